@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from decimal import Decimal
+from urllib.parse import quote
+
+import requests
+
+#
+# Pre-render the tiles of CKAN map previews into the tileserver cache.
+#
+# Reads the mappreview extra written by sync-datasets.py from a CKAN server
+# (or from a local JSON dump of those extras) and, for each raster layer,
+# requests the TileJSON document and the tiles that the dataset page's map
+# will request, over a range of zoom levels.
+#
+# Finished tiles are appended to a state file so an interrupted run can be
+# resumed by running the same command again.
+#
+# Usage:
+#  SEED_CKAN_URL=... TITILER_URL=... python seed-tile-cache.py --maxzoom 8
+#  python seed-tile-cache.py --from-json mappreviews.json --dataset some-dataset
+#
+# The JSON dump is either a list of CKAN packages (as returned by
+# package_show), or an object mapping dataset names to mappreview metadata.
+#
+
+CKAN_URL = os.environ.get('SEED_CKAN_URL', 'https://data.naturalcapitalproject.stanford.edu')
+TITILER_URL = os.environ.get('TITILER_URL',
+                             'https://titiler-897938321824.us-west1.run.app')
+
+# Keep in sync with _getRasterTilejsonUrl in ckanext-mappreview's mappreview.js
+MAPPREVIEW_COLORS = [
+    [109, 179, 30, 50],
+    [0, 143, 95, 255],
+    [0, 100, 110, 255],
+    [28, 58, 109, 255],
+    [39, 0, 59, 255],
+]
+MAPPREVIEW_COLORMAP = {
+    0: MAPPREVIEW_COLORS[0],
+    75: MAPPREVIEW_COLORS[1],
+    125: MAPPREVIEW_COLORS[2],
+    175: MAPPREVIEW_COLORS[3],
+    255: MAPPREVIEW_COLORS[4],
+}
+
+# Web Mercator's latitude limit
+MAX_LATITUDE = 85.0511287798066
+
+PROGRESS_INTERVAL = 10
+
+
+def js_number(value):
+    # Format a number the way JavaScript's String(number) does, so that
+    # query strings match the ones built by the browser.
+    if value is None:
+        return 'null'
+    value = float(value)
+    if value.is_integer() and abs(value) < 1e21:
+        return str(int(value))
+    if 1e-6 <= abs(value) < 1e21:
+        return format(Decimal(repr(value)), 'f')
+    mantissa, exponent = repr(value).split('e')
+    exponent = int(exponent)
+    return f'{mantissa}e{"+" if exponent > 0 else "-"}{abs(exponent)}'
+
+
+def encode_uri_component(value):
+    return quote(str(value), safe="-_.!~*'()")
+
+
+def get_tilejson_url(layer):
+    params = {
+        'tile_scale': 2,
+        'url': layer['url'],
+        'bidx': 1,
+        'format': 'webp',
+        'rescale': f'{js_number(layer["pixel_percentile_2"])},{js_number(layer["pixel_percentile_98"])}',
+        'colormap': json.dumps(
+            {str(k): v for k, v in MAPPREVIEW_COLORMAP.items()},
+            separators=(',', ':'),
+        ),
+        'colormap_type': 'linear',
+    }
+    prepared = '&'.join(f'{k}={encode_uri_component(v)}' for k, v in params.items())
+    return f'{TITILER_URL}/cog/WebMercatorQuad/tilejson.json?{prepared}'
+
+
+def lnglat_to_tile(lng, lat, z):
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    n = 2 ** z
+    x = int((lng + 180.0) / 360.0 * n)
+    sinlat = math.sin(math.radians(lat))
+    y = int((0.5 - math.log((1 + sinlat) / (1 - sinlat)) / (4 * math.pi)) * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def get_tiles(bounds, z):
+    minx, miny = lnglat_to_tile(bounds[0], bounds[3], z)
+    maxx, maxy = lnglat_to_tile(bounds[2], bounds[1], z)
+    for y in range(miny, maxy + 1):
+        for x in range(minx, maxx + 1):
+            yield z, x, y
+
+
+def get_mappreviews_from_json(path):
+    with open(path) as f:
+        dump = json.load(f)
+
+    if isinstance(dump, dict):
+        return list(dump.items())
+    return [(p['name'], get_package_mappreview(p)) for p in dump]
+
+
+def get_package_mappreview(package):
+    for extra in package.get('extras', []):
+        if extra['key'] == 'mappreview':
+            return json.loads(extra['value'])
+    return None
+
+
+def get_mappreviews_from_ckan(ckan_url, datasets=None):
+    if datasets:
+        for name in datasets:
+            r = requests.get(ckan_url + '/api/3/action/package_show', params={'id': name})
+            yield name, get_package_mappreview(r.json()['result'])
+        return
+
+    start = 0
+    rows = 1000
+    while True:
+        r = requests.get(ckan_url + '/api/3/action/package_search',
+                         params={'rows': rows, 'start': start})
+        results = r.json()['result']['results']
+        for package in results:
+            yield package['name'], get_package_mappreview(package)
+        if len(results) < rows:
+            return
+        start += rows
+
+
+class SeedState:
+    # Append-only record of finished tiles, one "<layer key> <z>/<x>/<y>"
+    # line each.  The layer key changes whenever the tile URLs do.
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.done = set(line.strip() for line in f if line.strip())
+        self.file = open(path, 'a') if path else None
+
+    def is_done(self, entry):
+        return entry in self.done
+
+    def mark_done(self, entry):
+        with self.lock:
+            self.done.add(entry)
+            if self.file:
+                self.file.write(entry + '\n')
+                self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class Progress:
+
+    def __init__(self):
+        self.total = 0
+        self.skipped = 0
+        self.done = 0
+        self.errors = 0
+        self.statuses = {}
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.reported = self.started
+
+    def record(self, status):
+        with self.lock:
+            self.done += 1
+            if status is None:
+                self.errors += 1
+            else:
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.reported < PROGRESS_INTERVAL:
+            return
+        self.reported = now
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed else 0
+        remaining = self.total - self.skipped - self.done
+        eta = f'{remaining / rate:.0f}s' if rate else '?'
+        statuses = ', '.join(f'{k}: {v}' for k, v in sorted(self.statuses.items()))
+        print(f'{self.done + self.skipped}/{self.total} tiles '
+              f'({self.skipped} already seeded, {self.errors} errors) '
+              f'{rate:.1f} tiles/s, eta {eta} [{statuses}]')
+
+
+def get_tiles_url(session, layer):
+    # Fetching the TileJSON also warms its cache entry
+    r = session.get(get_tilejson_url(layer), timeout=60)
+    r.raise_for_status()
+    return r.json()['tiles'][0]
+
+
+def seed_tile(session, tiles_url, tile):
+    z, x, y = tile
+    url = tiles_url.replace('{z}', str(z)).replace('{x}', str(x)).replace('{y}', str(y))
+    try:
+        r = session.get(url, timeout=120)
+    except requests.RequestException as e:
+        print(f'Failed to seed {url}: {e}')
+        return None
+
+    # 404s are tiles outside the dataset, which the tileserver never renders
+    if r.status_code not in (200, 404):
+        print(f'Failed to seed {url}: status code {r.status_code}')
+        return None
+    return r.headers.get('X-Cache', str(r.status_code))
+
+
+def seed_layer(layer, minzoom, maxzoom, workers, state, progress):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    try:
+        tiles_url = get_tiles_url(session, layer)
+    except Exception as e:
+        print(f'Failed to get TileJSON for {layer["url"]}: {e}')
+        return
+
+    layer_key = hashlib.sha1(tiles_url.encode()).hexdigest()[:16]
+    zooms = range(max(minzoom, layer.get('minzoom') or 0),
+                  min(maxzoom, layer.get('maxzoom') or maxzoom) + 1)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        for z in zooms:
+            for tile in get_tiles(layer['bounds'], z):
+                progress.total += 1
+                entry = f'{layer_key} {z}/{tile[1]}/{tile[2]}'
+                if state.is_done(entry):
+                    progress.skipped += 1
+                    continue
+
+                # Keep the queue short so that huge layers don't sit in memory
+                while len(pending) >= workers * 4:
+                    finished, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        finish_tile(future, pending.pop(future), state, progress)
+                    progress.report()
+
+                pending[executor.submit(seed_tile, session, tiles_url, tile)] = entry
+
+        for future in concurrent.futures.as_completed(pending):
+            finish_tile(future, pending[future], state, progress)
+            progress.report()
+
+
+def finish_tile(future, entry, state, progress):
+    status = future.result()
+    progress.record(status)
+    if status is not None:
+        state.mark_done(entry)
+
+
+def seed(mappreviews, minzoom, maxzoom, workers, state):
+    progress = Progress()
+    for name, mappreview in mappreviews:
+        if not mappreview:
+            continue
+        for layer in mappreview.get('layers', []):
+            if layer.get('type') != 'raster':
+                continue
+            print(f'Seeding {name}: {layer["name"]}')
+            seed_layer(layer, minzoom, maxzoom, workers, state, progress)
+            progress.report(force=True)
+    return progress
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-render map preview tiles into the tileserver cache.')
+    parser.add_argument('--from-json', help='Read mappreview metadata from a local JSON dump instead of CKAN')
+    parser.add_argument('--dataset', action='append', help='Only seed this dataset (repeatable)')
+    parser.add_argument('--minzoom', type=int, default=0)
+    parser.add_argument('--maxzoom', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent tile requests')
+    parser.add_argument('--state', default='seed-tile-cache.state',
+                        help='File recording finished tiles, for resuming')
+    args = parser.parse_args()
+
+    if args.from_json:
+        mappreviews = get_mappreviews_from_json(args.from_json)
+        if args.dataset:
+            mappreviews = [m for m in mappreviews if m[0] in args.dataset]
+    else:
+        mappreviews = get_mappreviews_from_ckan(CKAN_URL, args.dataset)
+
+    state = SeedState(args.state)
+    try:
+        print('Seeding tiles...')
+        progress = seed(mappreviews, args.minzoom, args.maxzoom, args.workers, state)
+    finally:
+        state.close()
+    print(f'Done. {progress.done} tiles requested, {progress.skipped} already seeded, '
+          f'{progress.errors} errors.')
@@ -1,8 +1,22 @@
 #!/usr/bin/env python
+import codecs
+import collections
+import concurrent.futures
+import hashlib
 import json
+import math
 import os
+import re
+import sys
+import threading
+import time
+import traceback
+from urllib.parse import urlparse
+
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 #
 # Sync CKAN datasets between two servers.
@@ -14,15 +28,169 @@ import yaml
 # If the source and destination servers are the same, the extra fields will be
 # added/udpated instead of deleting and adding datasets. 
 #
+# With SYNC_INCREMENTAL=1, only what changed is synced instead. Each dataset's
+# metadata_modified, derived extras, and a hash of their inputs (the YML, the
+# resources and the ETags of the GeoTIFFs and GeoJSONs previewed) are
+# recorded in a state file (SYNC_STATE). Datasets whose metadata_modified and
+# inputs are as recorded, and which are on the destination, are skipped.
+# Others are created or updated, and datasets on the destination that are no
+# longer on the source are purged. The derived extras are only recomputed if
+# their inputs changed. Datasets edited on the destination itself aren't
+# noticed; delete the state file to sync everything again.
+#
 # Usage:
 #  SYNC_DST_CKAN_APIKEY=... SYNC_SRC_URL=... SYNC_DST_URL=... python sync-datasets.py
 #
+# Datasets are synced by SYNC_WORKERS threads. Requests share a session, which
+# keeps connections alive and holds at most SYNC_*_CONNECTIONS at once to
+# each of the source CKAN, the destination CKAN, titiler and Cloud Storage.
+# Failed requests are retried SYNC_RETRIES times, with exponential backoff,
+# on connection errors and on 429, 502, 503 and 504 responses (only GETs and
+# HEADs for the latter). A summary of the run and its failures is printed at
+# the end, and the script exits with status 1 if any dataset failed.
+#
+# The bounds, feature counts and geometry types of vector layers are kept in
+# SYNC_VECTOR_SUMMARY_CACHE by URL and ETag, so that unchanged GeoJSONs aren't
+# downloaded again.
+#
+# Simplified versions of vector layers (a "pyramid", one GeoJSON per range of
+# zooms) are written under SYNC_VECTOR_PYRAMID_DIR if it is set. That
+# directory has to be copied to where SYNC_VECTOR_PYRAMID_URL serves it, e.g.
+#  gsutil -m rsync -r $SYNC_VECTOR_PYRAMID_DIR gs://<bucket>/pyramids
+# This needs shapely (mamba install shapely).
+#
 
 SRC = os.environ.get('SYNC_SRC_URL', 'https://data.naturalcapitalproject.stanford.edu')
 DST = os.environ.get('SYNC_DST_URL', 'http://localhost:5000')
 DST_APIKEY = os.environ['SYNC_DST_CKAN_APIKEY']
 TITILER_URL = os.environ.get('TITILER_URL',
                              'https://titiler-897938321824.us-west1.run.app')
+# Set to 0 to always compute exact raster statistics
+APPROXIMATE_STATISTICS = os.environ.get('SYNC_APPROXIMATE_STATISTICS', '1') != '0'
+# Largest standard error of approximate percentiles, as a fraction of the range
+STATISTICS_TOLERANCE = float(os.environ.get('SYNC_STATISTICS_TOLERANCE', '0.01'))
+# Where to write vector pyramids, and the URL that directory is served at
+VECTOR_PYRAMID_DIR = os.environ.get('SYNC_VECTOR_PYRAMID_DIR')
+VECTOR_PYRAMID_URL = os.environ.get('SYNC_VECTOR_PYRAMID_URL', '').rstrip('/')
+# Zooms at which each simplified version starts; the original is used from
+# the last one on
+VECTOR_PYRAMID_ZOOMS = [int(z) for z in
+                        os.environ.get('SYNC_VECTOR_PYRAMID_ZOOMS', '0,3,6,9,12').split(',')]
+# Simplification tolerance, in 256px tile pixels at the first zoom of a version
+VECTOR_PYRAMID_SIMPLIFY = float(os.environ.get('SYNC_VECTOR_PYRAMID_SIMPLIFY', '1'))
+# A version is only kept if it is at most this fraction of the original's size
+VECTOR_PYRAMID_MAX_RATIO = float(os.environ.get('SYNC_VECTOR_PYRAMID_MAX_RATIO', '0.5'))
+# Bounds, feature counts and geometry types of vector layers, by URL and ETag
+VECTOR_SUMMARY_CACHE = os.environ.get('SYNC_VECTOR_SUMMARY_CACHE', 'sync-vector-summaries.json')
+# Datasets synced at once, and connections at once to each host
+WORKERS = int(os.environ.get('SYNC_WORKERS', '8'))
+SRC_CONNECTIONS = int(os.environ.get('SYNC_SRC_CONNECTIONS', '4'))
+DST_CONNECTIONS = int(os.environ.get('SYNC_DST_CONNECTIONS', '4'))
+TITILER_CONNECTIONS = int(os.environ.get('SYNC_TITILER_CONNECTIONS', '4'))
+GCS_CONNECTIONS = int(os.environ.get('SYNC_GCS_CONNECTIONS', '8'))
+OTHER_CONNECTIONS = int(os.environ.get('SYNC_OTHER_CONNECTIONS', '4'))
+RETRIES = int(os.environ.get('SYNC_RETRIES', '3'))
+# Seconds before the first retry, doubled for each one after
+RETRY_BACKOFF = float(os.environ.get('SYNC_RETRY_BACKOFF', '1'))
+INCREMENTAL = os.environ.get('SYNC_INCREMENTAL', '0') != '0'
+STATE = os.environ.get('SYNC_STATE', 'sync-datasets.state.json')
+
+# Extras computed by this script, rather than copied from the source
+DERIVED_EXTRAS = ('sources', 'sources_res_formats', 'mappreview')
+
+
+class SyncReport:
+    """Counts of a sync's requests, by host, and of its datasets."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.synced = 0
+        self.skipped = 0
+        self.purged = 0
+        self.failures = []
+        self._lock = threading.Lock()
+
+    def count_response(self, response, *args, **kwargs):
+        host = urlparse(response.url).netloc
+        with self._lock:
+            self.requests[host] += 1
+            if response.status_code >= 400:
+                self.errors[host] += 1
+
+    def dataset_synced(self):
+        with self._lock:
+            self.synced += 1
+
+    def dataset_skipped(self):
+        with self._lock:
+            self.skipped += 1
+
+    def dataset_purged(self):
+        with self._lock:
+            self.purged += 1
+
+    def dataset_failed(self, id, error):
+        with self._lock:
+            self.failures.append((id, error))
+
+    def print(self):
+        elapsed = time.monotonic() - self.start
+        total = self.synced + self.skipped + len(self.failures)
+        print(f'Synced {self.synced} of {total} datasets in {elapsed:.1f}s '
+              f'({total / elapsed if elapsed else 0:.2f} datasets/s)')
+        if self.skipped or self.purged:
+            print(f'  {self.skipped} unchanged datasets skipped, {self.purged} purged')
+        for host, count in self.requests.most_common():
+            print(f'  {host}: {count} requests ({count / elapsed:.1f}/s), '
+                  f'{self.errors[host]} error responses')
+        if self.failures:
+            print(f'{len(self.failures)} datasets failed:')
+            for id, error in self.failures:
+                print(f'  {id}: {error}')
+
+
+def make_session(report):
+    """Return a session that pools and bounds connections per host."""
+    retry = Retry(
+        total=RETRIES,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=(429, 502, 503, 504),
+        raise_on_status=False,
+    )
+
+    def adapter(connections):
+        # Blocks a thread wanting a connection while all are in use
+        return HTTPAdapter(pool_maxsize=connections, pool_block=True, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter(OTHER_CONNECTIONS))
+    session.mount('https://', adapter(OTHER_CONNECTIONS))
+    gcs = adapter(GCS_CONNECTIONS)
+    session.mount('https://storage.googleapis.com/', gcs)
+    session.mount('https://storage.cloud.google.com/', gcs)
+    session.mount(TITILER_URL.rstrip('/') + '/', adapter(TITILER_CONNECTIONS))
+    session.mount(SRC.rstrip('/') + '/', adapter(SRC_CONNECTIONS))
+    if DST != SRC:
+        session.mount(DST.rstrip('/') + '/', adapter(DST_CONNECTIONS))
+    session.hooks['response'].append(report.count_response)
+    return session
+
+
+report = SyncReport()
+session = make_session(report)
+
+# One thread at a time reads or writes a vector layer's cached results
+_layer_locks = collections.defaultdict(threading.Lock)
+_layer_locks_lock = threading.Lock()
+_vector_summary_cache_lock = threading.Lock()
+_organization_lock = threading.Lock()
+
+
+def layer_lock(url):
+    with _layer_locks_lock:
+        return _layer_locks[url]
 
 
 def to_short_format(f):
@@ -49,19 +217,31 @@ def include_format(f):
     return f in to_keep
 
 
-def get_dataset_metadata(dataset):
+def get_dataset_metadata_yml(dataset):
+    # The text of the dataset's Geometamaker YML: None if it has none, and ''
+    # if it couldn't be fetched
     if dataset['resources']:
         for resource in dataset['resources']:
             if resource['description'] == 'Geometamaker YML':
                 try:
-                    r = requests.get(resource['url'])
-                    return yaml.safe_load(r.text)
+                    r = session.get(resource['url'])
+                    return r.text
                 except Exception as e:
                     print(f'Failed to get dataset metadata {resource["url"]}')
-                    return {}
+                    return ''
     return None
 
 
+def parse_dataset_metadata(yml):
+    if yml is None:
+        return None
+    try:
+        return yaml.safe_load(yml) if yml else {}
+    except Exception as e:
+        print('Failed to parse dataset metadata')
+        return {}
+
+
 def get_dataset_sources(dataset_metadata):
     return dataset_metadata.get('sources', None)
 
@@ -77,7 +257,7 @@ def bounds_valid(bounds):
 
 def get_raster_info(url):
     try:
-        r = requests.get(TITILER_URL + '/cog/info', params={'url': url})
+        r = session.get(TITILER_URL + '/cog/info', params={'url': url})
         j = r.json()
         bounds = j['bounds']
         # TODO titiler used to get min and maxzoom
@@ -93,9 +273,34 @@ def get_raster_info(url):
         raise e
 
 
+def approximate_statistics_usable(stats):
+    # Approximate statistics are used if the standard error of the 2nd
+    # percentile is small compared to the range of values
+    standard_error = stats.get('approximate', {}).get('standard_error', {})
+    if 'percentile_2' not in standard_error:
+        return False
+    value_range = stats['max'] - stats['min']
+    if value_range <= 0:
+        return standard_error['percentile_2'] == 0
+    return standard_error['percentile_2'] / value_range <= STATISTICS_TOLERANCE
+
+
 def get_raster_statistics(url):
-    statistics_response = requests.get(TITILER_URL + '/cog/statistics', params={'url': url})
-    stats = statistics_response.json()['b1']
+    stats = None
+    if APPROXIMATE_STATISTICS:
+        # Statistics from an overview or a sample of blocks are much faster
+        # than reading a preview of the whole GeoTIFF
+        statistics_response = session.get(TITILER_URL + '/cog/statistics',
+                                           params={'url': url, 'approximate': 'auto'})
+        if statistics_response.status_code == 200:
+            stats = statistics_response.json()['b1']
+            if not approximate_statistics_usable(stats):
+                print('Approximate statistics too uncertain, computing exact statistics', url)
+                stats = None
+
+    if stats is None:
+        statistics_response = session.get(TITILER_URL + '/cog/statistics', params={'url': url})
+        stats = statistics_response.json()['b1']
     return {
         'min': stats['min'],
         'max': stats['max'],
@@ -143,7 +348,7 @@ def get_raster_layer_metadata(raster_resource):
     if url.startswith('https://storage.cloud.google.com/'):
         url = url.replace('https://storage.cloud.google.com/', 'https://storage.googleapis.com/')
 
-    head_request = requests.head(url)
+    head_request = session.head(url)
     if head_request.status_code != 200 and 'retetion' in url:
         print('Failed to access GeoTIFF', url)
         print('Status code:', head_request.status_code)
@@ -176,38 +381,380 @@ def get_raster_layers_metadata(raster_resources):
     return filter(None, [get_raster_layer_metadata(r) for r in raster_resources])
 
 
+class GeoJSONFeatures:
+    """The features of a GeoJSON response, decoded one at a time.
+
+    Only the features being decoded are held in memory, not the whole
+    document. `crs` is the name of the document's legacy `crs` member, if
+    any: it is known once iteration starts if the member comes before the
+    features, and once iteration ends otherwise. `size` counts the bytes
+    read so far.
+    """
+
+    FEATURES_PATTERN = re.compile(r'"features"\s*:\s*\[')
+    CRS_PATTERN = re.compile(r'"crs"\s*:\s*\{.*?"name"\s*:\s*"([^"]+)"', re.DOTALL)
+
+    def __init__(self, response, chunk_size=1024 * 1024):
+        self.crs = None
+        self.size = 0
+        self._chunks = response.iter_content(chunk_size)
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._position = 0
+
+    def _read(self):
+        # Appends the next chunk to the undecoded rest of the buffer
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        self.size += len(chunk)
+        self._buffer = self._buffer[self._position:] + self._text.decode(chunk)
+        self._position = 0
+        return True
+
+    def __iter__(self):
+        while True:
+            match = self.FEATURES_PATTERN.search(self._buffer)
+            if match:
+                break
+            if not self._read():
+                # A single Feature or geometry
+                document = json.loads(self._buffer)
+                if document.get('type') != 'Feature':
+                    document = {'type': 'Feature', 'properties': {}, 'geometry': document}
+                yield document
+                return
+
+        crs = self.CRS_PATTERN.search(self._buffer, 0, match.start())
+        self.crs = crs.group(1) if crs else None
+        self._position = match.end()
+
+        decoder = json.JSONDecoder()
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in ' \t\r\n,':
+                self._position += 1
+            if self._position == len(self._buffer):
+                if not self._read():
+                    raise ValueError('GeoJSON ends within its features')
+                continue
+            if self._buffer[self._position] == ']':
+                # The crs member may also come after the features
+                self._position += 1
+                while self._read():
+                    pass
+                crs = self.CRS_PATTERN.search(self._buffer, self._position)
+                if crs:
+                    self.crs = crs.group(1)
+                return
+            try:
+                feature, self._position = decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                # The feature continues in the next chunk
+                if not self._read():
+                    raise
+                continue
+            yield feature
+
+
+def crs_is_wgs84(name):
+    return name is None or name.endswith('CRS84') or name.endswith('4326')
+
+
+def extend_bounds(bounds, coordinates):
+    # Extends [xmin, ymin, xmax, ymax] by a geometry's (nested) coordinates
+    if not coordinates:
+        return
+    if isinstance(coordinates[0], (int, float)):
+        coordinates = [coordinates]
+    elif not isinstance(coordinates[0][0], (int, float)):
+        for part in coordinates:
+            extend_bounds(bounds, part)
+        return
+    xs = [position[0] for position in coordinates]
+    ys = [position[1] for position in coordinates]
+    bounds[0] = min(bounds[0], min(xs))
+    bounds[1] = min(bounds[1], min(ys))
+    bounds[2] = max(bounds[2], max(xs))
+    bounds[3] = max(bounds[3], max(ys))
+
+
+class VectorLayerSummary:
+    """The bounds, feature count and geometry types of a GeoJSON's features.
+
+    Features are added one at a time as the GeoJSON is streamed, so that
+    the same pass can also write its pyramid. `complete` is set once the
+    whole GeoJSON has been read.
+    """
+
+    def __init__(self):
+        self.bounds = [math.inf, math.inf, -math.inf, -math.inf]
+        self.feature_count = 0
+        self.geometry_types = set()
+        self.crs = None
+        self.complete = False
+
+    def _add_geometry(self, geometry):
+        if geometry['type'] == 'GeometryCollection':
+            for part in geometry['geometries']:
+                self._add_geometry(part)
+            return
+        self.geometry_types.add(geometry['type'])
+        extend_bounds(self.bounds, geometry['coordinates'])
+
+    def add(self, feature):
+        self.feature_count += 1
+        if feature.get('geometry'):
+            self._add_geometry(feature['geometry'])
+
+    def finish(self, crs):
+        self.crs = crs
+        self.complete = True
+
+    def as_dict(self, url):
+        """Bounds are None if the layer has no coordinates or isn't in WGS84."""
+        bounds = self.bounds
+        if not crs_is_wgs84(self.crs):
+            print(f'GeoJSON is in {self.crs}, not WGS84', url)
+            bounds = None
+        elif bounds[0] > bounds[2]:
+            bounds = None
+        return {
+            'bounds': bounds,
+            'feature_count': self.feature_count,
+            'geometry_types': sorted(self.geometry_types),
+        }
+
+
+def summarize_vector_layer(url):
+    """Return the bounds, feature count and geometry types of a GeoJSON.
+
+    The GeoJSON is read in one streamed pass, a feature at a time.
+    """
+    summary = VectorLayerSummary()
+    with session.get(url, stream=True) as response:
+        response.raise_for_status()
+        features = GeoJSONFeatures(response)
+        for feature in features:
+            summary.add(feature)
+    summary.finish(features.crs)
+    return summary.as_dict(url)
+
+
+def get_vector_layer_summary(url, etag, summary=None):
+    """Return summarize_vector_layer(url), cached by URL and ETag.
+
+    `summary` is a complete VectorLayerSummary of the GeoJSON, if one was
+    made while writing its pyramid, so that it isn't read again.
+    """
+    with _vector_summary_cache_lock:
+        cached = read_vector_summary_cache().get(url)
+    if etag and cached and cached['etag'] == etag:
+        return cached['summary']
+
+    if summary is not None and summary.complete:
+        summary = summary.as_dict(url)
+    else:
+        summary = summarize_vector_layer(url)
+    if etag:
+        with _vector_summary_cache_lock:
+            cache = read_vector_summary_cache()
+            cache[url] = {'etag': etag, 'summary': summary}
+            with open(VECTOR_SUMMARY_CACHE + '.tmp', 'w') as f:
+                json.dump(cache, f)
+            os.replace(VECTOR_SUMMARY_CACHE + '.tmp', VECTOR_SUMMARY_CACHE)
+    return summary
+
+
+def read_vector_summary_cache():
+    if not os.path.exists(VECTOR_SUMMARY_CACHE):
+        return {}
+    with open(VECTOR_SUMMARY_CACHE) as f:
+        return json.load(f)
+
+
+def write_vector_pyramid(url, etag, summary=None):
+    """Write simplified versions of a GeoJSON, for ranges of zooms.
+
+    Each version's features are simplified to VECTOR_PYRAMID_SIMPLIFY pixels
+    at its first zoom, with coordinates rounded to match, and lines and
+    polygons smaller than that dropped. Versions are written as long as they
+    are at most VECTOR_PYRAMID_MAX_RATIO of the original's size; the zooms
+    after the last version are left to the original. A manifest next to
+    them records the original's ETag, so that an unchanged GeoJSON isn't
+    read again.
+
+    If `summary` (a VectorLayerSummary) is given, the features read are
+    also added to it, so that the GeoJSON is read once for both.
+
+    Returns a list of {minzoom, maxzoom, url, size, features}.
+    """
+    import numpy
+    import shapely
+    import shapely.geometry
+
+    path = urlparse(url).path.lstrip('/')
+    stem = path[:-len('.geojson')] if path.endswith('.geojson') else path
+    manifest_path = os.path.join(VECTOR_PYRAMID_DIR, stem + '.pyramid.json')
+
+    if etag and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('etag') == etag:
+            return manifest['levels']
+
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    levels = []
+    for zoom, next_zoom in zip(VECTOR_PYRAMID_ZOOMS, VECTOR_PYRAMID_ZOOMS[1:]):
+        tolerance = VECTOR_PYRAMID_SIMPLIFY * 360 / (256 * 2 ** zoom)
+        levels.append({
+            'minzoom': zoom,
+            'maxzoom': next_zoom - 1,
+            'tolerance': tolerance,
+            'digits': max(0, math.ceil(-math.log10(tolerance)) + 1),
+            'path': os.path.join(VECTOR_PYRAMID_DIR, f'{stem}.z{zoom}.geojson'),
+            'features': 0,
+        })
+
+    print('Writing vector pyramid', url)
+    files = [open(level['path'] + '.tmp', 'w') for level in levels]
+    try:
+        for f in files:
+            f.write('{"type": "FeatureCollection", "features": [\n')
+
+        with session.get(url, stream=True) as response:
+            response.raise_for_status()
+            features = GeoJSONFeatures(response)
+            for feature in features:
+                if summary is not None:
+                    summary.add(feature)
+                if not crs_is_wgs84(features.crs):
+                    raise ValueError(f'GeoJSON is in {features.crs}, not WGS84')
+                if not feature.get('geometry'):
+                    continue
+                geometry = shapely.geometry.shape(feature['geometry'])
+                xmin, ymin, xmax, ymax = geometry.bounds
+                extent = max(xmax - xmin, ymax - ymin)
+                properties = json.dumps(feature.get('properties') or {})
+                id = f', "id": {json.dumps(feature["id"])}' if 'id' in feature else ''
+
+                for level, f in zip(levels, files):
+                    if geometry.geom_type not in ('Point', 'MultiPoint') and extent < level['tolerance']:
+                        continue
+                    simplified = shapely.simplify(geometry, level['tolerance'], preserve_topology=True)
+                    simplified = shapely.transform(
+                        simplified, lambda coords: numpy.round(coords, level['digits']))
+                    if simplified.is_empty:
+                        continue
+                    if level['features']:
+                        f.write(',\n')
+                    f.write(f'{{"type": "Feature"{id}, "properties": {properties}, '
+                            f'"geometry": {shapely.to_geojson(simplified)}}}')
+                    level['features'] += 1
+
+        if summary is not None:
+            summary.finish(features.crs)
+        # A crs member after the features is only known now
+        if not crs_is_wgs84(features.crs):
+            raise ValueError(f'GeoJSON is in {features.crs}, not WGS84')
+
+        for f in files:
+            f.write('\n]}\n')
+    except Exception:
+        for level, f in zip(levels, files):
+            f.close()
+            os.remove(level['path'] + '.tmp')
+        raise
+    finally:
+        for f in files:
+            f.close()
+
+    # Keep versions while they are small enough to be worth loading instead
+    pyramid = []
+    for i, level in enumerate(levels):
+        size = os.path.getsize(level['path'] + '.tmp')
+        if len(pyramid) == i and size <= VECTOR_PYRAMID_MAX_RATIO * features.size:
+            os.replace(level['path'] + '.tmp', level['path'])
+            pyramid.append({
+                'minzoom': level['minzoom'],
+                'maxzoom': level['maxzoom'],
+                'url': f'{VECTOR_PYRAMID_URL}/{os.path.relpath(level["path"], VECTOR_PYRAMID_DIR)}',
+                'size': size,
+                'features': level['features'],
+            })
+        else:
+            os.remove(level['path'] + '.tmp')
+            if os.path.exists(level['path']):
+                os.remove(level['path'])
+
+    with open(manifest_path, 'w') as f:
+        json.dump({'url': url, 'etag': etag, 'size': features.size, 'levels': pyramid}, f, indent=2)
+    return pyramid
+
+
 def get_vector_layer_metadata(vector_resource):
     url = vector_resource['url']
 
     # Does this GeoJSON exist?
-    head_request = requests.head(url)
+    head_request = session.head(url)
     if head_request.status_code != 200:
         print('Failed to access', url)
         print('Status code:', head_request.status_code)
         return None
 
-    # If it exists, get all the info about it
-    try:
-        # TODO get bounds
-        bounds = [-180, -90, 180, 90]
+    # If it exists, get all the info about it.  Datasets synced at the same
+    # time may share a layer; the second one waits for the first's results.
+    with layer_lock(url):
+        return get_existing_vector_layer_metadata(vector_resource, head_request)
 
-        return {
-            'name': vector_resource['name'],
-            'type': 'vector',
-            'url': url,
-            'bounds': bounds,
-        }
+
+def get_existing_vector_layer_metadata(vector_resource, head_request):
+    url = vector_resource['url']
+    etag = head_request.headers.get('ETag')
+
+    # The pyramid is written first, summarizing the GeoJSON in the same pass
+    pyramid = None
+    layer_summary = VectorLayerSummary()
+    if VECTOR_PYRAMID_DIR:
+        try:
+            pyramid = write_vector_pyramid(url, etag, layer_summary)
+        except Exception as e:
+            print('Failed to write vector pyramid', url)
+            print(e)
+
+    metadata = {
+        'name': vector_resource['name'],
+        'type': 'vector',
+        'url': url,
+        'bounds': [-180, -90, 180, 90],
+    }
+
+    # Without a summary, the layer is still previewed, over the whole world
+    try:
+        summary = get_vector_layer_summary(url, etag, layer_summary)
     except Exception as e:
-        print('Failed to access', url)
-        print('Status code:', head_request.status_code)
-        return None
+        print('Failed to summarize vector layer', url)
+        print(e)
+    else:
+        if summary['bounds'] and bounds_valid(summary['bounds']):
+            metadata['bounds'] = summary['bounds']
+        metadata['feature_count'] = summary['feature_count']
+        metadata['geometry_types'] = summary['geometry_types']
+
+    if 'Content-Length' in head_request.headers:
+        metadata['size'] = int(head_request.headers['Content-Length'])
+
+    if pyramid:
+        metadata['pyramid'] = pyramid
+
+    return metadata
 
 
 def get_vector_layers_metadata(vector_resources):
     return filter(None, [get_vector_layer_metadata(r) for r in vector_resources])
 
 
-def get_mappreview_metadata(dataset, zip_sources):
+def get_layer_resources(dataset, zip_sources):
+    # The GeoTIFFs and GeoJSONs previewed, as lists of {name, url}
     raster_resources = [r for r in dataset['resources'] if r['format'] == 'GeoTIFF']
     vector_resources = [r for r in dataset['resources'] if r['format'] == 'Shapefile']
     layers = []
@@ -245,6 +792,12 @@ def get_mappreview_metadata(dataset, zip_sources):
                 'url': url,
             })
 
+    return raster_resources, vector_resources
+
+
+def get_mappreview_metadata(dataset, zip_sources):
+    raster_resources, vector_resources = get_layer_resources(dataset, zip_sources)
+    layers = []
     layers += get_raster_layers_metadata(raster_resources)
     layers += get_vector_layers_metadata(vector_resources)
 
@@ -257,21 +810,26 @@ def get_mappreview_metadata(dataset, zip_sources):
     return None
 
 
+def delete_dataset(id, dst, dst_apikey):
+    print('Deleting ' + id)
+    delete_response = session.post(dst + '/api/action/package_delete',
+                                   json={'id': id},
+                                   headers={'Authorization': dst_apikey})
+    purge_response = session.post(dst + '/api/action/dataset_purge',
+                                  json={'id': id},
+                                  headers={'Authorization': dst_apikey})
+
+
 def delete_datasets(dst, dst_apikey):
-    list_response = requests.get(dst + '/api/3/action/package_list')
+    list_response = session.get(dst + '/api/3/action/package_list')
 
-    for id in list_response.json()['result']:
-        print('Deleting ' + id)
-        delete_response = requests.post(dst + '/api/action/package_delete',
-                                        json={'id': id},
-                                        headers={'Authorization': dst_apikey})
-        purge_response = requests.post(dst + '/api/action/dataset_purge',
-                                        json={'id': id},
-                                        headers={'Authorization': dst_apikey})
+    with concurrent.futures.ThreadPoolExecutor(WORKERS) as executor:
+        list(executor.map(lambda id: delete_dataset(id, dst, dst_apikey),
+                          list_response.json()['result']))
 
 
-def get_dataset(id, src):
-    package_response = requests.get(src + '/api/3/action/package_show?id=' + id)
+def get_package(id, src):
+    package_response = session.get(src + '/api/3/action/package_show?id=' + id)
     package = package_response.json()['result']
 
     for extra in package['extras']:
@@ -280,25 +838,25 @@ def get_dataset(id, src):
 
     package['extras'] = [e for e in package['extras'] if e['key'] not in
                          ('suggested_citation',)]
+    return package
+
 
+def get_derived_extras(package, metadata):
     # If dataset has metadata with sources in it, add those
-    metadata = get_dataset_metadata(package)
     sources = get_dataset_sources(metadata)
 
     all_res_formats = [to_short_format(r['format']) for r in package['resources']]
-
-    # Remove extras that we will add
-    package['extras'] = [e for e in package['extras'] if e['key'] not in ('sources', 'sources_res_formats', 'mappreview')]
+    extras = []
 
     # Add sources
     if sources:
-        package['extras'].append({'key': 'sources', 'value': json.dumps(sources)})
+        extras.append({'key': 'sources', 'value': json.dumps(sources)})
         all_res_formats += [s.split('.')[-1] for s in sources]
 
     # Add sources_res_formats
     all_res_formats = [s for s in all_res_formats if include_format(s)]
     sources_res_formats = sorted(list(set(all_res_formats)))
-    package['extras'].append({
+    extras.append({
         'key': 'sources_res_formats',
         'value': json.dumps(sources_res_formats)
     })
@@ -306,30 +864,90 @@ def get_dataset(id, src):
     # Add mappreview
     mappreview_metadata = get_mappreview_metadata(package, sources)
     if mappreview_metadata:
-        package['extras'].append({'key': 'mappreview', 'value': json.dumps(mappreview_metadata)})
+        extras.append({'key': 'mappreview', 'value': json.dumps(mappreview_metadata)})
+
+    return extras
+
+
+def sha256(text):
+    return hashlib.sha256(text.encode()).hexdigest()
 
+
+def get_object_etag(url):
+    # None if the object can't be checked, so that it counts as changed
+    url = url.replace('https://storage.cloud.google.com/', 'https://storage.googleapis.com/')
+    try:
+        head_request = session.head(url)
+    except requests.RequestException:
+        return None
+    if head_request.status_code != 200:
+        return None
+    return head_request.headers.get('ETag')
+
+
+def get_inputs_sha256(package, yml):
+    """Return a hash of what the derived extras of a package are derived from.
+
+    That is its YML, its resources, and the ETags of the GeoTIFFs and
+    GeoJSONs it previews, so that objects changed in place are noticed.
+    """
+    resources = [[r.get('format'), r.get('url'), r.get('name'), r.get('description')]
+                 for r in package['resources']]
+    sources = get_dataset_sources(parse_dataset_metadata(yml) or {})
+    raster_resources, vector_resources = get_layer_resources(package, sources)
+    etags = [get_object_etag(r['url']) for r in raster_resources + vector_resources]
+    return sha256(json.dumps([yml, resources, etags]))
+
+
+def add_derived_extras(package, yml, previous=None, inputs=None):
+    """Add the derived extras to a package; return its state entry.
+
+    The extras of the `previous` state entry are reused if `inputs`, the
+    package's get_inputs_sha256, is the same as when they were derived.
+    """
+    if previous and inputs and previous['inputs_sha256'] == inputs:
+        extras = previous['extras']
+    else:
+        extras = get_derived_extras(package, parse_dataset_metadata(yml))
+
+    # Remove extras that we will add
+    package['extras'] = [e for e in package['extras'] if e['key'] not in DERIVED_EXTRAS]
+    package['extras'] += extras
+
+    return {
+        'metadata_modified': package.get('metadata_modified'),
+        'inputs_sha256': inputs,
+        'extras': extras,
+    }
+
+
+def get_dataset(id, src):
+    package = get_package(id, src)
+    add_derived_extras(package, get_dataset_metadata_yml(package))
     return package
 
 
 def add_dataset(id, dataset, dst, dst_apikey):
     print('Adding ' + id)
     organization_id = None
-    organization_response = requests.get(dst + '/api/action/organization_show?id=' + dataset['owner_org'])
 
-    if organization_response.status_code == 404:
-        print('Creating org')
-        organization_post_response = requests.post(
-            dst + '/api/action/organization_create',
-            headers={'Authorization': dst_apikey},
-            json=package_response.json()['result']['organization']
-        )
-        organization_id = organization_post_response.json()['result']['id']
+    # Only one dataset at a time may find its organization missing and
+    # create it
+    with _organization_lock:
+        organization_response = session.get(dst + '/api/action/organization_show?id=' + dataset['owner_org'])
 
-    for resource in dataset['resources']:
-        # We aren't uploading resources here, just linking to existing ones
-        resource['url_type'] = None
+        if organization_response.status_code == 404:
+            print('Creating org')
+            organization_post_response = session.post(
+                dst + '/api/action/organization_create',
+                headers={'Authorization': dst_apikey},
+                json=dataset['organization']
+            )
+            organization_id = organization_post_response.json()['result']['id']
 
-    post_response = requests.post(
+    link_resources(dataset)
+
+    post_response = session.post(
         dst + '/api/action/package_create',
         headers={'Authorization': dst_apikey},
         json=dataset
@@ -338,12 +956,19 @@ def add_dataset(id, dataset, dst, dst_apikey):
     if (post_response.status_code != 200):
         print(post_response.json()['error'])
         raise Exception('Failed to add ' + id)
+    return post_response.json()['result']
+
+
+def link_resources(dataset):
+    for resource in dataset['resources']:
+        # We aren't uploading resources here, just linking to existing ones
+        resource['url_type'] = None
 
 
 def update_dataset(id, dataset, dst, dst_apikey):
     print('Updating ' + id)
 
-    post_response = requests.post(
+    post_response = session.post(
         dst + '/api/action/package_update',
         headers={'Authorization': dst_apikey},
         json=dataset
@@ -352,6 +977,7 @@ def update_dataset(id, dataset, dst, dst_apikey):
     if (post_response.status_code != 200):
         print(post_response.json()['error'])
         raise Exception('Failed to update ' + id)
+    return post_response.json()['result']
 
 
 def sync_dataset(id, src, dst, dst_apikey, update=False):
@@ -363,11 +989,106 @@ def sync_dataset(id, src, dst, dst_apikey, update=False):
         update_dataset(id, dataset, dst, dst_apikey)
 
 
-def sync_datasets(src, dst, dst_apikey, update=False):
-    list_response = requests.get(src + '/api/3/action/package_list')
-
-    for id in list_response.json()['result']:
+def sync_dataset_reporting(id, src, dst, dst_apikey, update=False):
+    try:
         sync_dataset(id, src, dst, dst_apikey, update=update)
+        report.dataset_synced()
+    except Exception as e:
+        print(f'Failed to sync {id}')
+        traceback.print_exc()
+        report.dataset_failed(id, e)
+
+
+def sync_datasets(src, dst, dst_apikey, update=False):
+    list_response = session.get(src + '/api/3/action/package_list')
+
+    with concurrent.futures.ThreadPoolExecutor(WORKERS) as executor:
+        for id in list_response.json()['result']:
+            executor.submit(sync_dataset_reporting, id, src, dst, dst_apikey, update=update)
+
+
+class SyncState:
+    # What was last synced of each dataset, by name: the source's
+    # metadata_modified, and the derived extras and the hash of their
+    # inputs.  Rewritten whenever a dataset changes.
+
+    def __init__(self, path):
+        self.path = path
+        self.datasets = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.datasets = json.load(f)
+
+    def get(self, id):
+        with self.lock:
+            return self.datasets.get(id)
+
+    def set(self, id, entry):
+        with self.lock:
+            self.datasets[id] = entry
+            self._save()
+
+    def remove(self, id):
+        with self.lock:
+            if self.datasets.pop(id, None) is not None:
+                self._save()
+
+    def _save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.datasets, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def sync_dataset_incrementally(id, src, dst, dst_apikey, state, on_dst):
+    package = get_package(id, src)
+    yml = get_dataset_metadata_yml(package)
+    previous = state.get(id)
+    inputs = get_inputs_sha256(package, yml)
+
+    if (on_dst and previous and
+            previous['metadata_modified'] == package.get('metadata_modified') and
+            previous['inputs_sha256'] == inputs):
+        return False
+
+    entry = add_derived_extras(package, yml, previous, inputs)
+    if not on_dst:
+        result = add_dataset(id, package, dst, dst_apikey)
+    else:
+        if dst != src:
+            link_resources(package)
+        result = update_dataset(id, package, dst, dst_apikey)
+
+    # Updating a dataset in place changes its metadata_modified
+    if dst == src:
+        entry['metadata_modified'] = result['metadata_modified']
+    state.set(id, entry)
+    return True
+
+
+def sync_datasets_incrementally(src, dst, dst_apikey, state):
+    src_ids = session.get(src + '/api/3/action/package_list').json()['result']
+    dst_ids = set(session.get(dst + '/api/3/action/package_list').json()['result'])
+
+    def sync(id):
+        try:
+            if sync_dataset_incrementally(id, src, dst, dst_apikey, state, id in dst_ids):
+                report.dataset_synced()
+            else:
+                report.dataset_skipped()
+        except Exception as e:
+            print(f'Failed to sync {id}')
+            traceback.print_exc()
+            report.dataset_failed(id, e)
+
+    def purge(id):
+        delete_dataset(id, dst, dst_apikey)
+        state.remove(id)
+        report.dataset_purged()
+
+    with concurrent.futures.ThreadPoolExecutor(WORKERS) as executor:
+        list(executor.map(sync, src_ids))
+        list(executor.map(purge, dst_ids - set(src_ids)))
 
 
 if __name__ == '__main__':
@@ -375,11 +1096,21 @@ if __name__ == '__main__':
     if DST == SRC:
         update = True
 
-    if not update:
-        print('Deleting existing datasets...')
-        delete_datasets(DST, DST_APIKEY)
+    if INCREMENTAL:
+        print('Syncing changed datasets...')
+        sync_datasets_incrementally(SRC, DST, DST_APIKEY, SyncState(STATE))
+        print('Done.')
+    else:
+        if not update:
+            print('Deleting existing datasets...')
+            delete_datasets(DST, DST_APIKEY)
+            print('Done.')
+
+        print('Syncing datasets...')
+        sync_datasets(SRC, DST, DST_APIKEY, update=update)
         print('Done.')
 
-    print('Syncing datasets...')
-    sync_datasets(SRC, DST, DST_APIKEY, update=update)
-    print('Done.')
+    report.print()
+    # So that cron and CI notice a sync that didn't complete
+    if report.failures:
+        sys.exit(1)
@@ -52,6 +52,11 @@ ckan.module("mappreview", function ($, _) {
       return `${base}${endpoint}?${paramsPrepared}`;
     },
 
+    _getVectorTilesUrl: function (layer) {
+      const base = this._getGlobalConfig().titiler_url;
+      return `${base}/vector/{z}/{x}/{y}.mvt?url=${encodeURIComponent(layer.url)}`;
+    },
+
     _getRasterLayer: function (layer) {
       return {
         id: layer.name,
@@ -68,6 +73,7 @@ ckan.module("mappreview", function ($, _) {
         id: layer.name,
         type: 'fill',
         source: layer.name,
+        'source-layer': 'features',
         /*
         paint: {
           'raster-opacity': ['interpolate', ['linear'], ['zoom'], 0, 0.75, 12, 1],
@@ -81,6 +87,7 @@ ckan.module("mappreview", function ($, _) {
       jQuery.proxyAll(this, '_getRasterLayer');
       jQuery.proxyAll(this, '_getRasterTilejsonUrl');
       jQuery.proxyAll(this, '_getRasterPoint');
+      jQuery.proxyAll(this, '_getVectorTilesUrl');
       jQuery.proxyAll(this, '_getVectorLayer');
 
       const config = JSON.parse(this.options.config.replace(/'/g, '"'));
@@ -106,10 +113,11 @@ ckan.module("mappreview", function ($, _) {
           };
         }
         else if (l.type === 'vector') {
+          // Vector tiles of the GeoJSON, so that only what is visible is loaded
           return {
             id: l.name,
-            type: 'geojson',
-            data: l.url,
+            type: 'vector',
+            tiles: [this._getVectorTilesUrl(l)],
           };
         }
         else {
@@ -1,5 +1,4 @@
 import json
-import re
 from urllib.parse import urlencode
 from ckan.common import config
 import ckan.plugins as plugins
@@ -38,15 +37,18 @@ def get_layer_js(layer):
         layer_url = titiler_url + "/cog/tiles/WebMercatorQuad/{z}/{x}/{y}@2x?" + urlencode(query_params)
         return f"L.tileLayer('{layer_url}').addTo(map);"
     elif layer['type'] == 'vector':
-        slug = re.sub('[^a-zA-Z0-9]', '', layer['name'])
-        url = layer['url']
-        return f"""const add{slug} = async () => {{
-  const r = await fetch('{url}');
-  const geojson = await r.json();
-  L.geoJson(geojson).addTo(map);
-}};
-
-add{slug}();"""
+        # Vector tiles of the GeoJSON, so that only what is visible is loaded
+        titiler_url = get_config()['titiler_url']
+        query_params = {
+            'url': layer['url'],
+        }
+        layer_url = titiler_url + "/vector/{z}/{x}/{y}.mvt?" + urlencode(query_params)
+        return f"""L.vectorGrid.protobuf('{layer_url}', {{
+  rendererFactory: L.canvas.tile,
+  vectorTileLayerStyles: {{
+    features: {{ color: '#3388ff', weight: 2, fill: true, fillOpacity: 0.2, radius: 4 }},
+  }},
+}}).addTo(map);"""
 
 
 def get_layers_js(pkg):
@@ -54,12 +56,17 @@ def get_layers_js(pkg):
     return '\n'.join([get_layer_js(layer) for layer in layers])
 
 
+# The Leaflet.VectorGrid script still needs an `integrity` hash like the
+# Leaflet tags: a wrong one makes browsers refuse the script, so it must be
+# computed from the published file, with
+#   curl -sL <src> | openssl dgst -sha256 -binary | openssl base64 -A
 def generate_map_code(pkg):
     return """
 <div id="map" style="width: 100%; height: 400px;"></div>
 
 <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css" integrity="sha256-p4NxAoJBhIIN+hmNHrzRCf9tD/miZyoHS5obTRR9BMY=" crossorigin="" />
 <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js" integrity="sha256-20nQCchB9co0qIjJZRGuk2/Z9VM+kNiyxNV1lvTlZBo=" crossorigin=""></script>
+<script src="https://unpkg.com/leaflet.vectorgrid@1.3.0/dist/Leaflet.VectorGrid.bundled.min.js" crossorigin=""></script>
 <script>
   var map = L.map('map').setView([0, 0], 4);
 
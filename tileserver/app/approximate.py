@@ -0,0 +1,169 @@
+"""Approximate dataset statistics.
+
+app/approximate.py
+
+"""
+
+import math
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy
+from rio_tiler.io import Reader
+from rio_tiler.models import BandStatistics
+from rio_tiler.reader import read
+from rio_tiler.utils import get_array_statistics
+
+# Pixels per band read by default, about what titiler's 1024 pixel preview reads.
+DEFAULT_MAX_PIXELS = 1024 * 1024
+
+# Groups the pixels are split into to estimate the standard errors.
+ERROR_GROUPS = 8
+
+# Seed of the block sample, so that repeated requests agree.
+SAMPLE_SEED = 0
+
+
+def _overview_level(src_dst: Reader, max_pixels: int) -> Optional[int]:
+    """Return the finest overview level with at most `max_pixels` pixels."""
+    dataset = src_dst.dataset
+    for level, factor in enumerate(dataset.overviews(1)):
+        width = math.ceil(dataset.width / factor)
+        height = math.ceil(dataset.height / factor)
+        if width * height <= max_pixels:
+            return level
+    return None
+
+
+def _read_overview(src_dst: Reader, level: int, **kwargs):
+    dataset = src_dst.dataset
+    factor = dataset.overviews(1)[level]
+    # Reading at the overview's exact size makes GDAL use that overview.
+    image = read(
+        dataset,
+        width=math.ceil(dataset.width / factor),
+        height=math.ceil(dataset.height / factor),
+        **kwargs,
+    )
+    # Horizontal strips of the overview.
+    groups = numpy.array_split(image.array, min(ERROR_GROUPS, image.height), axis=1)
+    return image, [g.reshape(g.shape[0], -1) for g in groups], factor
+
+
+def _read_sample(src_dst: Reader, max_pixels: int, **kwargs):
+    """Read a deterministic random sample of the dataset's internal blocks."""
+    dataset = src_dst.dataset
+    windows = [window for _, window in dataset.block_windows(1)]
+    block_height, block_width = dataset.block_shapes[0]
+    count = min(len(windows), max(1, max_pixels // (block_height * block_width)))
+    rng = numpy.random.default_rng(SAMPLE_SEED)
+    chosen = sorted(rng.choice(len(windows), count, replace=False))
+
+    blocks = []
+    for index in chosen:
+        image = read(dataset, window=windows[index], **kwargs)
+        blocks.append(image.array.reshape(image.count, -1))
+
+    pixels = numpy.ma.concatenate(blocks, axis=1)
+    if len(blocks) < ERROR_GROUPS:
+        # Too few blocks to compare; use strips of rows instead.
+        groups = numpy.array_split(pixels, ERROR_GROUPS, axis=1)
+    else:
+        # Blocks are assigned to groups at random.
+        order = rng.permutation(len(blocks))
+        groups = [
+            numpy.ma.concatenate([blocks[i] for i in order[g::ERROR_GROUPS]], axis=1)
+            for g in range(ERROR_GROUPS)
+        ]
+    return image, pixels[:, numpy.newaxis, :], groups, count / len(windows)
+
+
+def _standard_errors(
+    groups: Sequence[numpy.ma.MaskedArray], band: int, percentiles: List[int]
+) -> Dict[str, Optional[float]]:
+    """Standard errors of the mean and percentiles, from their spread across groups.
+
+    Groups are spatially contiguous (strips or blocks), so the estimate
+    accounts for spatial correlation and errs on the large side.
+    """
+    values = [g[band].compressed() for g in groups]
+    values = [v for v in values if v.size]
+    if len(values) < 2:
+        return {}
+
+    estimates = {"mean": [v.mean() for v in values]}
+    for p in percentiles:
+        estimates[f"percentile_{p}"] = [numpy.percentile(v, p) for v in values]
+    return {
+        name: float(numpy.std(group_values, ddof=1) / math.sqrt(len(values)))
+        for name, group_values in estimates.items()
+    }
+
+
+def approximate_statistics(
+    src_dst: Reader,
+    method: str = "auto",
+    overview_level: Optional[int] = None,
+    max_pixels: int = DEFAULT_MAX_PIXELS,
+    categorical: bool = False,
+    categories: Optional[List[float]] = None,
+    percentiles: Optional[List[int]] = None,
+    hist_options: Optional[Dict] = None,
+    **kwargs: Any,
+) -> Dict[str, BandStatistics]:
+    """Return band statistics computed from an overview or a block sample.
+
+    `method` is "overview" (the level given by `overview_level`, or the
+    finest one with at most `max_pixels` pixels), "sample" (a fixed random
+    sample of internal blocks totalling about `max_pixels` pixels), or
+    "auto" (an overview if there is a small enough one, else a sample).
+    `kwargs` are passed to `rio_tiler.reader.read`, e.g. `indexes` and
+    `nodata`.
+
+    Each band's statistics get an "approximate" entry with the method,
+    the overview level and decimation factor or sampled fraction, and the
+    standard errors of the mean and percentiles.  Note that min and max
+    of an overview or sample can only be inside the true range.
+    """
+    percentiles = percentiles or [2, 98]
+    if method in ("auto", "overview") and overview_level is None:
+        overview_level = _overview_level(src_dst, max_pixels)
+        if overview_level is None and method == "overview":
+            # No overview is small enough; use the coarsest one.
+            overview_level = len(src_dst.dataset.overviews(1)) - 1
+    if method == "auto":
+        method = "overview" if overview_level is not None else "sample"
+
+    if method == "overview":
+        if overview_level is None or overview_level < 0:
+            raise ValueError("The dataset has no overviews")
+        if overview_level >= len(src_dst.dataset.overviews(1)):
+            raise ValueError(f"The dataset has no overview level {overview_level}")
+        image, groups, factor = _read_overview(src_dst, overview_level, **kwargs)
+        pixels = image.array
+        description = {
+            "method": "overview",
+            "overview_level": overview_level,
+            "decimation": factor,
+            "fraction": 1 / factor**2,
+        }
+    else:
+        image, pixels, groups, fraction = _read_sample(src_dst, max_pixels, **kwargs)
+        description = {"method": "sample", "fraction": fraction}
+
+    stats = get_array_statistics(
+        pixels,
+        categorical=categorical,
+        categories=categories,
+        percentiles=percentiles,
+        **(hist_options or {}),
+    )
+    return {
+        image.band_names[band]: BandStatistics(
+            **band_stats,
+            approximate={
+                **description,
+                "standard_error": _standard_errors(groups, band, percentiles),
+            },
+        )
+        for band, band_stats in enumerate(stats)
+    }
@@ -0,0 +1,467 @@
+"""Shared block cache.
+
+app/blockcache.py
+
+"""
+
+import collections
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import attr
+import httpx
+import rasterio
+from rio_tiler.io import Reader
+
+from readers import get_object_size, get_object_version, version_from_headers
+from settings import block_cache_setting
+
+LOGGER = logging.getLogger(__name__)
+
+
+class BlockCacheStats:
+    """Process-wide block cache counters, in blocks unless noted."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        # Range requests made for missing blocks, and the bytes they returned.
+        self.fetches = 0
+        self.fetched_bytes = 0
+        self.evictions = 0
+        # Bytes in the cache directory when it was last scanned.
+        self.size = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "fetches": self.fetches,
+            "fetched_bytes": self.fetched_bytes,
+            "evictions": self.evictions,
+            "size": self.size,
+        }
+
+
+block_cache_stats = BlockCacheStats()
+
+
+def _runs(indexes: List[int]) -> List[List[int]]:
+    """Split sorted block indexes into runs of consecutive ones."""
+    runs: List[List[int]] = []
+    for index in indexes:
+        if runs and runs[-1][-1] == index - 1:
+            runs[-1].append(index)
+        else:
+            runs.append([index])
+    return runs
+
+
+class _Mapping:
+    """Memory map of a cached block, and the readers using it."""
+
+    __slots__ = ("map", "touched", "readers", "evicted")
+
+    def __init__(self, map: mmap.mmap):
+        self.map = map
+        # Monotonic time the file was touched.
+        self.touched = 0.0
+        self.readers = 0
+        self.evicted = False
+
+
+class BlockCache:
+    """Byte ranges of remote datasets, cached in a directory on local disk.
+
+    Datasets are read in aligned blocks of `block_size` bytes.  Each block
+    is a file named by a hash of the dataset URL, its object version
+    (`readers.get_object_version`) and the block offset, so blocks never
+    change once written and a new version of a dataset is read afresh.
+    Consecutive missing blocks are fetched with one range request.  Since
+    the directory is shared, every worker of an instance, and its
+    replacements after a restart, reuse the blocks any of them has read.
+
+    Blocks are read through memory maps (the most recently used
+    `max_mapped` are kept per process), so hits are served from the page
+    cache that all workers share, without read calls.  Maps dropped from
+    the most recently used are closed once their last reader is done with
+    them.
+
+    Once a process has written enough to possibly exceed `max_size`, or
+    every `PURGE_INTERVAL` seconds, the directory is scanned in a
+    background thread and the blocks read least recently are removed.
+    Read times are file modification times, refreshed once every
+    `TOUCH_INTERVAL` seconds.
+    """
+
+    # Seconds before a read refreshes a block's modification time.
+    TOUCH_INTERVAL = 60
+    # Eviction frees space down to this fraction of `max_size`.
+    LOW_WATER = 0.9
+    # Seconds between scans of the directory.
+    PURGE_INTERVAL = 300
+
+    def __init__(self, directory: str, max_size: int, block_size: int, max_mapped: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.block_size = block_size
+        self.max_mapped = max_mapped
+        self._lock = threading.Lock()
+        # block path -> _Mapping, least recently used first
+        self._maps: collections.OrderedDict = collections.OrderedDict()
+        self._written = 0
+        self._purged = time.monotonic()
+        self._purging = False
+        self._http_client = httpx.Client(
+            follow_redirects=True,
+            timeout=30,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+        )
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def _path(self, url: str, version: str, index: int) -> str:
+        digest = hashlib.sha1(
+            f"{url}\n{version}\n{self.block_size}\n{index * self.block_size}".encode()
+        ).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def _mapped(self, path: str) -> Optional[_Mapping]:
+        """Check out the memory map of a cached block, or None if it isn't cached.
+
+        Every map checked out must be given back with `_release`.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._maps.get(path)
+            if entry is not None:
+                entry.readers += 1
+                self._maps.move_to_end(path)
+
+        if entry is None:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                return None
+            try:
+                mapped = _Mapping(mmap.mmap(fd, 0, prot=mmap.PROT_READ))
+            finally:
+                os.close(fd)
+
+            unused = []
+            with self._lock:
+                entry = self._maps.get(path)
+                if entry is None:
+                    entry = self._maps[path] = mapped
+                else:
+                    # Mapped by another thread meanwhile.
+                    self._maps.move_to_end(path)
+                    unused.append(mapped)
+                entry.readers += 1
+                while len(self._maps) > self.max_mapped:
+                    _, evicted = self._maps.popitem(last=False)
+                    evicted.evicted = True
+                    if not evicted.readers:
+                        unused.append(evicted)
+            self._close(unused)
+
+        if now - entry.touched > self.TOUCH_INTERVAL:
+            entry.touched = now
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Evicted; the mapping stays valid.
+                pass
+        return entry
+
+    def _release(self, entry: _Mapping):
+        """Give back a map checked out with `_mapped`."""
+        with self._lock:
+            entry.readers -= 1
+            unused = [entry] if entry.evicted and not entry.readers else []
+        self._close(unused)
+
+    @staticmethod
+    def _close(entries: List[_Mapping]):
+        for entry in entries:
+            entry.map.close()
+
+    def _write(self, path: str, data: bytes):
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # Written aside and renamed, so that readers never see part of a block.
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            LOGGER.warning(f"Could not write block cache file {path}", exc_info=True)
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            self._written += len(data)
+            due = (
+                self._written > self.max_size * (1 - self.LOW_WATER) / 2
+                or now - self._purged > self.PURGE_INTERVAL
+            )
+            due = due and not self._purging
+            if due:
+                self._written = 0
+                self._purged = now
+                self._purging = True
+        if due:
+            # Scanning the directory can take a while, so the request that
+            # wrote the block doesn't wait for it.
+            threading.Thread(
+                target=self._purge_in_background, name="block-cache-purge", daemon=True
+            ).start()
+
+    def _purge_in_background(self):
+        try:
+            self.purge()
+        except Exception:
+            LOGGER.exception("Block cache purge failed")
+        finally:
+            with self._lock:
+                self._purging = False
+
+    def _fetch(self, url: str, version: str, size: int, first: int, last: int) -> Dict[int, bytes]:
+        """Fetch blocks `first` to `last` with one range request and cache them."""
+        start = first * self.block_size
+        end = min((last + 1) * self.block_size, size)
+        response = self._http_client.get(url, headers={"Range": f"bytes={start}-{end - 1}"})
+        if response.status_code not in (200, 206):
+            raise IOError(f"HTTP {response.status_code} reading {url}")
+        response_version = version_from_headers(response.headers)
+        if response_version is not None and response_version != version:
+            raise IOError(f"{url} changed while it was read")
+
+        content = response.content
+        block_cache_stats.fetches += 1
+        block_cache_stats.fetched_bytes += len(content)
+        if response.status_code == 200:
+            # The server ignored the range.
+            content = content[start:end]
+        if len(content) != end - start:
+            raise IOError(f"Short read from {url}")
+
+        blocks = {}
+        for index in range(first, last + 1):
+            offset = (index - first) * self.block_size
+            blocks[index] = content[offset:offset + self.block_size]
+            self._write(self._path(url, version, index), blocks[index])
+        return blocks
+
+    def read(
+        self, url: str, version: str, size: int, start: int, end: int
+    ) -> bytes:
+        """Return bytes `start` to `end` of a dataset of `size` bytes."""
+        first, last = start // self.block_size, (end - 1) // self.block_size
+        mapped: Dict[int, _Mapping] = {}
+        missing = []
+        try:
+            for index in range(first, last + 1):
+                entry = self._mapped(self._path(url, version, index))
+                if entry is None:
+                    missing.append(index)
+                else:
+                    mapped[index] = entry
+            block_cache_stats.hits += len(mapped)
+            block_cache_stats.misses += len(missing)
+
+            blocks: Dict[int, Any] = {
+                index: entry.map for index, entry in mapped.items()
+            }
+            for run in _runs(missing):
+                blocks.update(self._fetch(url, version, size, run[0], run[-1]))
+
+            parts = []
+            for index in range(first, last + 1):
+                offset = index * self.block_size
+                parts.append(blocks[index][max(start - offset, 0):end - offset])
+            return parts[0] if len(parts) == 1 else b"".join(parts)
+        finally:
+            for entry in mapped.values():
+                self._release(entry)
+
+    def purge(self):
+        """Evict blocks read least recently until within `max_size`.
+
+        Only one process scans the directory at a time; the others skip.
+        """
+        lock_fd = os.open(os.path.join(self.directory, ".lock"), os.O_CREAT | os.O_RDWR)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            now = time.time()
+            blocks = []
+            total = 0
+            for subdirectory in os.scandir(self.directory):
+                if not subdirectory.is_dir():
+                    continue
+                for entry in os.scandir(subdirectory.path):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    if entry.name.startswith("."):
+                        # Left by a process that died while writing.
+                        if stat.st_mtime < now - self.PURGE_INTERVAL:
+                            os.unlink(entry.path)
+                        continue
+                    blocks.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+            if total > self.max_size:
+                blocks.sort()
+                target = total - self.max_size * self.LOW_WATER
+                for _, block_size, path in blocks:
+                    if target <= 0:
+                        break
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                    target -= block_size
+                    total -= block_size
+                    block_cache_stats.evictions += 1
+            block_cache_stats.size = total
+        finally:
+            os.close(lock_fd)
+
+    def opener(self, url: str) -> Optional["_Filesystem"]:
+        """Return a rasterio opener reading `url` through the cache.
+
+        Returns None if the dataset's version or size is unknown.
+        """
+        version = get_object_version(url)
+        size = get_object_size(url)
+        if version is None or not size:
+            return None
+        return _Filesystem(self, url, version, size)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, **block_cache_stats.as_dict()}
+
+
+class _File:
+    """Read-only file object over one version of a dataset."""
+
+    def __init__(self, cache: BlockCache, url: str, version: str, size: int):
+        self._cache = cache
+        self.url = url
+        self.version = version
+        self.size = size
+        self.position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        end = self.size if size < 0 else min(self.position + size, self.size)
+        if end <= self.position:
+            return b""
+        data = self._cache.read(self.url, self.version, self.size, self.position, end)
+        self.position = end
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Filesystem:
+    """A filesystem holding just one dataset, as a rasterio opener.
+
+    GDAL's probes for sidecar files (.aux.xml, .ovr, ...) find nothing,
+    without any request.
+    """
+
+    def __init__(self, cache: BlockCache, url: str, version: str, size: int):
+        self._cache = cache
+        self.url = url
+        self.version = version
+        self._size = size
+
+    def open(self, path: str, mode: str = "rb", **kwargs) -> _File:
+        if path != self.url:
+            raise FileNotFoundError(path)
+        return _File(self._cache, self.url, self.version, self._size)
+
+    def isfile(self, path: str) -> bool:
+        return path == self.url
+
+    def isdir(self, path: str) -> bool:
+        return False
+
+    def ls(self, path: str) -> List[str]:
+        return []
+
+    def mtime(self, path: str) -> int:
+        return 0
+
+    def size(self, path: str) -> int:
+        if path != self.url:
+            raise FileNotFoundError(path)
+        return self._size
+
+
+block_cache = BlockCache(
+    block_cache_setting.directory,
+    block_cache_setting.max_size,
+    block_cache_setting.block_size,
+    block_cache_setting.max_mapped,
+)
+
+
+@attr.s
+class BlockCacheReader(Reader):
+    """rio-tiler Reader that reads remote datasets through the block cache.
+
+    Local paths, and all datasets when BLOCK_CACHE_DIRECTORY is not set,
+    are opened by GDAL as usual.
+    """
+
+    def __attrs_post_init__(self):
+        if (
+            not self.dataset
+            and block_cache.enabled
+            and self.input.startswith(("http://", "https://"))
+        ):
+            opener = block_cache.opener(self.input)
+            if opener is not None:
+                self.dataset = self._ctx_stack.enter_context(
+                    rasterio.open(self.input, opener=opener)
+                )
+        super().__attrs_post_init__()
@@ -5,33 +5,660 @@ app/cache.py
 """
 
 import asyncio
+import collections
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
 import urllib
-from typing import Any, Dict
+from typing import Any, Callable, Dict, Tuple
 import logging
 
 import aiocache
+from aiocache.base import BaseCache
+from aiocache.serializers import BaseSerializer, NullSerializer
 from starlette.concurrency import run_in_threadpool
 from starlette.responses import Response
 
 from fastapi.dependencies.utils import is_coroutine_callable
 
+from readers import get_object_version
 from settings import cache_setting
 
 LOGGER = logging.getLogger(__name__)
 
+# Query parameters that never change the rendered output.
+IGNORED_QUERY_PARAMS = ("access_token",)
+
+
+class CacheStats:
+    """Process-wide cache counters.
+
+    Lookups and hits are counted per tier: ``local`` is the in-process LRU
+    cache and ``shared`` the Redis/Memcached backend, when configured.
+    """
+
+    def __init__(self):
+        self.lookups = collections.Counter()
+        self.hits = collections.Counter()
+        self.misses = 0
+        self.evictions = 0
+        # Misses answered by waiting on another request's render.
+        self.coalesced = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        hits = sum(self.hits.values())
+        requests = hits + self.misses
+        return {
+            "hits": hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "coalesced": self.coalesced,
+            "hit_ratio": hits / requests if requests else 0.0,
+            "tiers": {
+                tier: {
+                    "lookups": lookups,
+                    "hits": self.hits[tier],
+                    "hit_ratio": self.hits[tier] / lookups,
+                }
+                for tier, lookups in self.lookups.items()
+            },
+        }
+
+
+cache_stats = CacheStats()
+
+
+class LRUMemoryCache(BaseCache):
+    """In-process cache bounded by the total size of its values.
+
+    Values are ``(content, media_type)`` tuples.  Once the stored content
+    exceeds ``max_size`` bytes, the least recently used entries are evicted.
+    Expired entries are dropped lazily, when they are next read.
+    """
+
+    NAME = "lru_memory"
+
+    def __init__(self, serializer=None, max_size=cache_setting.max_size, **kwargs):
+        super().__init__(
+            serializer=serializer or NullSerializer(),
+            **kwargs,
+        )
+        self.max_size = int(max_size)
+        self.size = 0
+        # key -> (value, size in bytes, expiry as a monotonic timestamp or None)
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def _sizeof(key, value) -> int:
+        content, media_type = value
+        return len(key) + len(content) + len(media_type or "")
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        value, _, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._pop(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def _pop(self, key) -> int:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return 0
+        self.size -= entry[1]
+        return 1
+
+    async def _get(self, key, encoding="utf-8", _conn=None):
+        return self._lookup(key)
+
+    async def _gets(self, key, encoding="utf-8", _conn=None):
+        return self._lookup(key)
+
+    async def _multi_get(self, keys, encoding="utf-8", _conn=None):
+        return [self._lookup(key) for key in keys]
+
+    async def _set(self, key, value, ttl=None, _cas_token=None, _conn=None):
+        if _cas_token is not None and _cas_token != self._lookup(key):
+            return 0
+
+        self._pop(key)
+        size = self._sizeof(key, value)
+        if size > self.max_size:
+            return 0
+
+        while self._entries and self.size + size > self.max_size:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+            cache_stats.evictions += 1
+
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._entries[key] = (value, size, expires_at)
+        self.size += size
+        return True
+
+    async def _multi_set(self, pairs, ttl=None, _conn=None):
+        for key, value in pairs:
+            await self._set(key, value, ttl=ttl)
+        return True
+
+    async def _add(self, key, value, ttl=None, _conn=None):
+        if self._lookup(key) is not None:
+            raise ValueError(
+                "Key {} already exists, use .set to update the value".format(key)
+            )
+        return await self._set(key, value, ttl=ttl)
+
+    async def _exists(self, key, _conn=None):
+        return self._lookup(key) is not None
+
+    async def _expire(self, key, ttl, _conn=None):
+        value = self._lookup(key)
+        if value is None:
+            return False
+        value, size, _ = self._entries[key]
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._entries[key] = (value, size, expires_at)
+        return True
+
+    async def _delete(self, key, _conn=None):
+        return self._pop(key)
+
+    async def _clear(self, namespace=None, _conn=None):
+        if namespace:
+            for key in [k for k in self._entries if k.startswith(namespace)]:
+                self._pop(key)
+        else:
+            self._entries.clear()
+            self.size = 0
+        return True
+
+    async def _redlock_release(self, key, value):
+        if self._lookup(key) == value:
+            return self._pop(key)
+        return 0
+
+
+class TileSerializer(BaseSerializer):
+    """Serialize ``(content, media_type)`` tuples as raw bytes.
+
+    The media type is stored as a single header line in front of the
+    content, so shared backends never have to unpickle anything.
+    """
+
+    DEFAULT_ENCODING = None
+
+    def dumps(self, value):
+        content, media_type = value
+        return (media_type or "").encode() + b"\n" + content
+
+    def loads(self, value):
+        if value is None:
+            return None
+        media_type, content = value.split(b"\n", 1)
+        return content, media_type.decode() or None
+
+
+# Tile coordinates in a cache key's path, e.g. "/tiles/WebMercatorQuad/5/16/11".
+TILE_PATH_PATTERN = re.compile(
+    r"(?:/tiles/[^/?]+|/vector)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)"
+)
+
+# Dataset URL in a cache key's query.
+DATASET_PATTERN = re.compile(r"[?&]url=(?P<url>[^&]*)")
+
+
+class SQLiteCache(BaseCache):
+    """Cache stored in a local SQLite file, shared by the processes using it.
+
+    Entries are keyed by dataset URL, tile coordinates (-1 for other
+    routes) and a hash of the rest of the cache key, i.e. the route and
+    its render parameters.  The database is in WAL mode, so readers in
+    several workers don't block each other or the writer.
+
+    Once the stored content exceeds ``max_size`` bytes, the entries read
+    least recently are evicted.  Read times are only refreshed once every
+    ``TOUCH_INTERVAL`` seconds, so that hits rarely write.  Expired entries
+    are skipped when read and removed when the cache is trimmed.
+    """
+
+    NAME = "sqlite"
+
+    # Seconds before a read refreshes an entry's access time.
+    TOUCH_INTERVAL = 60
+    # Eviction frees space down to this fraction of `max_size`.
+    LOW_WATER = 0.9
+    # Seconds between removals of expired entries.
+    PURGE_INTERVAL = 300
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tiles (
+            id INTEGER PRIMARY KEY,
+            dataset TEXT NOT NULL,
+            z INTEGER NOT NULL,
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            params BLOB NOT NULL,
+            media_type TEXT,
+            content BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            expires REAL,
+            accessed REAL NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS tiles_key ON tiles (dataset, z, x, y, params);
+        CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed);
+        CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL);
+        INSERT OR IGNORE INTO usage VALUES (0, 0);
+        CREATE TRIGGER IF NOT EXISTS tiles_insert AFTER INSERT ON tiles BEGIN
+            UPDATE usage SET size = size + new.size;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tiles_update AFTER UPDATE OF size ON tiles BEGIN
+            UPDATE usage SET size = size + new.size - old.size;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tiles_delete AFTER DELETE ON tiles BEGIN
+            UPDATE usage SET size = size - old.size;
+        END;
+    """
+
+    def __init__(
+        self, serializer=None, path="tiles.db", max_size=cache_setting.max_size, **kwargs
+    ):
+        super().__init__(
+            serializer=serializer or NullSerializer(),
+            **kwargs,
+        )
+        self.path = path
+        self.max_size = int(max_size)
+        self._local = threading.local()
+        self._purged = 0.0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        with conn:
+            conn.executescript(self.SCHEMA)
+        # Not kept: the app may be preloaded before forking workers.
+        conn.close()
+
+    @classmethod
+    def parse_uri_path(cls, path):
+        return {"path": path}
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread and process.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = self._connect()
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _split_key(key: str) -> Tuple[str, int, int, int, bytes]:
+        """Return the (dataset, z, x, y, params hash) of a cache key."""
+        dataset = ""
+        match = DATASET_PATTERN.search(key)
+        if match:
+            dataset = urllib.parse.unquote_plus(match.group("url"))
+            key = key[: match.start()] + key[match.end():]
+
+        z = x = y = -1
+        match = TILE_PATH_PATTERN.search(key)
+        if match:
+            z, x, y = (int(v) for v in match.group("z", "x", "y"))
+            key = key[: match.start()] + key[match.end():]
+
+        return dataset, z, x, y, hashlib.sha1(key.encode()).digest()[:12]
+
+    @staticmethod
+    def _row_value(row):
+        if row is None:
+            return None
+        media_type, content = row
+        # Raw values (e.g. render locks) are stored without a media type.
+        if media_type is None:
+            return content
+        return content, media_type or None
+
+    def _lookup(self, key):
+        now = time.time()
+        conn = self._conn
+        row = conn.execute(
+            "SELECT id, media_type, content, accessed FROM tiles"
+            " WHERE dataset = ? AND z = ? AND x = ? AND y = ? AND params = ?"
+            " AND (expires IS NULL OR expires > ?)",
+            (*self._split_key(key), now),
+        ).fetchone()
+        if row is None:
+            return None
+
+        if row[3] < now - self.TOUCH_INTERVAL:
+            conn.execute("UPDATE tiles SET accessed = ? WHERE id = ?", (now, row[0]))
+        return self._row_value(row[1:3])
+
+    def _store(self, key, value, ttl=None, replace=True) -> bool:
+        if isinstance(value, tuple):
+            content, media_type = value
+            media_type = media_type or ""
+        else:
+            content, media_type = value, None
+
+        now = time.time()
+        expires = now + ttl if ttl else None
+        condition = "" if replace else " WHERE tiles.expires IS NOT NULL AND tiles.expires <= ?"
+        params = (
+            *self._split_key(key), media_type, content, len(content), expires, now
+        )
+        cursor = self._conn.execute(
+            "INSERT INTO tiles (dataset, z, x, y, params, media_type, content, size, expires, accessed)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (dataset, z, x, y, params) DO UPDATE SET"
+            " media_type = excluded.media_type, content = excluded.content,"
+            " size = excluded.size, expires = excluded.expires, accessed = excluded.accessed"
+            + condition,
+            params if replace else (*params, now),
+        )
+        stored = cursor.rowcount > 0
+        if stored:
+            self._trim(now)
+        return stored
+
+    def _trim(self, now: float):
+        """Remove expired entries, then evict until within `max_size`."""
+        conn = self._conn
+        if now - self._purged > self.PURGE_INTERVAL:
+            self._purged = now
+            conn.execute("DELETE FROM tiles WHERE expires <= ?", (now,))
+
+        (size,) = conn.execute("SELECT size FROM usage").fetchone()
+        if size <= self.max_size:
+            return
+
+        target = size - self.max_size * self.LOW_WATER
+        evicted = 0
+        while target > 0:
+            rows = conn.execute(
+                "SELECT id, size FROM tiles ORDER BY accessed LIMIT 256"
+            ).fetchall()
+            if not rows:
+                break
+            ids = []
+            for row_id, row_size in rows:
+                ids.append(row_id)
+                target -= row_size
+                if target <= 0:
+                    break
+            conn.execute(
+                f"DELETE FROM tiles WHERE id IN ({','.join('?' * len(ids))})", ids
+            )
+            evicted += len(ids)
+        cache_stats.evictions += evicted
+
+    def _delete_key(self, key) -> int:
+        cursor = self._conn.execute(
+            "DELETE FROM tiles WHERE dataset = ? AND z = ? AND x = ? AND y = ? AND params = ?",
+            self._split_key(key),
+        )
+        return cursor.rowcount
+
+    def _expire_key(self, key, ttl) -> bool:
+        expires = time.time() + ttl if ttl else None
+        cursor = self._conn.execute(
+            "UPDATE tiles SET expires = ?"
+            " WHERE dataset = ? AND z = ? AND x = ? AND y = ? AND params = ?",
+            (expires, *self._split_key(key)),
+        )
+        return cursor.rowcount > 0
+
+    def _delete_all(self):
+        self._conn.execute("DELETE FROM tiles")
+
+    async def _get(self, key, encoding="utf-8", _conn=None):
+        return await run_in_threadpool(self._lookup, key)
+
+    async def _gets(self, key, encoding="utf-8", _conn=None):
+        return await self._get(key)
+
+    async def _multi_get(self, keys, encoding="utf-8", _conn=None):
+        return [await self._get(key) for key in keys]
+
+    async def _set(self, key, value, ttl=None, _cas_token=None, _conn=None):
+        if _cas_token is not None and _cas_token != await self._get(key):
+            return 0
+        return await run_in_threadpool(self._store, key, value, ttl)
+
+    async def _multi_set(self, pairs, ttl=None, _conn=None):
+        for key, value in pairs:
+            await self._set(key, value, ttl=ttl)
+        return True
+
+    async def _add(self, key, value, ttl=None, _conn=None):
+        if not await run_in_threadpool(self._store, key, value, ttl, False):
+            raise ValueError(
+                "Key {} already exists, use .set to update the value".format(key)
+            )
+        return True
+
+    async def _exists(self, key, _conn=None):
+        return await self._get(key) is not None
+
+    async def _expire(self, key, ttl, _conn=None):
+        return await run_in_threadpool(self._expire_key, key, ttl)
+
+    async def _delete(self, key, _conn=None):
+        return await run_in_threadpool(self._delete_key, key)
+
+    async def _clear(self, namespace=None, _conn=None):
+        # Keys are stored hashed, so a namespace can't be cleared on its own.
+        await run_in_threadpool(self._delete_all)
+        return True
+
+    async def _redlock_release(self, key, value):
+        if await self._get(key) == value:
+            return await self._delete(key)
+        return 0
+
+
+def request_cache_key(f, *args, **kwargs) -> str:
+    """Build a cache key from the request's path and normalized query.
+
+    Query parameters are sorted by name (keeping the relative order of
+    repeated parameters, e.g. ``bidx``) so that equivalent URLs share one
+    entry.  The base URL is kept because TileJSON documents embed it.
+    """
+    request = kwargs["request"]
+    return path_cache_key(f, request, request.url.path)
+
+
+def path_cache_key(f, request, path: str) -> str:
+    """Build the `request_cache_key` of `path` with the query of `request`."""
+    return "{}:{}{}?{}".format(
+        f.__name__,
+        str(request.base_url).rstrip("/"),
+        path,
+        normalized_query(request),
+    )
+
+
+def versioned_key(key: str, version: str) -> str:
+    """Return `key` for the given object version of its dataset."""
+    return key.replace(":", f"@{version}:", 1)
+
+
+def normalized_query(request) -> str:
+    """Return the query of `request` sorted by name, without ignored parameters."""
+    query = sorted(
+        (
+            (key, value)
+            for key, value in request.query_params.multi_items()
+            if key not in IGNORED_QUERY_PARAMS
+        ),
+        key=lambda item: item[0],
+    )
+    return urllib.parse.urlencode(query)
+
+
+# Renders in progress in this process, by cache key.
+_inflight: Dict[str, asyncio.Future] = {}
+
+# Builders for content that is cheap to recreate, e.g. fully transparent
+# tiles, so that only a short placeholder has to be stored.
+_placeholders: Dict[str, Callable[[str], bytes]] = {}
+
+
+def register_placeholder(name: str, build: Callable[[str], bytes]):
+    """Register `build(argument)` as the content of `placeholder(name, argument)`."""
+    _placeholders[name] = build
+
+
+# Starts every placeholder.  Long enough that no image format's signature
+# (JPEG 2000's starts with NUL bytes, too) or JSON document can match it.
+PLACEHOLDER_PREFIX = b"\0\0tileserver-placeholder\0"
+
+
+def placeholder(name: str, argument: str) -> bytes:
+    """Return a short stand-in for the content built by the `name` builder."""
+    return PLACEHOLDER_PREFIX + f"{name}:{argument}".encode()
+
+
+def is_placeholder(content: bytes) -> bool:
+    """Whether `content` is a `placeholder`."""
+    return content.startswith(PLACEHOLDER_PREFIX)
+
+
+def expand_placeholder(content: bytes) -> bytes:
+    """Return the content a placeholder stands for, or `content` itself."""
+    if not is_placeholder(content):
+        return content
+    name, argument = content[len(PLACEHOLDER_PREFIX):].decode().split(":", 1)
+    return _placeholders[name](argument)
+
+
+def _cached_response(value, status) -> Response:
+    content, media_type = value
+    return Response(
+        expand_placeholder(content),
+        media_type=media_type,
+        headers={"X-Cache": status},
+    )
+
+
+async def _call(f, args, kwargs):
+    # CUSTOM, we add support for non-async method
+    if is_coroutine_callable(f):
+        return await f(*args, **kwargs)
+    return await run_in_threadpool(f, *args, **kwargs)
+
+
+def _is_cacheable(result) -> bool:
+    return isinstance(result, Response) and result.status_code == 200
+
+
 class cached(aiocache.cached):
-    """Custom Cached Decorator."""
+    """Custom Cached Decorator.
+
+    Only successful ``Response`` objects are cached, and they are stored as
+    their encoded content plus media type rather than as pickled responses.
+
+    When a ``local`` cache alias is configured, it is checked before the
+    main cache, written through on every store, and populated with values
+    found in the main cache.
+
+    Concurrent misses for the same key are coalesced: within a process they
+    wait on the render already in flight, and across processes sharing a
+    Redis/Memcached backend they wait on a short-lived lock key for the
+    value to appear.  Waiting gives up after ``CACHE_LOCK_TIMEOUT`` seconds
+    and falls back to rendering independently.
+
+    With ``versioned``, keys also include the object version of the
+    request's ``url`` dataset (see `readers.get_object_version`), so that
+    entries can be kept for long and are not used once the dataset
+    changes.  Responses for datasets without a known version are not
+    cached.
+
+    With ``admit``, a context manager factory such as
+    `render_pool.RenderPool.admit`, the route is only called inside it.  It
+    is entered on the event loop, so a request it rejects never waits for a
+    threadpool thread.
+
+    A route may attach ``related`` to its response: a mapping of other URL
+    paths of the same route (answering the same query) to their
+    ``(content, media_type)``, e.g. the other tiles of a metatile.  They are
+    stored alongside the response.  It may also set ``cache_content`` to a
+    `placeholder` to store instead of its body.
+    """
+
+    def __init__(
+        self,
+        *args,
+        key_builder=request_cache_key,
+        local_alias="local",
+        versioned=False,
+        admit=None,
+        **kwargs,
+    ):
+        super().__init__(*args, key_builder=key_builder, **kwargs)
+        self.local_alias = local_alias
+        self.local_cache = None
+        self.versioned = versioned
+        self.admit = admit
+
+    def __call__(self, f):
+        if self.local_alias in aiocache.caches.get_config():
+            self.local_cache = aiocache.caches.get(self.local_alias)
+        return super().__call__(f)
+
+    @property
+    def shared(self) -> bool:
+        """Whether the backing cache is shared with other processes."""
+        return not isinstance(self.cache, LRUMemoryCache)
 
     async def get_from_cache(self, key):
+        if self.local_cache is not None:
+            cache_stats.lookups["local"] += 1
+            value = await self._get_local(key)
+            if value is not None:
+                cache_stats.hits["local"] += 1
+                return value
+
+        tier = "shared" if self.shared else "local"
+        cache_stats.lookups[tier] += 1
+        value = await super().get_from_cache(key)
+        if value is not None:
+            cache_stats.hits[tier] += 1
+            if self.local_cache is not None:
+                await self._set_local(key, value)
+        return value
+
+    async def set_in_cache(self, key, value):
+        if self.local_cache is not None:
+            await self._set_local(key, value)
+        await super().set_in_cache(key, value)
+
+    async def _get_local(self, key):
         try:
-            value = await self.cache.get(key)
-            if isinstance(value, Response):
-                value.headers["X-Cache"] = "HIT"
-            return value
+            return await self.local_cache.get(key)
         except Exception:
-            aiocache.logger.exception(
-                "Couldn't retrieve %s, unexpected error", key
-            )
+            LOGGER.exception("Couldn't retrieve %s locally, unexpected error", key)
+
+    async def _set_local(self, key, value):
+        try:
+            await self.local_cache.set(key, value)
+        except Exception:
+            LOGGER.exception("Couldn't set %s locally, unexpected error", key)
 
     async def decorator(
         self,
@@ -43,39 +670,184 @@ class cached(aiocache.cached):
         **kwargs,
     ):
         key = self.get_cache_key(f, args, kwargs)
+        version = None
+        if self.versioned:
+            url = kwargs["request"].query_params.get("url")
+            version = url and await run_in_threadpool(get_object_version, url)
+            if not version:
+                return await self._call(f, args, kwargs)
+            key = versioned_key(key, version)
 
         if cache_read:
             value = await self.get_from_cache(key)
             if value is not None:
-                return value
+                return _cached_response(value, "HIT")
 
-        # CUSTOM, we add support for non-async method
-        if is_coroutine_callable(f):
-            result = await f(*args, **kwargs)
-        else:
-            result = await run_in_threadpool(f, *args, **kwargs)
+        cache_stats.misses += 1
 
-        if cache_write:
-            if aiocache_wait_for_write:
-                await self.set_in_cache(key, result)
+        inflight = _inflight.get(key)
+        if inflight is not None:
+            try:
+                result = await asyncio.wait_for(
+                    asyncio.shield(inflight), cache_setting.lock_timeout
+                )
+            except asyncio.TimeoutError:
+                LOGGER.warning("Timed out waiting for in-flight render of %s", key)
+            except asyncio.CancelledError:
+                # Only swallow the cancellation of the render we waited on.
+                if not inflight.cancelled():
+                    raise
             else:
-                asyncio.ensure_future(self.set_in_cache(key, result))
+                cache_stats.coalesced += 1
+                if _is_cacheable(result):
+                    return _cached_response(
+                        (result.body, result.media_type), "COALESCED"
+                    )
+                return result
+
+            return await self._render(
+                key, version, f, args, kwargs, cache_write, aiocache_wait_for_write
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        _inflight[key] = future
+        try:
+            result = await self._render(
+                key, version, f, args, kwargs, cache_write, aiocache_wait_for_write
+            )
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Waiters re-raise the error; don't warn if there were none.
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            if _inflight.get(key) is future:
+                del _inflight[key]
 
         return result
 
+    async def _render(
+        self, key, version, f, args, kwargs, cache_write, wait_for_write
+    ):
+        """Call the route, holding the shared render lock when there is one.
+
+        ``version`` is the object version in ``key``, if it is versioned.
+        """
+        lock_key = f"lock:{key}"
+        locked = False
+        if self.shared:
+            locked = await self._acquire_lock(lock_key)
+            if not locked:
+                value = await self._wait_for_value(key, lock_key)
+                if value is not None:
+                    cache_stats.coalesced += 1
+                    return _cached_response(value, "COALESCED")
+
+        try:
+            result = await self._call(f, args, kwargs)
+
+            if not _is_cacheable(result):
+                return result
+
+            result.headers["X-Cache"] = "MISS"
+
+            if cache_write:
+                content = getattr(result, "cache_content", None) or bytes(result.body)
+                values = {key: (content, result.media_type)}
+                for path, value in getattr(result, "related", {}).items():
+                    related_key = path_cache_key(f, kwargs["request"], path)
+                    if version:
+                        related_key = versioned_key(related_key, version)
+                    values[related_key] = value
+
+                write = asyncio.gather(
+                    *(self.set_in_cache(k, v) for k, v in values.items())
+                )
+                if wait_for_write:
+                    await write
+
+            return result
+        finally:
+            if locked:
+                await self._release_lock(lock_key)
+
+    async def _call(self, f, args, kwargs):
+        if self.admit is None:
+            return await _call(f, args, kwargs)
+        with self.admit():
+            return await _call(f, args, kwargs)
+
+    async def _acquire_lock(self, lock_key) -> bool:
+        try:
+            return await self.cache.add(
+                lock_key,
+                b"1",
+                ttl=cache_setting.lock_timeout,
+                dumps_fn=lambda value: value,
+            )
+        except ValueError:
+            return False
+        except Exception:
+            # If the shared cache is unavailable, render without the lock.
+            LOGGER.exception("Couldn't acquire %s, unexpected error", lock_key)
+            return True
+
+    async def _release_lock(self, lock_key):
+        try:
+            await self.cache.delete(lock_key)
+        except Exception:
+            LOGGER.exception("Couldn't release %s, unexpected error", lock_key)
+
+    async def _wait_for_value(self, key, lock_key):
+        """Poll the shared cache while another process renders ``key``.
+
+        Returns ``None`` if the lock is released without a value being
+        written (the other render failed) or the wait times out.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + cache_setting.lock_timeout
+        delay = 0.05
+        while loop.time() < deadline:
+            await asyncio.sleep(delay)
+            value = await super().get_from_cache(key)
+            if value is not None:
+                return value
+            try:
+                if not await self.cache.exists(lock_key):
+                    return None
+            except Exception:
+                return None
+            delay = min(delay * 2, 0.5)
+
+        LOGGER.warning("Timed out waiting for shared render of %s", key)
+        return None
+
 
 def setup_cache():
     """Setup aiocache."""
     config: Dict[str, Any] = {
-        'cache': "aiocache.SimpleMemoryCache",
+        'cache': "cache.LRUMemoryCache",
+        'max_size': cache_setting.max_size,
         'serializer': {
-            'class': "aiocache.serializers.PickleSerializer"
+            'class': "aiocache.serializers.NullSerializer"
         }
     }
     if cache_setting.ttl is not None:
         config["ttl"] = cache_setting.ttl
 
-    if cache_setting.endpoint:
+    if cache_setting.endpoint.startswith("sqlite:"):
+        # e.g. sqlite:////var/cache/tiles.db?max_size=1073741824
+        url = urllib.parse.urlparse(cache_setting.endpoint)
+        config.update(dict(urllib.parse.parse_qsl(url.query)))
+        config.update(SQLiteCache.parse_uri_path(url.netloc + url.path))
+        config["cache"] = "cache.SQLiteCache"
+
+    elif cache_setting.endpoint:
         url = urllib.parse.urlparse(cache_setting.endpoint)
         ulr_config = dict(urllib.parse.parse_qsl(url.query))
         config.update(ulr_config)
@@ -84,6 +856,8 @@ def setup_cache():
         config.update(cache_class.parse_uri_path(url.path))
         config["endpoint"] = url.hostname
         config["port"] = str(url.port)
+        config["serializer"] = {"class": "cache.TileSerializer"}
+        del config["max_size"]
 
         # Add other configuration into config here, Example for namespace:
         """
@@ -99,5 +873,18 @@ def setup_cache():
         elif cache_class == aiocache.Cache.MEMCACHED:
             config["cache"] = "aiocache.MemcachedCache"
 
-    LOGGER.info(f"Setting up cache with configuration: {config}")
-    aiocache.caches.set_config({"default": config})
\ No newline at end of file
+    caches = {"default": config}
+
+    # Keep the hottest tiles in-process in front of the shared backend.
+    if cache_setting.endpoint and cache_setting.local_max_size > 0:
+        caches["local"] = {
+            'cache': "cache.LRUMemoryCache",
+            'max_size': cache_setting.local_max_size,
+            'ttl': min(cache_setting.local_ttl, cache_setting.ttl),
+            'serializer': {
+                'class': "aiocache.serializers.NullSerializer"
+            }
+        }
+
+    LOGGER.info(f"Setting up cache with configuration: {caches}")
+    aiocache.caches.set_config(caches)
@@ -4,19 +4,115 @@ app/dependencies.py
 
 """
 
+import functools
 import json
 from typing import Dict
 from typing import Literal
 from typing import Optional
 
-import matplotlib
 import numpy
 from fastapi import HTTPException
 from fastapi import Query
 from rio_tiler.colormap import cmap as default_cmap
+from rio_tiler.colormap import make_lut
 from rio_tiler.colormap import parse_color
 from typing_extensions import Annotated
 
+# Number of distinct colormap query values to keep parsed.
+COLORMAP_CACHE_SIZE = 256
+
+
+class FrozenColorMap(dict):
+    """Colormap dict that cannot be modified.
+
+    Parsed colormaps are memoized and shared between requests, so changing
+    one in place would change it for every later request.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Colormaps are shared and cannot be modified.")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+
+class ColorMapLUT(FrozenColorMap):
+    """Colormap dict that also carries its (256, 4) uint8 lookup table."""
+
+    def __init__(self, lut: numpy.ndarray):
+        super().__init__((idx, tuple(rgba)) for idx, rgba in enumerate(lut.tolist()))
+        lut.flags.writeable = False
+        self.lut = lut
+
+    def __reduce__(self):
+        return (type(self), (numpy.array(self.lut),))
+
+
+def linear_colormap_lut(cm: Dict[int, tuple]) -> numpy.ndarray:
+    """Linearly interpolate colormap stops into a (256, 4) uint8 table.
+
+    Stops are keyed by their position in 0-255; colors before the first and
+    after the last stop are held constant.  The interpolation follows
+    matplotlib's ``LinearSegmentedColormap`` lookup table step for step, so
+    the output matches sampling one built from the same stops.
+    """
+    positions = sorted(cm)
+    stops = [cm[k] for k in positions]
+    if positions[0] != 0:
+        positions, stops = [0] + positions, stops[:1] + stops
+    if positions[-1] != 255:
+        positions, stops = positions + [255], stops + stops[-1:]
+
+    x = numpy.array(positions, dtype="float64") / 255 * 255
+    y = numpy.array(stops, dtype="float64") / 255
+
+    xind = 255 * numpy.linspace(0, 1, 256)
+    ind = numpy.searchsorted(x, xind)[1:-1]
+    distance = (xind[1:-1] - x[ind - 1]) / (x[ind] - x[ind - 1])
+    lut = numpy.concatenate(
+        [y[:1], distance[:, None] * (y[ind] - y[ind - 1]) + y[ind - 1], y[-1:]]
+    )
+    return (numpy.clip(lut, 0, 1) * 255).astype("uint8")
+
+
+@functools.lru_cache(maxsize=COLORMAP_CACHE_SIZE)
+def get_named_colormap(name: str) -> ColorMapLUT:
+    """Return one of rio-tiler's registered colormaps."""
+    return ColorMapLUT(make_lut(default_cmap.get(name)))
+
+
+@functools.lru_cache(maxsize=COLORMAP_CACHE_SIZE)
+def parse_colormap(colormap: str, colormap_type: str) -> FrozenColorMap:
+    """Parse a JSON encoded colormap query value."""
+    try:
+        cm = json.loads(
+            colormap,
+            object_hook=lambda x: {int(k): parse_color(v) for k, v in x.items()},
+        )
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="Could not parse the colormap value."
+        )
+
+    if not isinstance(cm, dict) or not cm:
+        raise HTTPException(
+            status_code=400, detail="The colormap needs at least one color."
+        )
+
+    if colormap_type == "linear":
+        # Stops are positions in the 256 entry lookup table.
+        if not all(0 <= k <= 255 for k in cm):
+            raise HTTPException(
+                status_code=400,
+                detail="Linear colormap stops need to be between 0 and 255.",
+            )
+        return ColorMapLUT(linear_colormap_lut(cm))
+
+    return FrozenColorMap(cm)
+
 
 def ColorMapParams(
             colormap_name: Annotated[  # type: ignore
@@ -34,35 +130,10 @@ def ColorMapParams(
         ) -> Optional[Dict]:
     """Colormap Dependency."""
     if colormap_name:
-        return default_cmap.get(colormap_name)
+        return get_named_colormap(colormap_name)
 
     if colormap:
-        try:
-            cm = json.loads(
-                colormap,
-                object_hook=lambda x: {int(k): parse_color(v) for k, v in x.items()},
-            )
-        except json.JSONDecodeError:
-            raise HTTPException(
-                status_code=400, detail="Could not parse the colormap value."
-            )
-
-        if colormap_type == "linear":
-            # input colormap has to start from 0 to 255 ?
-            cm = matplotlib.colors.LinearSegmentedColormap.from_list(
-                'custom',
-                [
-                    (k / 255, matplotlib.colors.to_hex([v / 255 for v in rgba], keep_alpha=True))
-                    for (k, rgba) in cm.items()
-                ],
-                256,
-            )
-            x = numpy.linspace(0, 1, 256)
-            cmap_vals = cm(x)[:, :]
-            cmap_uint8 = (cmap_vals * 255).astype('uint8')
-            cm = {idx: value.tolist() for idx, value in enumerate(cmap_uint8)}
-
-        return cm
+        return parse_colormap(colormap, colormap_type)
 
     return None
 
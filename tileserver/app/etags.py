@@ -0,0 +1,130 @@
+"""ETags and conditional requests.
+
+app/etags.py
+
+"""
+
+import hashlib
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import dependencies
+from cache import normalized_query
+from metrics import route_label
+from readers import peek_object_version
+
+# Routes answered from a dataset given by the `url` query parameter.
+ETAG_ROUTES = ("tile", "tilejson", "info", "statistics", "vector_tile")
+
+# Bump when a change to rendering changes the responses for the same
+# dataset and parameters, so that clients don't keep stale tiles.
+ETAG_VERSION = "1"
+
+
+def dataset_etag(
+    request: Request, version: Optional[str], encoding: Optional[str] = None
+) -> Optional[str]:
+    """Return the strong ETag of a dataset route's response.
+
+    Built from the dataset's object version (e.g. the GCS generation) and
+    the request's path and normalized query.  A compressed response gets
+    its content coding as a suffix, as each coding is its own
+    representation.  Returns None when the version is not known.
+    """
+    if version is None:
+        return None
+
+    parts = [
+        ETAG_VERSION,
+        version,
+        str(request.base_url),
+        request.url.path,
+        normalized_query(request),
+    ]
+    tag = hashlib.sha256("\n".join(parts).encode()).hexdigest()[:32]
+    if encoding:
+        tag = f"{tag}-{encoding}"
+    return f'"{tag}"'
+
+
+def etag_match(etag: str, if_none_match: str) -> Optional[str]:
+    """Return the tag in `If-None-Match` that matches `etag`, if any.
+
+    Tags are compared weakly, and a tag of any content coding of the same
+    response matches: the client can still decode the copy it has.
+    """
+    if if_none_match.strip() == "*":
+        return etag
+    prefix = etag[:-1] + "-"
+    for tag in if_none_match.split(","):
+        tag = tag.strip().removeprefix("W/")
+        if tag == etag or tag.startswith(prefix):
+            return tag
+    return None
+
+
+class ETagMiddleware:
+    """Add ETags to dataset routes and answer `If-None-Match` with a 304.
+
+    ETags come from the object versions the routes look up anyway
+    (`readers.peek_object_version`), so the middleware never makes a
+    request itself.  While the version is fresh, a matching conditional
+    request is answered before looking up the cache or reading the
+    dataset; otherwise the route runs and the ETag is added to its
+    response.  Only successful responses carry the ETag.
+
+    Add it outside the compression middleware, so that the ETag describes
+    the body as sent.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+
+        route = route_label(scope["path"])
+        request = Request(scope)
+        url = request.query_params.get("url")
+        # Only datasets the routes would read have a version.
+        if route not in ETAG_ROUTES or not url or not url.startswith(
+            dependencies.ALLOWED_PREFIXES
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        etag = dataset_etag(request, peek_object_version(url, fresh=True))
+        if_none_match = request.headers.get("if-none-match")
+        if etag is not None and if_none_match:
+            matched = etag_match(etag, if_none_match)
+            if matched is not None:
+                await send(
+                    {
+                        "type": "http.response.start",
+                        "status": 304,
+                        "headers": [(b"etag", matched.encode())],
+                    }
+                )
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                # The route has looked up the version by now.
+                encoding = Headers(raw=message.get("headers", [])).get(
+                    "content-encoding"
+                )
+                response_etag = dataset_etag(
+                    request, peek_object_version(url), encoding
+                )
+                if response_etag is not None:
+                    headers = MutableHeaders(scope=message)
+                    headers.append("etag", response_etag)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
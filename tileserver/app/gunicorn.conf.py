@@ -0,0 +1,113 @@
+"""gunicorn config.
+
+app/gunicorn.conf.py
+
+Production launch mode: `gunicorn main:app` from this directory runs
+WORKER_COUNT uvicorn workers (one by default; 0 for one per available CPU).
+The app is imported, and its lazily built state loaded (`main.preload`),
+before the workers are forked, so they share it copy-on-write.  Workers are
+replaced gracefully after WORKER_MAX_REQUESTS requests or once their
+resident memory goes over WORKER_MAX_MEMORY MB, so that growth of GDAL's
+block cache and other per-process caches doesn't accumulate.
+
+Every worker has its own in-process tile cache (CACHE_MAX_SIZE, and
+CACHE_LOCAL_MAX_SIZE in front of a shared cache), reader pool
+(READER_POOL_MAX_OPEN), block cache mappings (BLOCK_CACHE_MAX_MAPPED),
+vector layer pool (VECTOR_MAX_LAYERS) and, with
+TILE_RENDER_BACKEND=process, render pool (TILE_RENDER_PROCESSES).  Memory
+and processes therefore grow with WORKER_COUNT, and an in-process cache's
+hit ratio drops as requests spread over more copies of it.  With more than
+one worker, divide those sizes by the worker count, and use a cache shared
+by the workers (CACHE_ENDPOINT=sqlite:///... or redis://...).
+
+"""
+
+import gc
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import threading
+
+from settings import worker_setting
+
+LOGGER = logging.getLogger(__name__)
+
+# Metrics of all workers are added up through files in this directory; it
+# must be set before prometheus_client is imported by the app.
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "tileserver-metrics")
+)
+shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+bind = f"{os.environ.get('HOST', '127.0.0.1')}:{os.environ.get('PORT', 8000)}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = worker_setting.count or len(os.sched_getaffinity(0))
+if workers > 1 and not os.environ.get("CACHE_ENDPOINT"):
+    LOGGER.warning(
+        "%d workers each have their own in-process tile cache; consider a "
+        "shared CACHE_ENDPOINT",
+        workers,
+    )
+preload_app = True
+max_requests = worker_setting.max_requests
+max_requests_jitter = worker_setting.max_requests_jitter
+graceful_timeout = worker_setting.graceful_timeout
+# Tiles of large datasets can take a while to read.
+timeout = 120
+accesslog = None
+
+
+def _resident_memory() -> int:
+    """Resident memory of this process, in bytes."""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _watch_memory(limit: int, interval: float):
+    event = threading.Event()
+    while not event.wait(interval):
+        rss = _resident_memory()
+        if rss > limit:
+            LOGGER.warning(
+                "Worker %s uses %d MB, over WORKER_MAX_MEMORY; restarting it",
+                os.getpid(),
+                rss // 2**20,
+            )
+            # uvicorn finishes the requests in flight, then gunicorn starts
+            # a new worker.
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+
+
+def when_ready(server):
+    import main
+
+    main.preload()
+    # Keep the garbage collector from touching, and so copying, the
+    # preloaded objects in every worker.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import main
+
+    main.setup_logging()
+
+
+def post_worker_init(worker):
+    if worker_setting.max_memory:
+        threading.Thread(
+            target=_watch_memory,
+            args=(worker_setting.max_memory * 2**20, worker_setting.memory_check_interval),
+            name="memory-watchdog",
+            daemon=True,
+        ).start()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
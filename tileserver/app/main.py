@@ -12,12 +12,14 @@ import re
 import os
 
 import jinja2
+import rasterio
 from fastapi import Depends, FastAPI, HTTPException, Security
 from fastapi.security.api_key import APIKeyQuery
-from rio_tiler.io import Reader, STACReader
+from rio_tiler.colormap import cmap as default_cmap
+from rio_tiler.io import STACReader
 from starlette.middleware.cors import CORSMiddleware
 from starlette.requests import Request
-from starlette.responses import HTMLResponse
+from starlette.responses import HTMLResponse, JSONResponse
 from starlette.templating import Jinja2Templates
 from starlette_cramjam.middleware import CompressionMiddleware
 
@@ -46,22 +48,44 @@ from titiler.mosaic.errors import MOSAIC_STATUS_CODES
 from titiler.mosaic.factory import MosaicTilerFactory
 import google.cloud.logging
 
-from cache import setup_cache
+from blockcache import BlockCacheReader, block_cache
+from cache import cache_stats, setup_cache
+from etags import ETagMiddleware
+from metrics import MetricsMiddleware, metrics_response
+from profiler import ProfilerMiddleware
+from render import short_circuits
+from render_pool import RenderQueueFull, render_pool
+from settings import profiler_setting, tile_setting
 
 #logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger(__name__)
 
-try:
-    # Instantiates a client
-    client = google.cloud.logging.Client()
 
-    # Retrieves a Cloud Logging handler based on the environment
-    # you're running in and integrates the handler with the
-    # Python logging module. By default this captures all logs
-    # at INFO level and higher
-    client.setup_logging()
-except Exception as e:
-    LOGGER.info(f"Skipping GCP cloud logging setup; no credentials found. {str(e)}")
+def setup_logging():
+    """Send logs to GCP Cloud Logging, if credentials are available.
+
+    Called again in each worker of a preloaded multi-worker server, since
+    the client's connections and background thread don't survive a fork.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if type(handler).__module__.startswith("google.cloud.logging"):
+            root.removeHandler(handler)
+
+    try:
+        # Instantiates a client
+        client = google.cloud.logging.Client()
+
+        # Retrieves a Cloud Logging handler based on the environment
+        # you're running in and integrates the handler with the
+        # Python logging module. By default this captures all logs
+        # at INFO level and higher
+        client.setup_logging()
+    except Exception as e:
+        LOGGER.info(f"Skipping GCP cloud logging setup; no credentials found. {str(e)}")
+
+
+setup_logging()
 
 logging.getLogger("botocore.credentials").disabled = True
 logging.getLogger("botocore.utils").disabled = True
@@ -127,14 +151,16 @@ if not api_settings.disable_cog:
     if os.path.exists('/app'):
         sys.path.append('/app')
 
-    # Setup Cache
-    app.add_event_handler('startup', setup_cache)
+    # Setup Cache.  This has to happen before the routes are imported, since
+    # `cached(alias=...)` looks up the configured cache when it decorates.
+    setup_cache()
 
-    from dependencies import ColorMapParams, DatasetPathParams
+    from dependencies import ColorMapParams, DatasetPathParams, get_named_colormap
     from routes import TilerFactory
+    from vectortiles import router as vector_router, vector_layers
 
     cog = TilerFactory(
-        reader=Reader,
+        reader=BlockCacheReader,
         router_prefix="/cog",
         colormap_dependency=ColorMapParams,
         path_dependency=DatasetPathParams,
@@ -151,6 +177,12 @@ if not api_settings.disable_cog:
         tags=["Cloud Optimized GeoTIFF"],
     )
 
+    app.include_router(
+        vector_router,
+        prefix="/vector",
+        tags=["GeoJSON Vector Tiles"],
+    )
+
 
 ###############################################################################
 # STAC endpoints
@@ -207,6 +239,27 @@ app.include_router(
 add_exception_handlers(app, DEFAULT_STATUS_CODES)
 add_exception_handlers(app, MOSAIC_STATUS_CODES)
 
+
+@app.exception_handler(RenderQueueFull)
+def render_queue_full(request: Request, exc: RenderQueueFull):
+    """Shed load when every tile render slot is taken."""
+    return JSONResponse(
+        {"detail": "Too many tiles are being rendered, retry later"},
+        status_code=503,
+        headers={"Retry-After": str(tile_setting.render_retry_after)},
+    )
+
+
+@app.on_event("startup")
+def start_render_pool():
+    render_pool.start()
+
+
+@app.on_event("shutdown")
+def shutdown_render_pool():
+    render_pool.shutdown()
+
+
 # Set all CORS enabled origins
 if api_settings.cors_origins:
     app.add_middleware(
@@ -230,10 +283,15 @@ app.add_middleware(
     compression_level=6,
 )
 
+# Outside the compression middleware, so that ETags describe the body as
+# sent, and inside the cache control middleware, so that 304s get
+# Cache-Control too.
+app.add_middleware(ETagMiddleware)
+
 app.add_middleware(
     CacheControlMiddleware,
     cachecontrol=api_settings.cachecontrol,
-    exclude_path={r"/healthz"},
+    exclude_path={r"/healthz", r"/metrics"},
 )
 
 if api_settings.debug:
@@ -243,6 +301,13 @@ if api_settings.debug:
 if api_settings.lower_case_query_parameters:
     app.add_middleware(LowerCaseQueryStringMiddleware)
 
+if profiler_setting.directory:
+    app.add_middleware(ProfilerMiddleware)
+
+# Outermost, so that latency covers the other middlewares (and the
+# profiler's overhead) too.
+app.add_middleware(MetricsMiddleware)
+
 
 @app.get(
     "/healthz",
@@ -256,6 +321,32 @@ def ping():
     return {"ping": "pong!"}
 
 
+@app.get(
+    "/cache/stats",
+    description="Tile cache counters for this process.",
+    summary="Tile cache counters.",
+    operation_id="cacheStats",
+    tags=["Cache"],
+)
+def get_cache_stats():
+    """Tile cache hits, misses and evictions."""
+    stats = {
+        **cache_stats.as_dict(),
+        "short_circuits": dict(short_circuits),
+        "render_pool": render_pool.stats(),
+        "block_cache": block_cache.stats(),
+    }
+    if not api_settings.disable_cog:
+        stats["vector_layers"] = vector_layers.stats()
+    return stats
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics."""
+    return metrics_response()
+
+
 @app.get("/", response_class=HTMLResponse, include_in_schema=False)
 def landing(request: Request):
     """TiTiler landing page."""
@@ -328,6 +419,24 @@ def landing(request: Request):
         },
     )
 
+def preload():
+    """Load the state that is otherwise built on first use.
+
+    A multi-worker server calls this before forking its workers, so that
+    they share these pages copy-on-write instead of each building a copy.
+    """
+    for identifier in tms.supported_tms.list():
+        tms.supported_tms.get(identifier)
+
+    if not api_settings.disable_cog:
+        for name in default_cmap.list():
+            get_named_colormap(name)
+
+    # Registers the GDAL drivers; no dataset is opened before the fork.
+    with rasterio.Env():
+        pass
+
+
 if __name__ == '__main__':
     import uvicorn
     uvicorn.run(
@@ -0,0 +1,139 @@
+"""Metatiles.
+
+app/metatiles.py
+
+"""
+
+import concurrent.futures
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Tuple
+
+from morecantile import Tile, TileMatrixSet
+from rio_tiler.io import BaseReader
+from rio_tiler.models import ImageData
+
+from settings import cache_setting
+
+LOGGER = logging.getLogger(__name__)
+
+
+def metatile_tiles(
+    tms: TileMatrixSet, x: int, y: int, z: int, size: int
+) -> List[List[Tile]]:
+    """Return the rows of tiles in the `size` x `size` metatile containing x/y.
+
+    Metatiles are aligned on multiples of `size`, so every tile belongs to
+    exactly one of them.  Blocks at the edge of the tile matrix are cropped.
+    """
+    matrix = tms.matrix(z)
+    minx, miny = x - x % size, y - y % size
+    return [
+        [Tile(x=tx, y=ty, z=z) for tx in range(minx, min(minx + size, matrix.matrixWidth))]
+        for ty in range(miny, min(miny + size, matrix.matrixHeight))
+    ]
+
+
+def read_metatile(
+    src_dst: BaseReader,
+    x: int,
+    y: int,
+    z: int,
+    size: int,
+    tilesize: int = 256,
+    **kwargs: Any,
+) -> Dict[Tuple[int, int], ImageData]:
+    """Read the metatile containing x/y with one `part` call and split it.
+
+    Returns the tiles that intersect the dataset, keyed by (x, y).  Keyword
+    arguments are forwarded to `part`, as `Reader.tile` does.
+    """
+    tms = src_dst.tms
+    rows = metatile_tiles(tms, x, y, z, size)
+    exists = {
+        (tile.x, tile.y)
+        for row_tiles in rows
+        for tile in row_tiles
+        if src_dst.tile_exists(tile.x, tile.y, tile.z)
+    }
+    if not exists:
+        return {}
+
+    top_left = tms.xy_bounds(rows[0][0])
+    bottom_right = tms.xy_bounds(rows[-1][-1])
+
+    image = src_dst.part(
+        (top_left.left, bottom_right.bottom, bottom_right.right, top_left.top),
+        dst_crs=tms.rasterio_crs,
+        bounds_crs=tms.rasterio_crs,
+        height=len(rows) * tilesize,
+        width=len(rows[0]) * tilesize,
+        max_size=None,
+        **kwargs,
+    )
+
+    tiles = {}
+    for row, row_tiles in enumerate(rows):
+        for col, tile in enumerate(row_tiles):
+            if (tile.x, tile.y) not in exists:
+                continue
+            tiles[(tile.x, tile.y)] = ImageData(
+                image.array[
+                    :,
+                    row * tilesize:(row + 1) * tilesize,
+                    col * tilesize:(col + 1) * tilesize,
+                ],
+                assets=image.assets,
+                bounds=tms.xy_bounds(tile),
+                crs=image.crs,
+                metadata=image.metadata,
+                band_names=image.band_names,
+                dataset_statistics=image.dataset_statistics,
+            )
+    return tiles
+
+
+class MetatileRenderer:
+    """Run each metatile render once per process.
+
+    Requests for other tiles of a metatile that is being rendered wait for
+    that render instead of reading the same block again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, concurrent.futures.Future] = {}
+
+    def render(self, key: str, render: Callable[[], Dict]) -> Tuple[Dict, bool]:
+        """Return `render()` for `key` and whether this call rendered it.
+
+        Falls back to rendering independently if the render in flight takes
+        longer than `CACHE_LOCK_TIMEOUT`.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = concurrent.futures.Future()
+
+        if not leader:
+            try:
+                return future.result(timeout=cache_setting.lock_timeout), False
+            except concurrent.futures.TimeoutError:
+                LOGGER.warning("Timed out waiting for metatile %s", key)
+                return render(), True
+
+        try:
+            result = render()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+        return result, True
+
+
+metatile_renderer = MetatileRenderer()
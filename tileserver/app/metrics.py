@@ -0,0 +1,371 @@
+"""Prometheus metrics.
+
+app/metrics.py
+
+"""
+
+import ctypes
+import json
+import logging
+import os
+import re
+import time
+from typing import Dict, Optional
+
+import anyio.to_thread
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from blockcache import block_cache_stats
+from cache import cache_stats
+from readers import reader_pool
+from render import short_circuits
+from render_pool import render_pool
+
+LOGGER = logging.getLogger(__name__)
+
+# GDAL only records network statistics when asked to before its first read.
+os.environ.setdefault("CPL_VSIL_NETWORK_STATS_ENABLED", "YES")
+
+# Set by gunicorn.conf.py when several workers serve the app: metrics are
+# then kept in files in this directory and added up when scraped.
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+# Routes with their own series; everything else is counted as "other".
+ROUTE_PATTERN = re.compile(
+    r"^/cog/(?:"
+    r"(?P<tile>tiles/)"
+    r"|(?P<tilejson>[^/]+/tilejson\.json$)"
+    r"|(?P<info>info$)"
+    r"|(?P<statistics>statistics$)"
+    r"|(?P<point>point/)"
+    r")"
+    r"|^/vector/(?P<vector_tile>\d+/\d+/\d+\.mvt$)"
+)
+
+REQUEST_DURATION = Histogram(
+    "tileserver_request_duration_seconds",
+    "Request latency, from the first byte received to the last byte sent.",
+    ["route"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "tileserver_requests_in_flight",
+    "Requests being processed.",
+    ["route"],
+    multiprocess_mode="livesum",
+)
+RESPONSE_BYTES = Counter(
+    "tileserver_response_bytes",
+    "Response body bytes sent, by format.",
+    ["format"],
+)
+TILE_STAGE_DURATION = Histogram(
+    "tileserver_tile_stage_seconds",
+    "Time spent in each stage of rendering a tile, by zoom level. "
+    "Only recorded with TILE_STAGE_METRICS.",
+    ["stage", "zoom"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10),
+)
+THREADPOOL_BUSY = Gauge(
+    "tileserver_threadpool_busy_threads",
+    "Worker threads running sync routes and dependencies.",
+    multiprocess_mode="livesum",
+)
+THREADPOOL_WAITING = Gauge(
+    "tileserver_threadpool_queue_depth",
+    "Calls waiting for a worker thread.",
+    multiprocess_mode="livesum",
+)
+THREADPOOL_SIZE = Gauge(
+    "tileserver_threadpool_size",
+    "Maximum number of worker threads.",
+    multiprocess_mode="livesum",
+)
+
+
+def route_label(path: str) -> str:
+    match = ROUTE_PATTERN.match(path)
+    if match is None:
+        return "other"
+    return match.lastgroup
+
+
+def format_label(content_type: Optional[str]) -> str:
+    if not content_type:
+        return "none"
+    # e.g. "image/webp" -> "webp", "application/json" -> "json"
+    return content_type.split(";")[0].split("/")[-1].strip() or "none"
+
+
+def observe_tile_stages(timer, zoom: int):
+    """Record the stage durations of a `timings.StageTimer` for one tile."""
+    for stage, seconds in timer.durations.items():
+        TILE_STAGE_DURATION.labels(stage, str(zoom)).observe(seconds)
+
+
+class MetricsMiddleware:
+    """Record latency, in-flight requests and response bytes per request.
+
+    Routes are classified by path before routing so that the in-flight
+    gauge can be labelled; the work per request is a regex match and a few
+    metric updates.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = route_label(scope["path"])
+        in_flight = REQUESTS_IN_FLIGHT.labels(route)
+        response_format = "none"
+        sent = 0
+
+        async def send_wrapper(message: Message):
+            nonlocal response_format, sent
+            if message["type"] == "http.response.start":
+                for name, value in message.get("headers", ()):
+                    if name == b"content-type":
+                        response_format = format_label(value.decode("latin-1"))
+                        break
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        start = time.perf_counter()
+        in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_flight.dec()
+            REQUEST_DURATION.labels(route).observe(time.perf_counter() - start)
+            if sent:
+                RESPONSE_BYTES.labels(response_format).inc(sent)
+            if MULTIPROCESS:
+                _process_stats.update()
+
+
+class _GDALNetworkStats:
+    """Bytes and requests GDAL sent to remote files (/vsicurl/, /vsigs/...).
+
+    GDAL's statistics are read through its C API and then reset, since it
+    keeps a record per file; totals are accumulated here.
+    """
+
+    def __init__(self):
+        self.bytes: Dict[str, float] = {}
+        self.requests: Dict[tuple, float] = {}
+        self._lib = self._load()
+
+    @staticmethod
+    def _load():
+        # Use the libgdal rasterio has loaded rather than whichever one the
+        # dynamic linker would find.
+        import rasterio  # noqa: F401
+
+        try:
+            with open("/proc/self/maps") as f:
+                paths = [line.split()[-1] for line in f if "/libgdal" in line]
+            lib = ctypes.CDLL(paths[0])
+            lib.VSINetworkStatsGetAsSerializedJSON.restype = ctypes.c_void_p
+            lib.VSINetworkStatsGetAsSerializedJSON.argtypes = [ctypes.c_void_p]
+            lib.VSIFree.argtypes = [ctypes.c_void_p]
+            return lib
+        except (OSError, IndexError, AttributeError):
+            LOGGER.warning("GDAL network statistics are not available")
+            return None
+
+    def update(self):
+        if self._lib is None:
+            return
+
+        pointer = self._lib.VSINetworkStatsGetAsSerializedJSON(None)
+        self._lib.VSINetworkStatsReset()
+        if not pointer:
+            return
+        try:
+            stats = json.loads(ctypes.string_at(pointer).decode())
+        finally:
+            self._lib.VSIFree(pointer)
+
+        for handler, handler_stats in stats.get("handlers", {}).items():
+            for method, method_stats in handler_stats.get("methods", {}).items():
+                key = (handler, method)
+                self.requests[key] = self.requests.get(key, 0) + method_stats.get("count", 0)
+                self.bytes[handler] = self.bytes.get(handler, 0) + method_stats.get(
+                    "downloaded_bytes", 0
+                )
+
+
+class _StatsCollector:
+    """Expose the counters kept by the cache, reader pool and GDAL."""
+
+    def __init__(self):
+        self.network = _GDALNetworkStats()
+
+    def collect(self):
+        lookups = CounterMetricFamily(
+            "tileserver_cache_lookups", "Cache lookups, by tier.", labels=["tier"]
+        )
+        hits = CounterMetricFamily(
+            "tileserver_cache_hits", "Cache hits, by tier.", labels=["tier"]
+        )
+        for tier, count in cache_stats.lookups.items():
+            lookups.add_metric([tier], count)
+            hits.add_metric([tier], cache_stats.hits[tier])
+        yield lookups
+        yield hits
+        yield CounterMetricFamily(
+            "tileserver_cache_misses", "Requests not found in any cache tier.",
+            value=cache_stats.misses,
+        )
+        yield CounterMetricFamily(
+            "tileserver_cache_evictions", "Entries evicted from in-process caches.",
+            value=cache_stats.evictions,
+        )
+        yield CounterMetricFamily(
+            "tileserver_cache_coalesced", "Misses answered by another request's render.",
+            value=cache_stats.coalesced,
+        )
+
+        skipped = CounterMetricFamily(
+            "tileserver_tile_short_circuits",
+            "Tiles answered without rendering, by reason.",
+            labels=["reason"],
+        )
+        for reason, count in short_circuits.items():
+            skipped.add_metric([reason], count)
+        yield skipped
+
+        pool = reader_pool.stats()
+        yield GaugeMetricFamily(
+            "tileserver_readers_open", "Open dataset readers.", value=pool["open"]
+        )
+        for name in ("opened", "reused", "invalidated"):
+            yield CounterMetricFamily(
+                f"tileserver_readers_{name}", f"Dataset readers {name}.", value=pool[name]
+            )
+
+        renders = render_pool.stats()
+        yield GaugeMetricFamily(
+            "tileserver_render_slots", "Tile render slots (0 when unbounded).",
+            value=renders["slots"],
+        )
+        yield GaugeMetricFamily(
+            "tileserver_render_slots_in_use", "Tile renders holding a slot.",
+            value=renders["in_use"],
+        )
+        yield CounterMetricFamily(
+            "tileserver_render_rejected", "Tile requests rejected with a 503.",
+            value=renders["rejected"],
+        )
+
+        blocks = block_cache_stats
+        for name, description in (
+            ("hits", "Remote dataset blocks read from the block cache."),
+            ("misses", "Remote dataset blocks not in the block cache."),
+            ("fetches", "Range requests made by the block cache."),
+            ("fetched_bytes", "Bytes downloaded by the block cache."),
+            ("evictions", "Blocks evicted from the block cache."),
+        ):
+            yield CounterMetricFamily(
+                f"tileserver_block_cache_{name}", description, value=getattr(blocks, name)
+            )
+
+        self.network.update()
+        remote_bytes = CounterMetricFamily(
+            "tileserver_remote_read_bytes",
+            "Bytes downloaded by GDAL from remote datasets, by handler.",
+            labels=["handler"],
+        )
+        for handler, count in self.network.bytes.items():
+            remote_bytes.add_metric([handler], count)
+        yield remote_bytes
+
+        remote_requests = CounterMetricFamily(
+            "tileserver_remote_requests",
+            "HTTP requests made by GDAL to remote datasets.",
+            labels=["handler", "method"],
+        )
+        for (handler, method), count in self.network.requests.items():
+            remote_requests.add_metric([handler, method], count)
+        yield remote_requests
+
+
+class _ProcessStats:
+    """Copy a collector's values into gauges that add up across workers.
+
+    Custom collectors only see their own process, so in multiprocess mode
+    each worker writes its values, at most every `interval` seconds, to
+    "livesum" gauges of the same sample names.  Counters become gauges
+    there, and drop when a worker is replaced, like a counter reset.
+    """
+
+    def __init__(self, collector, interval: float = 1.0):
+        self.collector = collector
+        self.interval = interval
+        self._gauges: Dict[str, Gauge] = {}
+        self._updated = 0.0
+
+    def update(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._updated < self.interval:
+            return
+        self._updated = now
+
+        _update_threadpool()
+        for family in self.collector.collect():
+            for sample in family.samples:
+                gauge = self._gauges.get(sample.name)
+                if gauge is None:
+                    gauge = self._gauges[sample.name] = Gauge(
+                        sample.name,
+                        family.documentation,
+                        list(sample.labels),
+                        multiprocess_mode="livesum",
+                    )
+                if sample.labels:
+                    gauge = gauge.labels(**sample.labels)
+                gauge.set(sample.value)
+
+
+def _update_threadpool():
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    statistics = limiter.statistics()
+    THREADPOOL_BUSY.set(statistics.borrowed_tokens)
+    THREADPOOL_WAITING.set(statistics.tasks_waiting)
+    THREADPOOL_SIZE.set(limiter.total_tokens)
+
+
+if MULTIPROCESS:
+    _process_stats = _ProcessStats(_StatsCollector())
+else:
+    REGISTRY.register(_StatsCollector())
+
+
+def metrics_response() -> Response:
+    """Render all metrics; must be called from the event loop."""
+    if MULTIPROCESS:
+        _process_stats.update(force=True)
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        _update_threadpool()
+        registry = REGISTRY
+
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,246 @@
+"""Sampling profiler for slow requests.
+
+app/profiler.py
+
+"""
+
+import collections
+import datetime
+import inspect
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from typing import Dict, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from settings import profiler_setting
+
+LOGGER = logging.getLogger(__name__)
+
+# Deepest stack recorded for one sample.
+MAX_DEPTH = 128
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class _Profile:
+    """Samples collected for one request."""
+
+    def __init__(self, scope: Scope):
+        self.scope = scope
+        self.samples: collections.Counter = collections.Counter()
+        self._endpoint_code = None
+        self._urls = urllib.parse.parse_qs(
+            scope.get("query_string", b"").decode("latin-1")
+        ).get("url", [])
+
+    @property
+    def endpoint_code(self):
+        # The router sets the endpoint on the request's scope once matched.
+        if self._endpoint_code is None:
+            endpoint = self.scope.get("endpoint")
+            if endpoint is not None:
+                self._endpoint_code = getattr(inspect.unwrap(endpoint), "__code__", False)
+        return self._endpoint_code
+
+    def matches_locals(self, frame) -> bool:
+        """Whether an endpoint frame belongs to this request."""
+        values = frame.f_locals
+        request = values.get("request")
+        if request is not None:
+            return getattr(request, "scope", None) is self.scope
+        src_path = values.get("src_path")
+        if src_path is not None:
+            return src_path in self._urls
+        return True
+
+
+class Sampler:
+    """Sample the stacks of every thread while profiled requests run.
+
+    Each stack is attributed to the request it is working for: frames of
+    `ProfilerMiddleware.__call__` (on the event loop thread) carry the
+    request's scope, and frames of the matched endpoint (in threadpool
+    workers) are matched by endpoint and, if needed, by their `request` or
+    `src_path` argument.  Stacks that belong to no profiled request are
+    dropped.  The sampling thread only runs while a request is profiled.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._profiles: Dict[int, _Profile] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread: Optional[threading.Thread] = None
+        self._middleware_code = ProfilerMiddleware.__call__.__code__
+
+    def start(self, scope: Scope) -> _Profile:
+        profile = _Profile(scope)
+        with self._lock:
+            self._profiles[id(scope)] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="request-profiler", daemon=True
+                )
+                self._thread.start()
+            self._wakeup.notify()
+        return profile
+
+    def stop(self, profile: _Profile):
+        with self._lock:
+            self._profiles.pop(id(profile.scope), None)
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            with self._lock:
+                while not self._profiles:
+                    self._wakeup.wait()
+                profiles = list(self._profiles.values())
+
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if ident != own:
+                    self._sample(frame, profiles)
+            del frames, frame
+
+            time.sleep(self.interval)
+
+    def _sample(self, frame, profiles):
+        stack = []
+        owner = None
+        while frame is not None and len(stack) < MAX_DEPTH:
+            code = frame.f_code
+            if owner is None:
+                if code is self._middleware_code:
+                    scope = frame.f_locals.get("scope")
+                    owner = next((p for p in profiles if p.scope is scope), False)
+                else:
+                    candidates = [p for p in profiles if p.endpoint_code is code]
+                    if len(candidates) > 1:
+                        candidates = [p for p in candidates if p.matches_locals(frame)]
+                    if candidates:
+                        owner = candidates[0]
+            stack.append(_frame_name(code))
+            frame = frame.f_back
+
+        if owner:
+            owner.samples[";".join(reversed(stack))] += 1
+
+
+class ProfilerMiddleware:
+    """Profile slow or randomly sampled requests and write their profiles.
+
+    A request is profiled when it is picked by the 1-in-`PROFILE_SAMPLE_RATE`
+    sample, or, when `PROFILE_SLOW_THRESHOLD` is set, always, keeping only
+    the profiles of requests slower than the threshold.  Each profile is
+    written to `PROFILE_DIRECTORY` as folded stacks (`<name>.folded`, for
+    speedscope or flamegraph.pl) and request metadata (`<name>.json`).
+
+    With the defaults (a 1 s threshold and no random sample), every request
+    is profiled: a thread takes a stack sample every `PROFILE_INTERVAL`
+    while any request is in flight, and profiles of requests faster than
+    the threshold are discarded.  For a lower overhead, set
+    `PROFILE_SLOW_THRESHOLD=0` and `PROFILE_SAMPLE_RATE=N` to profile only
+    one request in N.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.directory = profiler_setting.directory
+        self.slow_threshold = profiler_setting.slow_threshold
+        self.sample_rate = profiler_setting.sample_rate
+        self.max_profiles = profiler_setting.max_profiles
+        self.sampler = Sampler(profiler_setting.interval)
+        os.makedirs(self.directory, exist_ok=True)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        sampled = self.sample_rate > 0 and random.randrange(self.sample_rate) == 0
+        if not sampled and not self.slow_threshold:
+            await self.app(scope, receive, send)
+            return
+
+        response = {}
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = {
+                    name.decode("latin-1"): value.decode("latin-1")
+                    for name, value in message.get("headers", ())
+                    if name in (b"content-type", b"server-timing", b"x-cache")
+                }
+            await send(message)
+
+        profile = self.sampler.start(scope)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - start
+            self.sampler.stop(profile)
+
+        slow = bool(self.slow_threshold) and duration >= self.slow_threshold
+        if (sampled or slow) and profile.samples:
+            reason = "slow" if slow else "sampled"
+            await run_in_threadpool(
+                self._write, profile, duration, reason, response
+            )
+
+    def _write(self, profile: _Profile, duration: float, reason: str, response: Dict):
+        scope = profile.scope
+        now = datetime.datetime.now(datetime.timezone.utc)
+        name = "{}-{}-{:.0f}ms".format(
+            now.strftime("%Y%m%dT%H%M%S.%f"),
+            scope["path"].strip("/").replace("/", "_")[:80] or "root",
+            duration * 1000,
+        )
+        metadata = {
+            "time": now.isoformat(),
+            "reason": reason,
+            "method": scope["method"],
+            "path": scope["path"],
+            "query": scope.get("query_string", b"").decode("latin-1"),
+            "duration_ms": round(duration * 1000, 1),
+            "status": response.get("status"),
+            "headers": response.get("headers", {}),
+            "interval_ms": self.sampler.interval * 1000,
+            "samples": sum(profile.samples.values()),
+        }
+
+        try:
+            with open(os.path.join(self.directory, f"{name}.folded"), "w") as f:
+                for stack, count in profile.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            with open(os.path.join(self.directory, f"{name}.json"), "w") as f:
+                json.dump(metadata, f, indent=2)
+            self._prune()
+        except OSError:
+            LOGGER.exception("Failed to write profile %s", name)
+
+    def _prune(self):
+        """Keep only the newest `max_profiles` profiles."""
+        profiles = sorted(
+            entry.name[: -len(".json")]
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith(".json")
+        )
+        for name in profiles[: max(len(profiles) - self.max_profiles, 0)]:
+            for suffix in (".json", ".folded"):
+                try:
+                    os.remove(os.path.join(self.directory, name + suffix))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,335 @@
+"""Reader pool.
+
+app/readers.py
+
+"""
+
+import collections
+import contextlib
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple, Type
+
+import httpx
+import rasterio
+from morecantile import TileMatrixSet
+from rio_tiler.constants import WEB_MERCATOR_TMS
+from rio_tiler.errors import RioTilerError
+from rio_tiler.io import BaseReader
+from rio_tiler.io.base import SpatialMixin
+
+from settings import reader_pool_setting
+
+LOGGER = logging.getLogger(__name__)
+
+# Number of datasets whose bounds are remembered after their readers close.
+FOOTPRINT_CACHE_SIZE = 4096
+
+# url -> (version, size, monotonic time it was checked)
+_versions: Dict[str, tuple] = {}
+_versions_lock = threading.Lock()
+
+# Shared so that version checks reuse connections and the SSL context.
+_http_client = httpx.Client(follow_redirects=True, timeout=5)
+
+
+def version_from_headers(headers: httpx.Headers) -> Optional[str]:
+    """Return the object version given by an HTTP response's headers."""
+    # Google Cloud Storage gives every object write a new generation number.
+    return (
+        headers.get("x-goog-generation")
+        or headers.get("etag")
+        or headers.get("last-modified")
+    )
+
+
+def _fetch_object_info(url: str) -> Optional[Tuple[Optional[str], Optional[int]]]:
+    """Return the version and size of an object, or None if the check failed."""
+    if not url.startswith(("http://", "https://")):
+        try:
+            stat = os.stat(url)
+        except OSError:
+            return None, None
+        return f"{stat.st_mtime_ns}-{stat.st_size}", stat.st_size
+
+    try:
+        response = _http_client.head(url)
+    except httpx.HTTPError:
+        LOGGER.warning(f"Could not check the version of {url}")
+        return None
+
+    if response.status_code == 429 or response.status_code >= 500:
+        LOGGER.warning(
+            f"Could not check the version of {url}: HTTP {response.status_code}"
+        )
+        return None
+    if response.status_code != 200:
+        return None, None
+
+    size = response.headers.get("content-length")
+    return version_from_headers(response.headers), size and int(size)
+
+
+def _object_info(url: str) -> Tuple[Optional[str], Optional[int]]:
+    now = time.monotonic()
+    with _versions_lock:
+        cached = _versions.get(url)
+    if cached is not None and now - cached[2] < reader_pool_setting.revalidate:
+        return cached[0], cached[1]
+
+    info = _fetch_object_info(url)
+    if info is None:
+        # A failed check keeps the last known version, so that pooled
+        # readers and versioned cache entries outlive a transient error.
+        info = cached[:2] if cached is not None else (None, None)
+    with _versions_lock:
+        _versions[url] = (*info, now)
+    return info
+
+
+def get_object_version(url: str) -> Optional[str]:
+    """Return an identifier that changes whenever the object at `url` does.
+
+    Versions are looked up with a HEAD request (or `os.stat` for local
+    files) at most once every `READER_POOL_REVALIDATE` seconds per URL.
+    If a check fails, the last known version is kept.  Returns None if the
+    version cannot be determined.
+    """
+    return _object_info(url)[0]
+
+
+def peek_object_version(url: str, fresh: bool = False) -> Optional[str]:
+    """Return the last version looked up for `url`, without checking it.
+
+    Never makes a request, so it is safe to call on the event loop.  With
+    `fresh`, versions older than `READER_POOL_REVALIDATE` are ignored.
+    Returns None if no version is known.
+    """
+    with _versions_lock:
+        cached = _versions.get(url)
+    if cached is None:
+        return None
+    if fresh and time.monotonic() - cached[2] >= reader_pool_setting.revalidate:
+        return None
+    return cached[0]
+
+
+def get_object_size(url: str) -> Optional[int]:
+    """Return the size in bytes of the object at `url`, looked up with its version."""
+    return _object_info(url)[1]
+
+
+class ReaderPool:
+    """Process-wide pool of open dataset readers.
+
+    Opening a reader over `/vsicurl/` fetches the COG header and IFDs, so
+    readers are kept open between requests and reused.  Each reader is
+    checked out by one thread at a time.  Idle readers are closed in
+    least-recently-used order once more than `max_open` are open, and all
+    readers for a dataset are dropped when its object version changes.
+
+    The bounds of every dataset opened are remembered (per object version)
+    so that `tile_exists` can answer without a reader.
+    """
+
+    def __init__(self, max_open: int):
+        self.max_open = max_open
+        self.open_count = 0
+        self.opened = 0
+        self.reused = 0
+        self.invalidated = 0
+        self._lock = threading.Lock()
+        # key -> (object version, [idle readers]), least recently used first
+        self._idle: collections.OrderedDict = collections.OrderedDict()
+        # (reader, src_path) -> (object version, crs, bounds)
+        self._footprints: collections.OrderedDict = collections.OrderedDict()
+
+    @staticmethod
+    def _key(
+        reader: Type[BaseReader],
+        src_path: str,
+        tms: TileMatrixSet,
+        options: Dict[str, Any],
+    ) -> str:
+        return "|".join(
+            [
+                f"{reader.__module__}.{reader.__name__}",
+                src_path,
+                tms.id,
+                repr(sorted(options.items())),
+            ]
+        )
+
+    def _evict(self):
+        """Pop idle readers until the pool is within its limit."""
+        evicted = []
+        while self.open_count > self.max_open and self._idle:
+            key, (version, readers) = next(iter(self._idle.items()))
+            evicted.append(readers.pop(0))
+            self.open_count -= 1
+            if not readers:
+                del self._idle[key]
+        return evicted
+
+    @staticmethod
+    def _close(readers):
+        for src_dst in readers:
+            try:
+                src_dst.close()
+            except Exception:
+                LOGGER.exception("Failed to close reader")
+
+    @contextlib.contextmanager
+    def reader(
+        self,
+        reader: Type[BaseReader],
+        src_path: str,
+        tms: TileMatrixSet,
+        env: Optional[Dict] = None,
+        **options: Any,
+    ):
+        """Check out an open reader for `src_path`, opening one if needed.
+
+        `env` is the GDAL environment of the request; readers opened under a
+        different environment are not shared.
+        """
+        key = self._key(reader, src_path, tms, {**options, **(env or {})})
+        version = get_object_version(src_path)
+
+        stale = []
+        src_dst = None
+        with self._lock:
+            entry = self._idle.get(key)
+            if entry is not None and entry[0] != version:
+                stale = entry[1]
+                self.open_count -= len(stale)
+                self.invalidated += len(stale)
+                del self._idle[key]
+            elif entry is not None and entry[1]:
+                src_dst = entry[1].pop()
+                self._idle.move_to_end(key)
+                self.reused += 1
+
+            if src_dst is None:
+                self.open_count += 1
+                self.opened += 1
+        self._close(stale)
+
+        if src_dst is None:
+            try:
+                src_dst = reader(src_path, tms=tms, **options)
+            except BaseException:
+                with self._lock:
+                    self.open_count -= 1
+                raise
+            self._remember_footprint(reader, src_path, version, src_dst)
+
+        try:
+            yield src_dst
+        except RioTilerError:
+            # Errors such as TileOutsideBounds leave the reader usable.
+            self._checkin(key, version, src_dst)
+            raise
+        except BaseException:
+            with self._lock:
+                self.open_count -= 1
+            self._close([src_dst])
+            raise
+        else:
+            self._checkin(key, version, src_dst)
+
+    def _checkin(self, key: str, version: Optional[str], src_dst: BaseReader):
+        with self._lock:
+            entry = self._idle.get(key)
+            if entry is not None and entry[0] != version:
+                # The object changed while this reader was checked out.
+                evicted = [src_dst]
+                self.open_count -= 1
+            else:
+                if entry is None:
+                    entry = self._idle[key] = (version, [])
+                entry[1].append(src_dst)
+                self._idle.move_to_end(key)
+                evicted = self._evict()
+        self._close(evicted)
+
+    def _remember_footprint(self, reader, src_path, version, src_dst):
+        key = (reader, src_path)
+        with self._lock:
+            self._footprints[key] = (version, src_dst.crs, src_dst.bounds)
+            self._footprints.move_to_end(key)
+            while len(self._footprints) > FOOTPRINT_CACHE_SIZE:
+                self._footprints.popitem(last=False)
+
+    def tile_exists(
+        self,
+        reader: Type[BaseReader],
+        src_path: str,
+        tms: TileMatrixSet,
+        x: int,
+        y: int,
+        z: int,
+    ) -> Optional[bool]:
+        """Whether a tile intersects the dataset, using its remembered bounds.
+
+        Returns None if the dataset has not been opened since it last changed.
+        """
+        key = (reader, src_path)
+        with self._lock:
+            entry = self._footprints.get(key)
+        if entry is None or entry[0] != get_object_version(src_path):
+            return None
+
+        footprint = SpatialMixin(tms=tms)
+        footprint.crs = entry[1]
+        footprint.bounds = entry[2]
+        return footprint.tile_exists(x, y, z)
+
+    def clear(self):
+        """Close every idle reader."""
+        with self._lock:
+            readers = [r for _, idle in self._idle.values() for r in idle]
+            self.open_count -= len(readers)
+            self._idle.clear()
+        self._close(readers)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "open": self.open_count,
+                "idle": sum(len(idle) for _, idle in self._idle.values()),
+                "opened": self.opened,
+                "reused": self.reused,
+                "invalidated": self.invalidated,
+            }
+
+
+class PooledReader:
+    """Stand-in for a reader class that checks readers out of a pool.
+
+    Called like the reader class, it returns a context manager yielding a
+    pooled reader, so routes written for the class (e.g. titiler's) use the
+    pool unchanged.  The GDAL environment active at the call is the `env`
+    of `ReaderPool.reader`.
+    """
+
+    def __init__(self, pool: ReaderPool, reader: Type[BaseReader]):
+        self.pool = pool
+        self.reader = reader
+
+    def __call__(
+        self, src_path: str, tms: TileMatrixSet = WEB_MERCATOR_TMS, **options: Any
+    ):
+        env = rasterio.env.getenv() if rasterio.env.hasenv() else None
+        return self.pool.reader(self.reader, src_path, tms, env, **options)
+
+    def tile_exists(
+        self, src_path: str, tms: TileMatrixSet, x: int, y: int, z: int
+    ) -> Optional[bool]:
+        """See `ReaderPool.tile_exists`."""
+        return self.pool.tile_exists(self.reader, src_path, tms, x, y, z)
+
+
+reader_pool = ReaderPool(max_open=reader_pool_setting.max_open)
@@ -0,0 +1,251 @@
+"""Rendering helpers.
+
+app/render.py
+
+"""
+
+import collections
+import functools
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy
+from rio_tiler.models import ImageData
+from rio_tiler.types import IntervalTuple
+from rio_tiler.utils import linear_rescale, render
+from titiler.core.resources.enums import ImageType
+from titiler.core.utils import render_image
+
+from cache import placeholder, register_placeholder
+
+# Integer types small enough to map every possible value through one table.
+LOOKUP_DTYPES = ("uint8", "int8", "uint16", "int16")
+
+# Formats that can encode a fully transparent tile.
+TRANSPARENT_FORMATS = (ImageType.png, ImageType.webp)
+
+# Tile requests answered without rendering, by reason: "outside_bounds" when
+# the tile misses the dataset's remembered bounds, "empty" when every pixel
+# read was nodata.
+short_circuits: collections.Counter = collections.Counter()
+
+
+@functools.lru_cache(maxsize=32)
+def _empty_tile(argument: str) -> bytes:
+    name, size = argument.split(":")
+    width, height = (int(v) for v in size.split("x"))
+    output_format = ImageType[name]
+    return render(
+        numpy.zeros((1, height, width), dtype="uint8"),
+        numpy.zeros((height, width), dtype="uint8"),
+        img_format=output_format.driver,
+        **output_format.profile,
+    )
+
+
+register_placeholder("empty", _empty_tile)
+
+
+def empty_tile(
+    width: int, height: int, output_format: Optional[ImageType] = None
+) -> Optional[Tuple[bytes, str]]:
+    """Return the cache placeholder and media type of a transparent tile.
+
+    Returns None if `output_format` cannot be transparent.  Without a format,
+    PNG is used, as `render_image` does for masked images.
+    """
+    output_format = output_format or ImageType.png
+    if output_format not in TRANSPARENT_FORMATS:
+        return None
+    return (
+        placeholder("empty", f"{output_format.name}:{width}x{height}"),
+        output_format.mediatype,
+    )
+
+
+def can_render_colormapped(image: ImageData, rescale, colormap) -> bool:
+    """Whether `render_colormapped` can render this image.
+
+    The image needs a single band, a rescale range and a colormap that
+    carries its lookup table (see `dependencies.ColorMapLUT`).
+    """
+    return (
+        image.count == 1
+        and bool(rescale)
+        and getattr(colormap, "lut", None) is not None
+    )
+
+
+def _rescale_to_uint8(values: numpy.ndarray, in_range: IntervalTuple) -> numpy.ndarray:
+    # Same casts as `ImageData.rescale`: the rescaled values are written back
+    # into the source dtype before being truncated to uint8.
+    rescaled = numpy.empty_like(values)
+    rescaled[...] = linear_rescale(values, in_range=in_range)
+    return rescaled.astype("uint8")
+
+
+@functools.lru_cache(maxsize=64)
+def _lookup_table(dtype: str, in_range: IntervalTuple, lut: bytes) -> numpy.ndarray:
+    """Build a (4, N + 1) RGBA table indexed by pixel value (or rescaled value).
+
+    For the integer types in `LOOKUP_DTYPES` the table covers every value of
+    the type, offset by its minimum, so rescaling and colormapping are one
+    lookup.  For other types it is indexed by the already rescaled uint8
+    value.  The extra last column is the transparent entry for masked pixels.
+    """
+    colors = numpy.frombuffer(lut, dtype="uint8").reshape(256, 4)
+
+    # Masked pixels are rescaled to 0 and made transparent by the mask.
+    nodata = numpy.append(colors[0, :3], 0).astype("uint8")
+
+    if dtype in LOOKUP_DTYPES:
+        info = numpy.iinfo(dtype)
+        values = numpy.arange(info.min, int(info.max) + 1).astype(dtype)
+        colors = colors[_rescale_to_uint8(values, in_range)]
+
+    table = numpy.vstack([colors, nodata]).T.copy()
+    table.flags.writeable = False
+    return table
+
+
+def apply_rescaled_colormap(
+    image: ImageData, in_range: IntervalTuple, colormap
+) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """Return the RGB data and alpha mask of a rescaled, colormapped band.
+
+    The rescale, colormap and mask are applied with a single gather from a
+    cached lookup table instead of separate passes over the array.
+    """
+    band = image.array[0]
+    data = band.data
+    masked = numpy.ma.getmaskarray(band)
+    table = _lookup_table(
+        str(data.dtype), tuple(in_range), colormap.lut.tobytes()
+    )
+
+    if str(data.dtype) in LOOKUP_DTYPES:
+        index = data.astype("int32")
+        if numpy.iinfo(data.dtype).min:
+            index -= numpy.iinfo(data.dtype).min
+    else:
+        index = _rescale_to_uint8(data, in_range).astype("int32")
+    index[masked] = table.shape[1] - 1
+
+    rgba = table[:, index]
+    return rgba[:3], rgba[3]
+
+
+def encode_image(
+    image: ImageData,
+    data: numpy.ndarray,
+    mask: numpy.ndarray,
+    output_format: Optional[ImageType] = None,
+    add_mask: bool = True,
+    **kwargs,
+) -> Tuple[bytes, str]:
+    """Encode RGB(A) `data` and `mask` computed from `image`.
+
+    Follows `titiler.core.utils.render_image` in choosing the format and
+    georeferencing GeoTIFF output.
+    """
+    if not output_format:
+        output_format = ImageType.jpeg if mask.all() else ImageType.png
+
+    creation_options = {**kwargs, **output_format.profile}
+    if output_format == ImageType.tif:
+        if "transform" not in creation_options:
+            creation_options.update({"transform": image.transform})
+        if "crs" not in creation_options and image.crs:
+            creation_options.update({"crs": image.crs})
+
+    if not add_mask:
+        mask = None
+
+    return (
+        render(
+            data,
+            mask,
+            img_format=output_format.driver,
+            **creation_options,
+        ),
+        output_format.mediatype,
+    )
+
+
+def render_colormapped(
+    image: ImageData,
+    in_range: IntervalTuple,
+    colormap,
+    output_format: Optional[ImageType] = None,
+    add_mask: bool = True,
+    **kwargs,
+) -> Tuple[bytes, str]:
+    """Rescale, colormap and encode a single band image.
+
+    Produces the same output as ``image.rescale((in_range,))`` followed by
+    ``titiler.core.utils.render_image(image, colormap=colormap, ...)``.
+    """
+    data, mask = apply_rescaled_colormap(image, in_range, colormap)
+    return encode_image(
+        image, data, mask, output_format=output_format, add_mask=add_mask, **kwargs
+    )
+
+
+def render_tile(
+    image: ImageData,
+    output_format: Optional[ImageType] = None,
+    post_process=None,
+    rescale=None,
+    color_formula: Optional[str] = None,
+    colormap=None,
+    dst_colormap=None,
+    render_params: Optional[Dict] = None,
+) -> Tuple[bytes, str, Dict[str, float]]:
+    """Post process, rescale, colormap and encode a tile image.
+
+    This is the CPU bound part of the tile endpoint.  It only takes picklable
+    arguments, so that it can run in a `render_pool` worker process, and
+    returns the content, media type and the seconds spent in the "process"
+    and "encode" stages.  Fully masked images give the `empty_tile`
+    placeholder when the format can be transparent.
+    """
+    render_params = render_params or {}
+    durations = {}
+
+    start = time.perf_counter()
+    if post_process:
+        image = post_process(image)
+
+    if render_params.get("add_mask") is not False and image.array.mask.all():
+        empty = empty_tile(image.width, image.height, output_format)
+        if empty:
+            durations["process"] = time.perf_counter() - start
+            return (*empty, durations)
+
+    # Fast path for single band tiles, e.g. the CKAN map preview.
+    fused = not color_formula and can_render_colormapped(image, rescale, colormap)
+    if fused:
+        data, mask = apply_rescaled_colormap(image, rescale[0], colormap)
+    else:
+        if rescale:
+            image.rescale(rescale)
+
+        if color_formula:
+            image.apply_color_formula(color_formula)
+
+    encode_start = time.perf_counter()
+    durations["process"] = encode_start - start
+
+    if fused:
+        content, media_type = encode_image(
+            image, data, mask, output_format=output_format, **render_params
+        )
+    else:
+        content, media_type = render_image(
+            image,
+            output_format=output_format,
+            colormap=colormap or dst_colormap,
+            **render_params,
+        )
+    durations["encode"] = time.perf_counter() - encode_start
+    return content, media_type, durations
@@ -0,0 +1,174 @@
+"""Tile rendering backends.
+
+app/render_pool.py
+
+"""
+
+import concurrent.futures
+import contextlib
+import logging
+import multiprocessing
+import sys
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Optional
+
+from settings import tile_setting
+
+LOGGER = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def _worker_main():
+    """Spawn processes with `render_worker` as their main module.
+
+    A spawned process first imports its parent's main module; this keeps
+    that to the render functions.
+    """
+    import render_worker
+
+    main = sys.modules["__main__"]
+    sys.modules["__main__"] = render_worker
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = main
+
+
+class RenderQueueFull(Exception):
+    """Raised when every render slot is taken; answered with a 503."""
+
+
+class RenderPool:
+    """Run the CPU bound stages of tile rendering, in threads or processes.
+
+    With the "thread" backend, work runs inline in the request's threadpool
+    worker and admission is unbounded, as before.  With the "process" backend
+    it runs in a pool of `processes` worker processes, so that rescaling,
+    colormapping and encoding are not serialised by the GIL, while reads and
+    warps stay in threads (GDAL releases the GIL).
+
+    With the process backend, admission is bounded: a tile render takes one
+    of `processes + queue_size` slots, and is rejected with `RenderQueueFull`
+    when none is free rather than queueing without limit.  `admit` is meant
+    to be entered on the event loop (see `cache.cached`'s `admit`), before
+    the request waits for a threadpool thread.
+    """
+
+    def __init__(self, backend: str, processes: int, queue_size: int):
+        if backend not in ("thread", "process"):
+            raise ValueError(f"Unknown render backend {backend!r}")
+        self.backend = backend
+        self.processes = max(processes, 1)
+        self.queue_size = queue_size
+        self.slots = self.processes + queue_size
+        self.in_use = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        # Held while the executor is created, which takes its processes'
+        # startup time; `admit` doesn't wait on it.
+        self._executor_lock = threading.Lock()
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+    @property
+    def bounded(self) -> bool:
+        return self.backend == "process"
+
+    @contextlib.contextmanager
+    def admit(self):
+        """Hold a render slot, or raise `RenderQueueFull` if none is free."""
+        if not self.bounded:
+            yield
+            return
+
+        with self._lock:
+            if self.in_use >= self.slots:
+                self.rejected += 1
+                raise RenderQueueFull()
+            self.in_use += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_use -= 1
+
+    def submit(self, fn: Callable, *args, **kwargs) -> concurrent.futures.Future:
+        """Run `fn(*args, **kwargs)` on the backend and return its future.
+
+        `fn` and its arguments must be picklable with the process backend.
+        """
+        if self.backend == "thread":
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            return future
+
+        executor = self._get_executor()
+        try:
+            return executor.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a new pool.
+            LOGGER.warning("Render pool is broken, restarting it")
+            self._reset(executor)
+            return self._get_executor().submit(fn, *args, **kwargs)
+
+    def run(self, fn: Callable, *args, **kwargs):
+        """Run `fn(*args, **kwargs)` on the backend and return its result."""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def start(self):
+        """Start the worker processes, rather than on the first tile."""
+        if self.backend == "process":
+            self._get_executor()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "slots": self.slots if self.bounded else 0,
+            "in_use": self.in_use,
+            "rejected": self.rejected,
+        }
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                # Not forked: the server's threads may hold GDAL or
+                # allocator locks.
+                executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                # Processes are spawned as tasks are submitted; one task
+                # per worker spawns them all, and once they are idle no
+                # later task spawns another.
+                import render_worker
+
+                with _worker_main():
+                    futures = [
+                        executor.submit(render_worker.ready)
+                        for _ in range(self.processes)
+                    ]
+                for future in futures:
+                    future.result()
+                self._executor = executor
+            return self._executor
+
+    def _reset(self, executor: concurrent.futures.ProcessPoolExecutor):
+        with self._executor_lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def shutdown(self):
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+render_pool = RenderPool(
+    tile_setting.render_backend,
+    tile_setting.render_processes,
+    tile_setting.render_queue_size,
+)
@@ -0,0 +1,16 @@
+"""Render worker entry module.
+
+app/render_worker.py
+
+Render worker processes are spawned with this module as their main module,
+so that they import only what rendering needs rather than re-running the
+server's main module (which builds the whole app).
+
+"""
+
+import render  # noqa: F401
+
+
+def ready() -> bool:
+    """Return once the worker has imported the render functions."""
+    return True
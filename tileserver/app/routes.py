@@ -1,4 +1,8 @@
-from typing import Callable, Dict, Type, Literal, List, Tuple, Optional
+import contextlib
+import functools
+import inspect
+import time
+from typing import Callable, Dict, Type, Literal, Tuple, Optional
 from urllib.parse import urlencode
 
 from attrs import define
@@ -6,22 +10,127 @@ from titiler.core.factory import TilerFactory as TiTilerFactory
 from titiler.core.factory import img_endpoint_params
 from titiler.core.resources.enums import ImageType
 from titiler.core.models.mapbox import TileJSON
-from titiler.core.utils import render_image
+from rio_tiler.errors import TileOutsideBounds
 from rio_tiler.io import BaseReader, Reader
-from fastapi import Depends, Path, Query
-from pydantic import Field
+from fastapi import Depends, HTTPException, Path, Query
+from pydantic import Field, TypeAdapter
 from starlette.requests import Request
 from starlette.responses import Response
 import rasterio
 from typing_extensions import Annotated
 
-from cache import cached
+from approximate import DEFAULT_MAX_PIXELS, approximate_statistics
+from cache import cached, expand_placeholder, is_placeholder, path_cache_key
+from metatiles import metatile_renderer, read_metatile
+from metrics import observe_tile_stages
+from readers import PooledReader, reader_pool
+from render import empty_tile, short_circuits
+from render import render_tile as render_image_tile
+from render_pool import render_pool
+from settings import cache_setting, tile_setting
+from timings import StageTimer
+
+# Query parameters added to titiler's GET /statistics.
+APPROXIMATE_PARAMETERS = [
+    inspect.Parameter(
+        "approximate",
+        inspect.Parameter.KEYWORD_ONLY,
+        default=None,
+        annotation=Annotated[
+            Optional[Literal["auto", "overview", "sample"]],
+            Query(
+                description="Compute the statistics from an overview or a sample of the dataset's blocks instead of a preview.  `auto` uses an overview if one has at most `max_pixels` pixels.  Results include the method used and standard errors.  Can't be combined with `expression`, `algorithm` or the preview size (`max_size`, `height`, `width`).",
+            ),
+        ],
+    ),
+    inspect.Parameter(
+        "overview_level",
+        inspect.Parameter.KEYWORD_ONLY,
+        default=None,
+        annotation=Annotated[
+            Optional[int],
+            Query(ge=0, description="Overview level read by `approximate=overview`."),
+        ],
+    ),
+    inspect.Parameter(
+        "max_pixels",
+        inspect.Parameter.KEYWORD_ONLY,
+        default=DEFAULT_MAX_PIXELS,
+        annotation=Annotated[
+            int,
+            Query(gt=0, description="Pixels per band read by approximate statistics."),
+        ],
+    ),
+]
+
+
+def cached_endpoint(endpoint: Callable, route: Dict, **cache_kwargs) -> Callable:
+    """Wrap a titiler `endpoint`, registered with the arguments `route`, in `cached`.
+
+    The endpoint's result is encoded with the route's response model, so
+    that the document can be cached as bytes.  The wrapper also takes the
+    request, for the cache key.
+    """
+    adapter = TypeAdapter(route["response_model"])
+    exclude_none = route.get("response_model_exclude_none", False)
+    media_type = route["response_class"].media_type
+    signature = inspect.signature(endpoint)
+    takes_request = "request" in signature.parameters
+
+    @functools.wraps(endpoint)
+    def wrapper(*, request: Request, **kwargs):
+        if takes_request:
+            kwargs["request"] = request
+        result = endpoint(**kwargs)
+        if isinstance(result, Response):
+            return result
+        return Response(
+            adapter.dump_json(result, exclude_none=exclude_none),
+            media_type=media_type,
+        )
+
+    if not takes_request:
+        request = inspect.Parameter(
+            "request", inspect.Parameter.KEYWORD_ONLY, annotation=Request
+        )
+        wrapper.__signature__ = signature.replace(
+            parameters=[*signature.parameters.values(), request]
+        )
+    return cached(**cache_kwargs)(wrapper)
+
 
 @define(kw_only=True)
 class TilerFactory(TiTilerFactory):
 
     reader: Type[BaseReader] = Reader
 
+    def __attrs_post_init__(self):
+        # Every route, titiler's included, checks readers out of the pool.
+        self.reader = PooledReader(reader_pool, self.reader)
+        super().__attrs_post_init__()
+
+    @contextlib.contextmanager
+    def wrap_endpoints(self, wrappers: Dict[Tuple[str, str], Callable]):
+        """Wrap the endpoints registered meanwhile, e.g. by titiler.
+
+        `wrappers` maps a method and path to a function of the endpoint and
+        its route arguments, returning the endpoint to register instead.
+        """
+        add_api_route = self.router.add_api_route
+
+        def add_wrapped_api_route(path, endpoint, **kwargs):
+            for method in kwargs.get("methods") or ():
+                wrapper = wrappers.get((method, path))
+                if wrapper is not None:
+                    endpoint = wrapper(endpoint, kwargs)
+            return add_api_route(path, endpoint, **kwargs)
+
+        self.router.add_api_route = add_wrapped_api_route
+        try:
+            yield
+        finally:
+            del self.router.add_api_route
+
     def register_routes(self):
         @self.router.get(r"/tiles/{tileMatrixSetId}/{z}/{x}/{y}", **img_endpoint_params)
         @self.router.get(
@@ -34,8 +143,9 @@ class TilerFactory(TiTilerFactory):
             r"/tiles/{tileMatrixSetId}/{z}/{x}/{y}@{scale}x.{format}",
             **img_endpoint_params,
         )
-        #@cached(alias="default")
+        @cached(alias="default", versioned=True, admit=render_pool.admit)
         def tile(
+            request: Request,
             z: Annotated[
                 int,
                 Path(
@@ -83,39 +193,142 @@ class TilerFactory(TiTilerFactory):
             env=Depends(self.environment_dependency),
         ):
             """Create map tile from a dataset."""
+            timer = StageTimer()
             tms = self.supported_tms.get(tileMatrixSetId)
-            with rasterio.Env(**env):
-                with self.reader(
-                    src_path, tms=tms, **reader_params.as_dict()
-                ) as src_dst:
-                    image = src_dst.tile(
-                        x,
-                        y,
-                        z,
-                        tilesize=scale * 256,
-                        **tile_params.as_dict(),
-                        **layer_params.as_dict(),
-                        **dataset_params.as_dict(),
+            tilesize = scale * 256
+            # Transparent tiles are only possible when the mask is kept.
+            transparent = render_params.add_mask is not False
+
+            def tile_response(content, media_type):
+                body = expand_placeholder(content)
+                response = Response(body, media_type=media_type)
+                if body is not content:
+                    # Cache the placeholder rather than the image.
+                    response.cache_content = content
+                return response
+
+            def outside_bounds():
+                size = int(tilesize + 2 * (tile_params.buffer or 0))
+                empty = transparent and empty_tile(size, size, format)
+                if not empty:
+                    raise TileOutsideBounds(
+                        f"Tile(x={x}, y={y}, z={z}) is outside bounds"
                     )
-                    dst_colormap = getattr(src_dst, "colormap", None)
+                return tile_response(*empty)
+
+            @contextlib.contextmanager
+            def open_reader():
+                with rasterio.Env(**env), contextlib.ExitStack() as stack:
+                    with timer.stage("open"):
+                        src_dst = stack.enter_context(
+                            self.reader(src_path, tms=tms, **reader_params.as_dict())
+                        )
+                    yield src_dst
 
-            if post_process:
-                image = post_process(image)
+            def render(images, dst_colormap):
+                """Render `images` (a dict of tile images) on the render pool."""
+                futures = {
+                    key: render_pool.submit(
+                        render_image_tile,
+                        image,
+                        output_format=format,
+                        post_process=post_process,
+                        rescale=rescale,
+                        color_formula=color_formula,
+                        colormap=colormap,
+                        dst_colormap=dst_colormap,
+                        render_params=render_params.as_dict(),
+                    )
+                    for key, image in images.items()
+                }
 
-            if rescale:
-                image.rescale(rescale)
+                rendered = {}
+                for key, future in futures.items():
+                    content, media_type, durations = future.result()
+                    for stage, seconds in durations.items():
+                        timer.add(stage, seconds)
+                    # `render_tile` only returns placeholders for empty tiles.
+                    if is_placeholder(content):
+                        short_circuits["empty"] += 1
+                    rendered[key] = (content, media_type)
+                return rendered
 
-            if color_formula:
-                image.apply_color_formula(color_formula)
+            def render_tile():
+                if self.reader.tile_exists(src_path, tms, x, y, z) is False:
+                    short_circuits["outside_bounds"] += 1
+                    return outside_bounds()
 
-            content, media_type = render_image(
-                image,
-                output_format=format,
-                colormap=colormap or dst_colormap,
-                **render_params.as_dict(),
-            )
+                metatile_size = tile_setting.metatile_size(z)
+                if metatile_size > 1 and not tile_params.buffer:
+                    # Render the whole block of tiles around this one from a
+                    # single read and hand the other tiles to the cache.
+                    def tile_path(tile_x, tile_y):
+                        path_params = {**request.path_params, "x": tile_x, "y": tile_y}
+                        return request.url_for("tile", **path_params).path
+
+                    def render_metatile():
+                        with open_reader() as src_dst:
+                            with timer.stage("read"):
+                                images = read_metatile(
+                                    src_dst,
+                                    x,
+                                    y,
+                                    z,
+                                    metatile_size,
+                                    tilesize=tilesize,
+                                    **tile_params.as_dict(),
+                                    **layer_params.as_dict(),
+                                    **dataset_params.as_dict(),
+                                )
+                            dst_colormap = getattr(src_dst, "colormap", None)
+
+                        return render(images, dst_colormap)
+
+                    timer.describe("read", f"metatile {metatile_size}x{metatile_size}")
+                    origin = tile_path(x - x % metatile_size, y - y % metatile_size)
+                    wait_start = time.perf_counter()
+                    tiles, rendered = metatile_renderer.render(
+                        f"{metatile_size}:{path_cache_key(tile, request, origin)}",
+                        render_metatile,
+                    )
+                    if not rendered:
+                        timer.add("wait", time.perf_counter() - wait_start)
+
+                    if (x, y) not in tiles:
+                        return outside_bounds()
+
+                    response = tile_response(*tiles[(x, y)])
+                    if rendered:
+                        response.related = {
+                            tile_path(*tile_xy): value
+                            for tile_xy, value in tiles.items()
+                            if tile_xy != (x, y)
+                        }
+                    return response
+
+                with open_reader() as src_dst:
+                    if not src_dst.tile_exists(x, y, z):
+                        return outside_bounds()
 
-            return Response(content, media_type=media_type)
+                    with timer.stage("read"):
+                        image = src_dst.tile(
+                            x,
+                            y,
+                            z,
+                            tilesize=tilesize,
+                            **tile_params.as_dict(),
+                            **layer_params.as_dict(),
+                            **dataset_params.as_dict(),
+                        )
+                    dst_colormap = getattr(src_dst, "colormap", None)
+
+                return tile_response(*render({(x, y): image}, dst_colormap)[(x, y)])
+
+            response = render_tile()
+            response.headers["Server-Timing"] = timer.server_timing()
+            if tile_setting.stage_metrics:
+                observe_tile_stages(timer, z)
+            return response
         
         @self.router.get(
             "/{tileMatrixSetId}/tilejson.json",
@@ -123,7 +336,7 @@ class TilerFactory(TiTilerFactory):
             responses={200: {"description": "Return a tilejson"}},
             response_model_exclude_none=True,
         )
-        #@cached(alias="default")
+        @cached(alias="default", versioned=True)
         def tilejson(
             request: Request,
             tileMatrixSetId: Annotated[
@@ -196,16 +409,22 @@ class TilerFactory(TiTilerFactory):
                 with self.reader(
                     src_path, tms=tms, **reader_params.as_dict()
                 ) as src_dst:
-                    return {
-                        "bounds": src_dst.get_geographic_bounds(
+                    tilejson = TileJSON(
+                        bounds=src_dst.get_geographic_bounds(
                             tms.rasterio_geographic_crs
                         ),
-                        "minzoom": minzoom if minzoom is not None else src_dst.minzoom,
-                        "maxzoom": maxzoom if maxzoom is not None else src_dst.maxzoom,
-                        "tiles": [tiles_url],
-                    }
+                        minzoom=minzoom if minzoom is not None else src_dst.minzoom,
+                        maxzoom=maxzoom if maxzoom is not None else src_dst.maxzoom,
+                        tiles=[tiles_url],
+                    )
+
+            # Return encoded JSON so that the document can be cached as bytes.
+            return Response(
+                tilejson.model_dump_json(exclude_none=True),
+                media_type="application/json",
+            )
                 
-        # Register all other routes.  These are copied from the original TilerFactory class.
+        # Register all other routes from the original TilerFactory class.
         self.bounds()
         self.info()  # Used by our CKAN instance
         self.statistics()  # used by our CKAN instance
@@ -220,4 +439,100 @@ class TilerFactory(TiTilerFactory):
             self.preview()
 
         if self.add_part:
-            self.part()
\ No newline at end of file
+            self.part()
+
+
+    def info(self):
+        """Register /info endpoints.
+
+        GET /info is cached per dataset object version.
+        """
+        cache = functools.partial(
+            cached_endpoint,
+            alias="default",
+            ttl=cache_setting.metadata_ttl,
+            versioned=True,
+        )
+        with self.wrap_endpoints({("GET", "/info"): cache}):
+            super().info()
+
+    def statistics(self):
+        """Register /statistics endpoints.
+
+        GET /statistics also computes approximate statistics, and is cached
+        per dataset object version.
+        """
+
+        def approximate_and_cache(endpoint, route):
+            endpoint = self.approximate_statistics_endpoint(endpoint)
+            return cached_endpoint(
+                endpoint,
+                route,
+                alias="default",
+                ttl=cache_setting.metadata_ttl,
+                versioned=True,
+            )
+
+        with self.wrap_endpoints({("GET", "/statistics"): approximate_and_cache}):
+            super().statistics()
+
+    def approximate_statistics_endpoint(self, endpoint: Callable) -> Callable:
+        """Add the `APPROXIMATE_PARAMETERS` to titiler's GET /statistics `endpoint`."""
+
+        @functools.wraps(endpoint)
+        def statistics(
+            *,
+            approximate=None,
+            overview_level=None,
+            max_pixels=DEFAULT_MAX_PIXELS,
+            **kwargs,
+        ):
+            if not approximate:
+                return endpoint(**kwargs)
+
+            # The blocks are read with `rio_tiler.reader.read`, and sized by
+            # `max_pixels` rather than as a preview.
+            preview = kwargs["image_params"]
+            default_max_size = self.img_preview_dependency().max_size
+            unsupported = [
+                name
+                for name, value in (
+                    ("expression", kwargs["layer_params"].expression),
+                    ("algorithm", kwargs["post_process"]),
+                    ("max_size", preview.max_size not in (None, default_max_size)),
+                    ("height", preview.height),
+                    ("width", preview.width),
+                )
+                if value
+            ]
+            if unsupported:
+                raise HTTPException(
+                    status_code=400,
+                    detail="`approximate` can't be combined with {}".format(
+                        ", ".join(f"`{name}`" for name in unsupported)
+                    ),
+                )
+
+            with rasterio.Env(**kwargs["env"]):
+                with self.reader(
+                    kwargs["src_path"], **kwargs["reader_params"].as_dict()
+                ) as src_dst:
+                    try:
+                        return approximate_statistics(
+                            src_dst,
+                            method=approximate,
+                            overview_level=overview_level,
+                            max_pixels=max_pixels,
+                            **kwargs["stats_params"].as_dict(),
+                            hist_options=kwargs["histogram_params"].as_dict(),
+                            **kwargs["layer_params"].as_dict(),
+                            **kwargs["dataset_params"].as_dict(),
+                        )
+                    except ValueError as e:
+                        raise HTTPException(status_code=400, detail=str(e))
+
+        signature = inspect.signature(endpoint)
+        statistics.__signature__ = signature.replace(
+            parameters=[*signature.parameters.values(), *APPROXIMATE_PARAMETERS]
+        )
+        return statistics
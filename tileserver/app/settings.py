@@ -12,9 +12,23 @@ from typing import Optional
 class CacheSettings(BaseSettings):
     """Cache settings"""
 
+    # redis://, memcached:// or sqlite:///path/to/file.db (a local file that
+    # all workers of an instance share); empty for an in-process cache.
     endpoint: Optional[str] = os.environ.get('CACHE_ENDPOINT', '')
     ttl: int = int(os.environ.get('CACHE_TTL', 3600))
+    # TTL of /info and /statistics responses, which are cached per dataset
+    # object version and so never go stale.
+    metadata_ttl: int = int(os.environ.get('CACHE_METADATA_TTL', 7 * 24 * 3600))
     namespace: str = os.environ.get('CACHE_NAMESPACE', '')
+    # Upper bound, in bytes, on the content held by the in-process or SQLite
+    # cache (`max_size` in a sqlite:// endpoint's query overrides it).
+    max_size: int = int(os.environ.get('CACHE_MAX_SIZE', 256 * 1024 * 1024))
+    # In-process tier in front of CACHE_ENDPOINT; a size of 0 disables it.
+    # Its TTL is kept short since promoted entries restart their TTL.
+    local_max_size: int = int(os.environ.get('CACHE_LOCAL_MAX_SIZE', 32 * 1024 * 1024))
+    local_ttl: int = int(os.environ.get('CACHE_LOCAL_TTL', 300))
+    # Seconds a request waits on another request rendering the same tile.
+    lock_timeout: int = int(os.environ.get('CACHE_LOCK_TIMEOUT', 30))
 
     class Config:
         """model config"""
@@ -23,4 +37,163 @@ class CacheSettings(BaseSettings):
         env_prefix = "CACHE_"
 
 
-cache_setting = CacheSettings()
\ No newline at end of file
+cache_setting = CacheSettings()
+
+class ReaderPoolSettings(BaseSettings):
+    """Open dataset reader pool settings"""
+
+    # Maximum number of readers kept open across all datasets.
+    max_open: int = int(os.environ.get('READER_POOL_MAX_OPEN', 64))
+    # Seconds between checks that a pooled dataset has not changed.
+    revalidate: int = int(os.environ.get('READER_POOL_REVALIDATE', 60))
+
+    class Config:
+        """model config"""
+
+        env_file = ".env"
+        env_prefix = "READER_POOL_"
+
+
+reader_pool_setting = ReaderPoolSettings()
+
+class BlockCacheSettings(BaseSettings):
+    """Shared on-disk cache of remote dataset byte ranges"""
+
+    # Directory of the cache, shared by all workers of an instance; empty
+    # (the default) reads remote datasets through GDAL's /vsicurl/ instead.
+    directory: str = os.environ.get('BLOCK_CACHE_DIRECTORY', '')
+    # Upper bound, in bytes, on the blocks kept in the directory.
+    max_size: int = int(os.environ.get('BLOCK_CACHE_MAX_SIZE', 4 * 1024 * 1024 * 1024))
+    # Size of the aligned blocks remote datasets are read and cached in.
+    block_size: int = int(os.environ.get('BLOCK_CACHE_BLOCK_SIZE', 256 * 1024))
+    # Blocks each process keeps memory-mapped.
+    max_mapped: int = int(os.environ.get('BLOCK_CACHE_MAX_MAPPED', 1024))
+
+    class Config:
+        """model config"""
+
+        env_file = ".env"
+        env_prefix = "BLOCK_CACHE_"
+
+
+block_cache_setting = BlockCacheSettings()
+
+class VectorTileSettings(BaseSettings):
+    """GeoJSON vector tile settings"""
+
+    # GeoJSON layers kept loaded and indexed, least recently used dropped first.
+    max_layers: int = int(os.environ.get('VECTOR_MAX_LAYERS', 8))
+    # Largest GeoJSON file, in bytes, that is loaded.
+    max_size: int = int(os.environ.get('VECTOR_MAX_SIZE', 256 * 1024 * 1024))
+    # Tile coordinate extent, and the buffer around tiles, in its units.
+    extent: int = int(os.environ.get('VECTOR_EXTENT', 4096))
+    buffer: int = int(os.environ.get('VECTOR_BUFFER', 64))
+    # Simplification tolerance, in tile coordinate units.
+    simplify: float = float(os.environ.get('VECTOR_SIMPLIFY', 8))
+    # Zoom above which geometries are no longer simplified.
+    simplify_maxzoom: int = int(os.environ.get('VECTOR_SIMPLIFY_MAXZOOM', 14))
+    # Zooms whose simplified geometries are kept per layer, each a copy of
+    # the layer; least recently used dropped first.
+    simplified_zooms: int = int(os.environ.get('VECTOR_SIMPLIFIED_ZOOMS', 3))
+
+    class Config:
+        """model config"""
+
+        env_file = ".env"
+        env_prefix = "VECTOR_"
+
+
+vector_tile_setting = VectorTileSettings()
+
+class TileSettings(BaseSettings):
+    """Tile rendering settings"""
+
+    # Metatile size by zoom, as comma separated `minzoom:size` pairs, e.g.
+    # "10:2,13:4" renders 2x2 blocks of tiles from zoom 10 and 4x4 blocks
+    # from zoom 13.  Empty (the default) renders every tile on its own.
+    metatile_sizes: str = os.environ.get('TILE_METATILE_SIZES', '')
+    # Record per-stage tile timings in a histogram by zoom level at /metrics.
+    stage_metrics: bool = os.environ.get('TILE_STAGE_METRICS', 'false').lower() in ('1', 'true', 'yes')
+    # Where rescaling, colormapping and encoding run: "thread" (inline in the
+    # request's worker thread) or "process" (a pool of worker processes).
+    render_backend: str = os.environ.get('TILE_RENDER_BACKEND', 'thread')
+    # Worker processes of the "process" backend; defaults to the CPU count.
+    render_processes: int = int(os.environ.get('TILE_RENDER_PROCESSES', os.cpu_count() or 1))
+    # Tile renders allowed to wait for a worker process before requests are
+    # rejected with a 503.
+    render_queue_size: int = int(os.environ.get('TILE_RENDER_QUEUE_SIZE', 32))
+    # Seconds clients are told to wait (`Retry-After`) when rejected.
+    render_retry_after: int = int(os.environ.get('TILE_RENDER_RETRY_AFTER', 1))
+
+    class Config:
+        """model config"""
+
+        env_file = ".env"
+        env_prefix = "TILE_"
+
+    def metatile_size(self, zoom: int) -> int:
+        """Return the metatile size (tiles per side) used at `zoom`."""
+        size = 1
+        for minzoom, zoom_size in sorted(
+            tuple(int(v) for v in pair.split(":"))
+            for pair in self.metatile_sizes.split(",")
+            if pair.strip()
+        ):
+            if zoom >= minzoom:
+                size = max(zoom_size, 1)
+        return size
+
+
+tile_setting = TileSettings()
+
+
+class ProfilerSettings(BaseSettings):
+    """Slow request profiler settings"""
+
+    # Directory profiles are written to; empty (the default) disables profiling.
+    directory: str = os.environ.get('PROFILE_DIRECTORY', '')
+    # Profile every request and keep those slower than this many seconds; 0 disables.
+    # With this default, every request pays for stack sampling.
+    slow_threshold: float = float(os.environ.get('PROFILE_SLOW_THRESHOLD', 1.0))
+    # Also profile a random 1 in N requests; 0 disables.
+    sample_rate: int = int(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    # Seconds between stack samples.
+    interval: float = float(os.environ.get('PROFILE_INTERVAL', 0.01))
+    # Number of profiles kept in the directory, oldest removed first.
+    max_profiles: int = int(os.environ.get('PROFILE_MAX_PROFILES', 500))
+
+    class Config:
+        """model config"""
+
+        env_file = ".env"
+        env_prefix = "PROFILE_"
+
+
+profiler_setting = ProfilerSettings()
+
+
+class WorkerSettings(BaseSettings):
+    """Multi-worker server settings, used by gunicorn.conf.py"""
+
+    # Number of worker processes; 0 uses one per available CPU.  Each worker
+    # has its own in-process caches and pools (see gunicorn.conf.py).
+    count: int = int(os.environ.get('WORKER_COUNT', 1))
+    # Requests a worker serves before it is replaced; 0 disables.  A random
+    # jitter of up to WORKER_MAX_REQUESTS_JITTER staggers the restarts.
+    max_requests: int = int(os.environ.get('WORKER_MAX_REQUESTS', 10000))
+    max_requests_jitter: int = int(os.environ.get('WORKER_MAX_REQUESTS_JITTER', 1000))
+    # Resident memory, in MB, above which a worker is replaced; 0 disables.
+    max_memory: int = int(os.environ.get('WORKER_MAX_MEMORY', 0))
+    # Seconds between memory checks.
+    memory_check_interval: float = float(os.environ.get('WORKER_MEMORY_CHECK_INTERVAL', 10))
+    # Seconds a replaced worker has to finish its requests.
+    graceful_timeout: int = int(os.environ.get('WORKER_GRACEFUL_TIMEOUT', 30))
+
+    class Config:
+        """model config"""
+
+        env_file = ".env"
+        env_prefix = "WORKER_"
+
+
+worker_setting = WorkerSettings()
@@ -0,0 +1,52 @@
+"""Request stage timings.
+
+app/timings.py
+
+"""
+
+import contextlib
+import threading
+import time
+from typing import Dict, Optional
+
+
+class StageTimer:
+    """Accumulate the time spent in named stages of one request.
+
+    Stages can be entered several times (e.g. once per tile of a metatile)
+    and from several threads; their durations add up.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.durations: Dict[str, float] = {}
+        self.descriptions: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def describe(self, name: str, description: str):
+        """Attach a description (e.g. "4x4" for a metatile) to a stage."""
+        self.descriptions[name] = description
+
+    def server_timing(self, total: Optional[float] = None) -> str:
+        """Format the stages as a `Server-Timing` header value."""
+        if total is None:
+            total = time.perf_counter() - self.start
+        metrics = []
+        for name, seconds in {**self.durations, "total": total}.items():
+            metric = f"{name};dur={seconds * 1000:.1f}"
+            if name in self.descriptions:
+                metric += f';desc="{self.descriptions[name]}"'
+            metrics.append(metric)
+        return ", ".join(metrics)
@@ -0,0 +1,290 @@
+"""GeoJSON vector tiles.
+
+app/vectortiles.py
+
+"""
+
+import collections
+import json
+import logging
+import threading
+from typing import Any, Dict
+
+import httpx
+import mapbox_vector_tile
+import numpy
+import shapely
+from fastapi import APIRouter, Depends, HTTPException, Path
+from pyproj import CRS, Transformer
+from pyproj.exceptions import CRSError
+from rio_tiler.io.base import WEB_MERCATOR_TMS
+from starlette.requests import Request
+from starlette.responses import Response
+from typing_extensions import Annotated
+
+from cache import cached
+from dependencies import DatasetPathParams
+from readers import get_object_version
+from settings import vector_tile_setting
+
+LOGGER = logging.getLogger(__name__)
+
+# Layer name of the features in every tile.
+LAYER_NAME = "features"
+
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+
+# Latitude limit of Web Mercator.
+MAX_LATITUDE = 85.05112878
+
+_http_client = httpx.Client(follow_redirects=True, timeout=60)
+
+
+def _property_value(value):
+    # Vector tiles only hold strings, numbers and booleans.
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    return json.dumps(value)
+
+
+def _source_crs(document: Dict) -> CRS:
+    # RFC 7946 GeoJSON is always WGS84, but files written from shapefiles
+    # by older tools may name another CRS.
+    name = (document.get("crs") or {}).get("properties", {}).get("name")
+    return CRS.from_user_input(name) if name else CRS.from_user_input("OGC:CRS84")
+
+
+def _to_web_mercator(geometries: numpy.ndarray, crs: CRS) -> numpy.ndarray:
+    transformer = Transformer.from_crs(crs, "EPSG:3857", always_xy=True)
+
+    def transform(coords):
+        x, y = coords[:, 0], coords[:, 1]
+        if crs.is_geographic:
+            y = numpy.clip(y, -MAX_LATITUDE, MAX_LATITUDE)
+        return numpy.column_stack(transformer.transform(x, y))
+
+    return shapely.transform(geometries, transform)
+
+
+class VectorLayer:
+    """The features of a GeoJSON document, indexed for tiling.
+
+    Geometries are projected to Web Mercator and put in an STR-tree once.
+    Each zoom's simplified geometries are computed for the features its
+    tiles touch, and kept for the `simplified_zooms` zooms used most
+    recently.
+    """
+
+    def __init__(self, document: Dict):
+        if document.get("type") == "FeatureCollection":
+            features = document.get("features") or []
+        elif document.get("type") == "Feature":
+            features = [document]
+        else:
+            features = [{"type": "Feature", "geometry": document}]
+        features = [f for f in features if f.get("geometry")]
+
+        self.geometries = _to_web_mercator(
+            shapely.from_geojson([json.dumps(f["geometry"]) for f in features]),
+            _source_crs(document),
+        )
+        self.properties = [
+            {
+                key: _property_value(value)
+                for key, value in (f.get("properties") or {}).items()
+                if value is not None
+            }
+            for f in features
+        ]
+        self.ids = [f.get("id") if isinstance(f.get("id"), int) else None for f in features]
+        self.tree = shapely.STRtree(self.geometries)
+        self._lock = threading.Lock()
+        # zoom -> geometries simplified for it, None until computed; least
+        # recently used first
+        self._simplified: collections.OrderedDict = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.geometries)
+
+    def _geometries_at(self, zoom: int, indexes: numpy.ndarray) -> numpy.ndarray:
+        if zoom > vector_tile_setting.simplify_maxzoom:
+            return self.geometries[indexes]
+
+        with self._lock:
+            simplified = self._simplified.get(zoom)
+            if simplified is None:
+                simplified = self._simplified[zoom] = numpy.full(
+                    len(self.geometries), None, dtype=object
+                )
+                while len(self._simplified) > vector_tile_setting.simplified_zooms:
+                    self._simplified.popitem(last=False)
+            else:
+                self._simplified.move_to_end(zoom)
+        missing = indexes[shapely.is_missing(simplified[indexes])]
+        if missing.size:
+            tile = WEB_MERCATOR_TMS.xy_bounds(0, 0, zoom)
+            resolution = (tile.right - tile.left) / vector_tile_setting.extent
+            simplified[missing] = shapely.simplify(
+                self.geometries[missing],
+                vector_tile_setting.simplify * resolution,
+                preserve_topology=True,
+            )
+        return simplified[indexes]
+
+    def tile(self, z: int, x: int, y: int) -> bytes:
+        """Return the Mapbox Vector Tile of the features in a WebMercatorQuad tile."""
+        extent = vector_tile_setting.extent
+        bounds = WEB_MERCATOR_TMS.xy_bounds(x, y, z)
+        scale = extent / (bounds.right - bounds.left)
+        margin = vector_tile_setting.buffer / scale
+        clip = (
+            bounds.left - margin,
+            bounds.bottom - margin,
+            bounds.right + margin,
+            bounds.top + margin,
+        )
+
+        indexes = numpy.sort(self.tree.query(shapely.box(*clip)))
+        if not indexes.size:
+            return b""
+        geometries = shapely.clip_by_rect(self._geometries_at(z, indexes), *clip)
+
+        # To integer tile coordinates, y down.  Snapping to the grid drops
+        # parts that collapse and leaves valid geometries, so the encoder's
+        # own (slow) validity and winding order checks can be skipped.
+        geometries = shapely.transform(
+            geometries,
+            lambda coords: numpy.column_stack(
+                ((coords[:, 0] - bounds.left) * scale, (bounds.top - coords[:, 1]) * scale)
+            ),
+        )
+        geometries = shapely.set_precision(geometries, 1.0)
+        keep = ~(shapely.is_empty(geometries) | shapely.is_missing(geometries))
+        if not keep.any():
+            return b""
+        # Exterior rings clockwise on screen, as the spec requires.
+        geometries = shapely.orient_polygons(geometries[keep], exterior_cw=False)
+
+        features = [
+            {"geometry": geometry, "properties": self.properties[i], "id": self.ids[i]}
+            for i, geometry in zip(indexes[keep], geometries)
+        ]
+        return mapbox_vector_tile.encode(
+            [{"name": LAYER_NAME, "features": features}],
+            default_options={
+                "extents": extent,
+                "y_coord_down": True,
+                "check_winding_order": False,
+            },
+        )
+
+
+def _load_document(url: str) -> Dict:
+    if not url.startswith(("http://", "https://")):
+        with open(url, "rb") as f:
+            return json.loads(f.read(vector_tile_setting.max_size + 1))
+
+    content = bytearray()
+    with _http_client.stream("GET", url) as response:
+        response.raise_for_status()
+        for chunk in response.iter_bytes():
+            content += chunk
+            if len(content) > vector_tile_setting.max_size:
+                raise ValueError(
+                    f"GeoJSON is larger than {vector_tile_setting.max_size} bytes"
+                )
+    return json.loads(content)
+
+
+class VectorLayerPool:
+    """Process-wide pool of indexed GeoJSON layers, by URL.
+
+    A layer is loaded once, by the first request that needs it, and
+    reloaded when its object version changes.  The least recently used
+    layers are dropped once more than `max_layers` are loaded.
+    """
+
+    def __init__(self, max_layers: int):
+        self.max_layers = max_layers
+        self.loaded = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+        # url -> (object version, layer), least recently used first
+        self._layers: collections.OrderedDict = collections.OrderedDict()
+        self._loading: Dict[str, threading.Lock] = {}
+
+    def get(self, url: str) -> VectorLayer:
+        version = get_object_version(url)
+        with self._lock:
+            entry = self._layers.get(url)
+            if entry is not None and entry[0] == version:
+                self._layers.move_to_end(url)
+                self.reused += 1
+                return entry[1]
+            loading = self._loading.setdefault(url, threading.Lock())
+
+        # Only one request per URL loads it; the others wait for it.
+        with loading:
+            with self._lock:
+                entry = self._layers.get(url)
+                if entry is not None and entry[0] == version:
+                    self.reused += 1
+                    return entry[1]
+
+            layer = VectorLayer(_load_document(url))
+            with self._lock:
+                self.loaded += 1
+                self._layers[url] = (version, layer)
+                self._layers.move_to_end(url)
+                while len(self._layers) > self.max_layers:
+                    self._layers.popitem(last=False)
+                self._loading.pop(url, None)
+            return layer
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "layers": len(self._layers),
+                "features": sum(len(layer) for _, layer in self._layers.values()),
+                "loaded": self.loaded,
+                "reused": self.reused,
+            }
+
+
+vector_layers = VectorLayerPool(max_layers=vector_tile_setting.max_layers)
+
+router = APIRouter()
+
+
+@router.get(
+    "/{z}/{x}/{y}.mvt",
+    response_class=Response,
+    responses={200: {"content": {MVT_MEDIA_TYPE: {}}, "description": "Return a vector tile."}},
+)
+@cached(alias="default", versioned=True)
+def vector_tile(
+    request: Request,
+    z: Annotated[int, Path(ge=0, le=24, description="Zoom level of the WebMercatorQuad tile.")],
+    x: Annotated[int, Path(ge=0, description="Column of the tile.")],
+    y: Annotated[int, Path(ge=0, description="Row of the tile.")],
+    src_path=Depends(DatasetPathParams),
+):
+    """Mapbox Vector Tile of a GeoJSON dataset, in a `features` layer."""
+    if x >= 2**z or y >= 2**z:
+        raise HTTPException(status_code=404, detail="Tile outside the tile matrix.")
+
+    try:
+        layer = vector_layers.get(src_path)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(
+            status_code=404 if e.response.status_code == 404 else 502,
+            detail=f"Could not read {src_path}",
+        )
+    except httpx.TransportError:
+        raise HTTPException(status_code=502, detail=f"Could not read {src_path}")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Could not read {src_path}")
+    except (ValueError, TypeError, AttributeError, CRSError, shapely.errors.GEOSException) as e:
+        raise HTTPException(status_code=400, detail=f"Not a readable GeoJSON: {e}")
+
+    return Response(layer.tile(z, x, y), media_type=MVT_MEDIA_TYPE)
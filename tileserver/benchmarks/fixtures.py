@@ -0,0 +1,114 @@
+"""Synthetic COG fixtures for the tileserver benchmarks.
+
+Each fixture varies one of the things that change how the tileserver
+reads a dataset: its size, data type, internal block size and overview
+layout (full pyramid, a single level, or none).  The data is a noisy
+gradient with a band of nodata, generated from a fixed seed, so that a
+fixture is identical wherever it is written.
+
+Usage (from the tileserver directory, with the titiler image's packages):
+    python benchmarks/fixtures.py DIRECTORY [--fixture NAME ...]
+"""
+import argparse
+import os
+
+import numpy
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.windows import Window
+
+# name -> (size, dtype, block size, overview factors, bounds)
+FIXTURES = {
+    "float32-4096-b512": (4096, "float32", 512, [2, 4, 8, 16], (-10, 35, 10, 55)),
+    "uint8-4096-b256": (4096, "uint8", 256, [2, 4, 8, 16], (-125, 25, -65, 50)),
+    "int16-8192-b512": (8192, "int16", 512, [2, 4, 8, 16, 32], (-180, -60, 180, 80)),
+    "float64-2048-b128": (2048, "float64", 128, [2, 4, 8], (100, -45, 155, -10)),
+    "uint16-4096-b512-one-overview": (4096, "uint16", 512, [4], (-80, -35, -35, 10)),
+    "float32-2048-b512-no-overviews": (2048, "float32", 512, [], (20, -5, 45, 20)),
+}
+
+# Rows generated and written at a time.
+STRIP_HEIGHT = 1024
+
+NODATA = {"float32": -9999, "float64": -9999, "int16": -32768, "uint8": 255, "uint16": 0}
+
+
+def _strip(name: str, row: int, height: int) -> numpy.ndarray:
+    """Return rows `row` to `row + height` of the fixture's data."""
+    size, dtype, _, _, _ = FIXTURES[name]
+    rng = numpy.random.default_rng([0, row])
+    info = numpy.iinfo(dtype) if numpy.issubdtype(dtype, numpy.integer) else None
+    high = min(info.max - 1, 10000) if info else 100
+
+    rows = numpy.arange(row, row + height, dtype="float32")[:, numpy.newaxis]
+    cols = numpy.arange(size, dtype="float32")[numpy.newaxis, :]
+    data = (rows + cols) / (2 * size) * high
+    data += rng.normal(0, high / 50, (height, size)).astype("float32")
+    data = numpy.clip(data, 1, high)
+    # A diagonal band of nodata, so that masks are exercised.
+    data[numpy.abs(rows - cols) < size // 32] = NODATA[dtype]
+    return data.astype(dtype)
+
+
+def make_fixture(path: str, name: str):
+    """Write the fixture `name` as a COG at `path`."""
+    size, dtype, block_size, overviews, bounds = FIXTURES[name]
+    profile = {
+        "driver": "GTiff",
+        "dtype": dtype,
+        "count": 1,
+        "width": size,
+        "height": size,
+        "crs": "EPSG:4326",
+        "transform": from_bounds(*bounds, size, size),
+        "nodata": NODATA[dtype],
+        "tiled": True,
+        "blockxsize": block_size,
+        "blockysize": block_size,
+        "compress": "deflate",
+    }
+    # Written aside, then copied with the overviews ahead of the full
+    # resolution data, as in a COG.
+    tmp_path = path + ".tmp.tif"
+    with rasterio.open(tmp_path, "w", **profile) as dst:
+        for row in range(0, size, STRIP_HEIGHT):
+            height = min(STRIP_HEIGHT, size - row)
+            dst.write(_strip(name, row, height), 1, window=Window(0, row, size, height))
+        if overviews:
+            dst.build_overviews(overviews, Resampling.average)
+    with rasterio.open(tmp_path) as src:
+        rasterio.shutil.copy(
+            src,
+            path,
+            copy_src_overviews=True,
+            **{k: v for k, v in profile.items() if k != "driver"},
+        )
+    os.remove(tmp_path)
+
+
+def ensure_fixtures(directory: str, names=None):
+    """Write the fixtures missing from `directory`; return {name: path}."""
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for name in names or FIXTURES:
+        path = os.path.join(directory, f"{name}.tif")
+        if not os.path.exists(path):
+            make_fixture(path, name)
+        paths[name] = path
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("directory")
+    parser.add_argument("--fixture", action="append", choices=sorted(FIXTURES))
+    args = parser.parse_args()
+
+    for name, path in ensure_fixtures(args.directory, args.fixture).items():
+        print(f"{name:>32} {os.path.getsize(path) / 2**20:8.1f} MB  {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""Load test of the tileserver, replaying pan/zoom traces of the map preview.
+
+Writes the synthetic COGs of `benchmarks/fixtures.py` (reused from
+`--fixtures` if given), serves them from the local range server of
+`benchmarks/rangeserver.py` in place of GCS, starts the tileserver and
+replays map sessions from `--users` concurrent users for `--duration`
+seconds.
+
+A session opens one dataset the way a dataset page and the sync script
+do (tilejson, info and approximate statistics), then pans and zooms
+around it.  Tiles are requested as the map preview's Leaflet layer
+requests them (ckanext-mappreview's `get_layer_js`): `@2x`
+WebMercatorQuad tiles with the same query parameters, for every 256 pixel
+tile in a 900x400 view, nearest the centre first, up to 6 at a time, and
+each tile once per session (the browser cache has the rest).  Traces are
+seeded, so the same options replay the same requests.
+
+Reports requests, errors, throughput and p50/p95/p99 latency per route,
+with the tileserver's cache counters and the range requests it made.
+`--json` saves the report and `--baseline` compares with a saved one, so
+that a change to caching or rendering can be measured against the tree
+before it.  Server settings are passed with `--env`, e.g.
+`--env BLOCK_CACHE_DIRECTORY=/tmp/blocks --env TILE_RENDER_BACKEND=process`.
+The load generator shares the machine with the server; give it spare CPUs.
+
+Usage (from the tileserver directory, with the titiler image's packages):
+    python benchmarks/loadtest.py [--users 16] [--duration 60] [--latency 0.03]
+        [--fixture NAME ...] [--env KEY=VALUE ...] [--json FILE] [--baseline FILE]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import tempfile
+import time
+from urllib.parse import urlencode
+
+import httpx
+import numpy
+from rio_tiler.io import Reader
+
+from fixtures import FIXTURES, ensure_fixtures
+from rangeserver import serve
+from render_backend import start_server
+
+ROUTES = ("tile", "tilejson", "info", "statistics")
+
+# The map preview: a 400 pixel high map, about 900 wide on a laptop, of
+# 256 pixel Leaflet tiles.
+VIEWPORT = (900, 400)
+TILE_SIZE = 256
+# Requests a browser makes at once to one host.
+BROWSER_CONNECTIONS = 6
+# Chances that the next step of a session pans, zooms in or zooms out.
+ACTIONS = {"pan": 0.6, "zoom_in": 0.25, "zoom_out": 0.15}
+
+
+def dataset_metadata(name, path, url):
+    """Bounds, zooms and tile query parameters of a fixture."""
+    with Reader(path) as src_dst:
+        bounds = src_dst.get_geographic_bounds(src_dst.tms.rasterio_geographic_crs)
+        stats = src_dst.statistics()["b1"]
+        minzoom, maxzoom = src_dst.minzoom, src_dst.maxzoom
+    # As get_layer_js builds them, from the sync script's statistics.
+    params = {
+        "colormap_name": "viridis",
+        "bidx": 1,
+        "url": url,
+        "rescale": f"{stats.percentile_2},{stats.max}",
+    }
+    return {
+        "name": name,
+        "url": url,
+        "bounds": bounds,
+        "minzoom": minzoom,
+        "maxzoom": maxzoom,
+        "query": urlencode(params),
+    }
+
+
+def lonlat_to_pixel(lon, lat, zoom):
+    world = TILE_SIZE * 2**zoom
+    lat = max(min(lat, 85.05), -85.05)
+    siny = math.sin(math.radians(lat))
+    x = (lon + 180) / 360 * world
+    y = (0.5 - math.log((1 + siny) / (1 - siny)) / (4 * math.pi)) * world
+    return x, y
+
+
+def view_tiles(cx, cy, zoom):
+    """Tiles of a view centred on pixel (cx, cy), nearest the centre first."""
+    width, height = VIEWPORT
+    count = 2**zoom
+    tiles = []
+    for y in range(math.floor((cy - height / 2) / TILE_SIZE), math.floor((cy + height / 2 - 1) / TILE_SIZE) + 1):
+        if not 0 <= y < count:
+            continue
+        for x in range(math.floor((cx - width / 2) / TILE_SIZE), math.floor((cx + width / 2 - 1) / TILE_SIZE) + 1):
+            distance = ((x + 0.5) * TILE_SIZE - cx) ** 2 + ((y + 0.5) * TILE_SIZE - cy) ** 2
+            # Leaflet wraps tiles around the antimeridian.
+            tiles.append((distance, (zoom, x % count, y)))
+    return [tile for _, tile in sorted(tiles)]
+
+
+def session_trace(rng, dataset, steps):
+    """Yield the tiles of each view of a pan/zoom session over `dataset`."""
+    west, south, east, north = dataset["bounds"]
+    zoom = max(dataset["minzoom"], 1)
+    maxzoom = dataset["maxzoom"] + 1
+    lon = rng.uniform(west + (east - west) * 0.2, east - (east - west) * 0.2)
+    lat = rng.uniform(south + (north - south) * 0.2, north - (north - south) * 0.2)
+    cx, cy = lonlat_to_pixel(lon, lat, zoom)
+
+    for _ in range(steps):
+        # Keep the centre over the dataset.
+        left, top = lonlat_to_pixel(west, north, zoom)
+        right, bottom = lonlat_to_pixel(east, south, zoom)
+        cx, cy = min(max(cx, left), right), min(max(cy, top), bottom)
+        yield view_tiles(cx, cy, zoom)
+
+        action = rng.choice(list(ACTIONS), p=list(ACTIONS.values()))
+        if action == "pan":
+            cx += rng.uniform(-0.5, 0.5) * VIEWPORT[0]
+            cy += rng.uniform(-0.5, 0.5) * VIEWPORT[1]
+        elif action == "zoom_in" and zoom < maxzoom:
+            zoom, cx, cy = zoom + 1, cx * 2, cy * 2
+        elif action == "zoom_out" and zoom > max(dataset["minzoom"], 1):
+            zoom, cx, cy = zoom - 1, cx / 2, cy / 2
+
+
+class Results:
+    def __init__(self):
+        self.latencies = {route: [] for route in ROUTES}
+        self.statuses = {route: {} for route in ROUTES}
+
+    def add(self, route, status, latency):
+        self.statuses[route][status] = self.statuses[route].get(status, 0) + 1
+        if isinstance(status, int) and status < 400:
+            self.latencies[route].append(latency)
+
+    def report(self, elapsed):
+        report = {}
+        for route in ROUTES:
+            latencies = numpy.array(self.latencies[route]) * 1000
+            statuses = self.statuses[route]
+            requests = sum(statuses.values())
+            p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99]) if latencies.size else (0, 0, 0)
+            report[route] = {
+                "requests": requests,
+                "errors": requests - latencies.size,
+                "rate": requests / elapsed,
+                "p50": float(p50),
+                "p95": float(p95),
+                "p99": float(p99),
+                "statuses": {str(k): v for k, v in sorted(statuses.items(), key=str)},
+            }
+        return report
+
+
+async def timed_get(client, results, route, url):
+    start = time.perf_counter()
+    try:
+        response = await client.get(url)
+        status = response.status_code
+        await response.aclose()
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    results.add(route, status, time.perf_counter() - start)
+
+
+async def user(index, client, datasets, args, deadline, results):
+    session = 0
+    while time.perf_counter() < deadline:
+        rng = numpy.random.default_rng([args.seed, index, session])
+        session += 1
+        dataset = datasets[rng.integers(len(datasets))]
+        query = dataset["query"]
+        url_query = urlencode({"url": dataset["url"]})
+
+        await timed_get(client, results, "tilejson", f"/cog/WebMercatorQuad/tilejson.json?{query}&tile_scale=2")
+        await timed_get(client, results, "info", f"/cog/info?{url_query}")
+        await timed_get(client, results, "statistics", f"/cog/statistics?{url_query}&approximate=auto")
+
+        seen = set()
+        connections = asyncio.Semaphore(BROWSER_CONNECTIONS)
+
+        async def tile(z, x, y):
+            async with connections:
+                await timed_get(
+                    client, results, "tile",
+                    f"/cog/tiles/WebMercatorQuad/{z}/{x}/{y}@2x?{query}",
+                )
+
+        for tiles in session_trace(rng, dataset, args.steps):
+            tiles = [t for t in tiles if t not in seen]
+            seen.update(tiles)
+            await asyncio.gather(*(tile(*t) for t in tiles))
+            if time.perf_counter() >= deadline:
+                break
+            if args.think:
+                await asyncio.sleep(rng.exponential(args.think))
+
+
+async def replay(base, datasets, args):
+    results = Results()
+    limits = httpx.Limits(max_connections=args.users * BROWSER_CONNECTIONS)
+    async with httpx.AsyncClient(base_url=base, timeout=120, limits=limits) as client:
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(
+            *(user(i, client, datasets, args, deadline, results) for i in range(args.users))
+        )
+        elapsed = time.perf_counter() - start
+    return results.report(elapsed), elapsed
+
+
+def print_report(report, baseline=None):
+    def change(route, key):
+        if not baseline or route not in baseline["routes"] or not baseline["routes"][route][key]:
+            return ""
+        old = baseline["routes"][route][key]
+        return f" ({(report['routes'][route][key] - old) / old * 100:+.0f}%)"
+
+    print(f"{'route':>10} {'requests':>9} {'errors':>7} {'req/s':>14} {'p50 ms':>14} {'p95 ms':>14} {'p99 ms':>14}")
+    for route, stats in report["routes"].items():
+        print(
+            f"{route:>10} {stats['requests']:>9} {stats['errors']:>7} "
+            + " ".join(
+                f"{f'{stats[key]:.1f}' + change(route, key):>14}"
+                for key in ("rate", "p50", "p95", "p99")
+            )
+        )
+    for route, stats in report["routes"].items():
+        print(f"{route:>10} statuses: {stats['statuses']}")
+
+    cache = report.get("cache_stats") or {}
+    if cache:
+        print(f"tile cache hit ratio {cache.get('hit_ratio', 0):.2f}", end="")
+        block_cache = cache.get("block_cache") or {}
+        if block_cache.get("enabled"):
+            print(f", block cache hit ratio {block_cache['hit_ratio']:.2f}", end="")
+        print()
+    remote = report.get("remote") or {}
+    tiles = report["routes"]["tile"]["requests"]
+    if remote and tiles:
+        print(
+            f"range server: {remote.get('get', 0)} GETs, {remote.get('head', 0)} HEADs, "
+            f"{remote.get('bytes', 0) / 2**20:.1f} MB "
+            f"({remote.get('get', 0) / tiles:.2f} GETs per tile)"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--steps", type=int, default=12, help="Views per session")
+    parser.add_argument("--think", type=float, default=0, help="Mean seconds between views")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fixture", action="append", choices=sorted(FIXTURES))
+    parser.add_argument("--fixtures", help="Directory the fixtures are written to and reused from")
+    parser.add_argument("--latency", type=float, default=0.03, help="Range server delay, in seconds")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE tileserver setting")
+    parser.add_argument("--base", help="Test a running tileserver instead of starting one")
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--json", help="Save the report to this file")
+    parser.add_argument("--baseline", help="Compare with a report saved by --json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        directory = args.fixtures or tmpdir
+        paths = ensure_fixtures(directory, args.fixture)
+        range_server = serve(directory, latency=args.latency)
+        range_base = f"http://127.0.0.1:{range_server.server_port}"
+        datasets = [
+            dataset_metadata(name, path, f"{range_base}/{os.path.basename(path)}")
+            for name, path in paths.items()
+        ]
+
+        server = None
+        base = args.base
+        if not base:
+            env = dict(setting.split("=", 1) for setting in args.env)
+            server, base = start_server(datasets[0]["url"], args.port, env)
+        try:
+            routes, elapsed = asyncio.run(replay(base, datasets, args))
+            cache_stats = httpx.get(f"{base}/cache/stats").json()
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+        remote = httpx.get(f"{range_base}/_stats").json()
+        range_server.shutdown()
+
+    report = {
+        "options": {
+            key: getattr(args, key)
+            for key in ("users", "duration", "steps", "think", "seed", "latency", "env")
+        },
+        "fixtures": sorted(paths),
+        "elapsed": elapsed,
+        "routes": routes,
+        "cache_stats": cache_stats,
+        "remote": remote,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print(
+        f"{len(datasets)} datasets, {args.users} users, {elapsed:.0f} s, "
+        f"range server latency {args.latency * 1000:.0f} ms, {os.cpu_count()} CPUs"
+    )
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
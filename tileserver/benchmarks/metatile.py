@@ -0,0 +1,134 @@
+"""Per-tile latency of the tile endpoint with and without metatiles.
+
+Renders every tile of a few metatile-aligned blocks of a COG, once tile by
+tile (`Reader.tile`) and once through `metatiles.read_metatile`, and reports
+the mean read + render time per tile.  Both paths use the map preview's
+rescale and colormap and go through `render.render_colormapped`.
+
+Without `--url`, a synthetic float32 COG (4096x4096, 512 pixel blocks, with
+overviews) is written to a temporary directory.  Pointing `--url` at a COG
+in Google Cloud Storage shows the effect of fewer range requests.
+
+Usage (from the tileserver directory, with the titiler image's packages):
+    python benchmarks/metatile.py [--url URL] [--zoom 8] [--sizes 2,4]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rio_tiler.io import Reader
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from dependencies import get_named_colormap  # noqa: E402
+from metatiles import metatile_tiles, read_metatile  # noqa: E402
+from render import render_colormapped  # noqa: E402
+
+RESCALE = (0.0, 100.0)
+
+# No block or range cache between runs, so both modes pay for their reads.
+ENV = {"GDAL_CACHEMAX": 0, "VSI_CACHE": False, "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR"}
+
+
+def make_cog(path, size=4096):
+    """Write a noisy gradient COG over western Europe."""
+    rng = numpy.random.default_rng(0)
+    gradient = numpy.linspace(0, 100, size * size, dtype="float32").reshape(size, size)
+    data = gradient + rng.normal(0, 5, (size, size)).astype("float32")
+    profile = {
+        "driver": "GTiff",
+        "dtype": "float32",
+        "count": 1,
+        "width": size,
+        "height": size,
+        "crs": "EPSG:4326",
+        "transform": from_bounds(-10, 35, 10, 55, size, size),
+        "nodata": -9999,
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "compress": "deflate",
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data, 1)
+        dst.build_overviews([2, 4, 8, 16], Resampling.average)
+
+
+def blocks(src_dst, zoom, size, count):
+    """Return up to `count` metatile origins whose tiles are all in the dataset."""
+    minx, miny, maxx, maxy = src_dst.get_geographic_bounds(src_dst.tms.rasterio_geographic_crs)
+    ul = src_dst.tms.tile(minx, maxy, zoom)
+    lr = src_dst.tms.tile(maxx, miny, zoom)
+    origins = []
+    for y in range(ul.y - ul.y % size + size, lr.y - size + 1, size):
+        for x in range(ul.x - ul.x % size + size, lr.x - size + 1, size):
+            origins.append((x, y))
+    return origins[:count]
+
+
+def per_tile(src_dst, tiles, scale, colormap):
+    for tile in tiles:
+        image = src_dst.tile(tile.x, tile.y, tile.z, tilesize=scale * 256, indexes=(1,))
+        render_colormapped(image, RESCALE, colormap)
+
+
+def per_metatile(src_dst, origin, zoom, size, scale, colormap):
+    images = read_metatile(
+        src_dst, origin[0], origin[1], zoom, size, tilesize=scale * 256, indexes=(1,)
+    )
+    for image in images.values():
+        render_colormapped(image, RESCALE, colormap)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--url", help="COG to read (default: a synthetic COG)")
+    parser.add_argument("--zoom", type=int, default=8)
+    parser.add_argument("--sizes", default="2,4", help="Metatile sizes to compare")
+    parser.add_argument("--scale", type=int, default=2, help="Tile scale (2 = 512px)")
+    parser.add_argument("--blocks", type=int, default=4, help="Metatiles per size")
+    args = parser.parse_args()
+
+    colormap = get_named_colormap("viridis")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        url = args.url
+        if not url:
+            url = os.path.join(tmpdir, "cog.tif")
+            make_cog(url)
+
+        print(f"{'size':>4} {'tiles':>5} {'per tile ms':>12} {'metatile ms':>12} {'x':>6}")
+        for size in (int(s) for s in args.sizes.split(",")):
+            with rasterio.Env(**ENV), Reader(url) as src_dst:
+                origins = blocks(src_dst, args.zoom, size, args.blocks)
+                if not origins:
+                    print(f"{size:>4} no complete metatile at zoom {args.zoom}")
+                    continue
+
+                tiles = [
+                    tile
+                    for x, y in origins
+                    for row in metatile_tiles(src_dst.tms, x, y, args.zoom, size)
+                    for tile in row
+                ]
+
+                start = time.perf_counter()
+                per_tile(src_dst, tiles, args.scale, colormap)
+                single = (time.perf_counter() - start) * 1000 / len(tiles)
+
+            with rasterio.Env(**ENV), Reader(url) as src_dst:
+                start = time.perf_counter()
+                for origin in origins:
+                    per_metatile(src_dst, origin, args.zoom, size, args.scale, colormap)
+                meta = (time.perf_counter() - start) * 1000 / len(tiles)
+
+            print(f"{size:>4} {len(tiles):>5} {single:>12.2f} {meta:>12.2f} {single / meta:>5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Local stand-in for Google Cloud Storage, serving files with range requests.
+
+Serves the files of a directory over HTTP the way storage.googleapis.com
+serves public objects, as far as GDAL and the tileserver care: HEAD, and
+GET with single `Range` requests (206, or 416 past the end), with
+`x-goog-generation` and `ETag` headers that change when a file does.  An
+optional delay before each response stands in for GCS's time to first
+byte.  Counts of requests and bytes served are at `/_stats`.
+
+Usage (from the tileserver directory):
+    python benchmarks/rangeserver.py DIRECTORY [--port 8790] [--latency 0.03]
+"""
+import argparse
+import http.server
+import json
+import os
+import re
+import threading
+import time
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Set on the subclass made by `serve`.
+    directory = "."
+    latency = 0.0
+    stats = None
+    stats_lock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _count(self, name, value=1):
+        with self.stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def _send_empty(self, status, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _object(self):
+        """Return the path and stat of the requested file, or send a 404."""
+        name = self.path.split("?")[0].lstrip("/")
+        path = os.path.realpath(os.path.join(self.directory, name))
+        if not path.startswith(os.path.realpath(self.directory) + os.sep) or not os.path.isfile(path):
+            self._send_empty(404)
+            return None, None
+        return path, os.stat(path)
+
+    def _object_headers(self, stat):
+        generation = str(stat.st_mtime_ns)
+        self.send_header("x-goog-generation", generation)
+        self.send_header("ETag", f'"{generation}-{stat.st_size}"')
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+
+    def do_HEAD(self):
+        self._count("head")
+        time.sleep(self.latency)
+        path, stat = self._object()
+        if path is None:
+            return
+        self.send_response(200)
+        self._object_headers(stat)
+        self.send_header("Content-Length", str(stat.st_size))
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == "/_stats":
+            with self.stats_lock:
+                body = json.dumps(self.stats).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self._count("get")
+        time.sleep(self.latency)
+        path, stat = self._object()
+        if path is None:
+            return
+
+        start, end = 0, stat.st_size
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header:
+            match = RANGE_PATTERN.match(range_header.strip())
+            if not match or not (match.group(1) or match.group(2)):
+                self._send_empty(416, [("Content-Range", f"bytes */{stat.st_size}")])
+                return
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)) + 1, stat.st_size)
+            else:
+                # A suffix range: the last N bytes.
+                start = max(stat.st_size - int(match.group(2)), 0)
+            if start >= stat.st_size or start >= end:
+                self._send_empty(416, [("Content-Range", f"bytes */{stat.st_size}")])
+                return
+            status = 206
+
+        with open(path, "rb") as f:
+            body = os.pread(f.fileno(), end - start, start)
+        self._count("bytes", len(body))
+
+        self.send_response(status)
+        self._object_headers(stat)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{stat.st_size}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(directory: str, port: int = 0, latency: float = 0.0):
+    """Start a range server in a background thread; return the server.
+
+    The server's URL is `f"http://127.0.0.1:{server.server_port}"`.
+    """
+    handler = type(
+        "Handler",
+        (RangeRequestHandler,),
+        {
+            "directory": directory,
+            "latency": latency,
+            "stats": {},
+            "stats_lock": threading.Lock(),
+        },
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("directory")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds of delay before each response"
+    )
+    args = parser.parse_args()
+
+    server = serve(args.directory, args.port, args.latency)
+    print(f"Serving {args.directory} at http://127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Tile throughput under load with the thread and process render backends.
+
+Starts the tileserver once per backend (`TILE_RENDER_BACKEND`), serving a
+local COG, and requests distinct tiles from `--concurrency` clients for
+`--duration` seconds.  A nonce in each query string keeps the tile cache
+out of the way, so every request reads and renders.  Reports tiles/s,
+latency percentiles of successful requests and the number of 503s
+(clients wait for `Retry-After` before their next request).
+
+Without `--url`, the synthetic COG of `benchmarks/metatile.py` is written to
+a temporary directory.
+
+Usage (from the tileserver directory, with the titiler image's packages):
+    python benchmarks/render_backend.py [--concurrency 32] [--duration 20]
+"""
+import argparse
+import concurrent.futures
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+import numpy
+from rio_tiler.io import Reader
+
+from metatile import make_cog
+
+APP = os.path.join(os.path.dirname(__file__), "..", "app")
+
+# Serve local files, which the dataset URL check would otherwise refuse.
+SERVER = """
+import sys
+sys.path.insert(0, {app!r})
+import dependencies
+dependencies.ALLOWED_PREFIXES = ({prefix!r},)
+import main, uvicorn
+uvicorn.run(main.app, port={port}, log_level="warning")
+"""
+
+PARAMS = {
+    "bidx": 1,
+    "format": "webp",
+    "rescale": "0,100",
+    "colormap_name": "viridis",
+}
+
+
+def tiles(url, zoom):
+    with Reader(url) as src_dst:
+        minx, miny, maxx, maxy = src_dst.get_geographic_bounds(
+            src_dst.tms.rasterio_geographic_crs
+        )
+        ul = src_dst.tms.tile(minx, maxy, zoom)
+        lr = src_dst.tms.tile(maxx, miny, zoom)
+    return [(zoom, x, y) for y in range(ul.y, lr.y + 1) for x in range(ul.x, lr.x + 1)]
+
+
+def start_server(url, port, env):
+    script = SERVER.format(app=os.path.abspath(APP), prefix=os.path.dirname(url), port=port)
+    server = subprocess.Popen([sys.executable, "-c", script], env={**os.environ, **env})
+    base = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        try:
+            if httpx.get(f"{base}/healthz").status_code == 200:
+                return server, base
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("tileserver did not start")
+
+
+def load(base, url, tile_list, concurrency, duration):
+    """Request tiles from `concurrency` clients; return latencies and statuses."""
+    nonces = itertools.count()
+    lock = threading.Lock()
+    latencies, statuses = [], {}
+    deadline = time.perf_counter() + duration
+
+    def client():
+        with httpx.Client(base_url=base, timeout=120) as http:
+            while time.perf_counter() < deadline:
+                with lock:
+                    n = next(nonces)
+                z, x, y = tile_list[n % len(tile_list)]
+                start = time.perf_counter()
+                r = http.get(
+                    f"/cog/tiles/WebMercatorQuad/{z}/{x}/{y}@2x",
+                    params={**PARAMS, "url": url, "nonce": n},
+                )
+                elapsed = time.perf_counter() - start
+                with lock:
+                    statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+                    if r.status_code == 200:
+                        latencies.append(elapsed)
+                if r.status_code == 503:
+                    time.sleep(float(r.headers.get("Retry-After", 1)))
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(concurrency)]:
+            future.result()
+    return time.perf_counter() - start, latencies, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--url", help="Local COG to serve (default: a synthetic COG)")
+    parser.add_argument("--zoom", type=int, default=7)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--queue-size", type=int, default=8)
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        url = args.url and os.path.abspath(args.url)
+        if not url:
+            url = os.path.join(tmpdir, "cog.tif")
+            make_cog(url)
+        tile_list = tiles(url, args.zoom)
+
+        print(
+            f"{len(tile_list)} tiles at zoom {args.zoom}, {args.concurrency} clients, "
+            f"{args.processes} processes, queue {args.queue_size}, {os.cpu_count()} CPUs"
+        )
+        print(f"{'backend':>8} {'tiles/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'503s':>6}")
+        for backend in ("thread", "process"):
+            server, base = start_server(url, args.port, {
+                "TILE_RENDER_BACKEND": backend,
+                "TILE_RENDER_PROCESSES": str(args.processes),
+                "TILE_RENDER_QUEUE_SIZE": str(args.queue_size),
+            })
+            try:
+                elapsed, latencies, statuses = load(
+                    base, url, tile_list, args.concurrency, args.duration
+                )
+            finally:
+                server.terminate()
+                server.wait()
+
+            p50, p95, p99 = (
+                numpy.percentile(latencies, [50, 95, 99]) * 1000 if latencies else (0, 0, 0)
+            )
+            print(
+                f"{backend:>8} {len(latencies) / elapsed:>8.1f} {p50:>8.0f} {p95:>8.0f} "
+                f"{p99:>8.0f} {statuses.get(503, 0):>6}"
+            )
+            others = {k: v for k, v in statuses.items() if k not in (200, 503)}
+            if others:
+                print(f"{'':>8} other statuses: {others}")
+
+
+if __name__ == "__main__":
+    main()
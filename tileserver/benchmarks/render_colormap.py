@@ -0,0 +1,129 @@
+"""Micro-benchmark for the fused rescale + colormap tile rendering path.
+
+Compares `render.render_colormapped` with the generic path in the `tile`
+route (`ImageData.rescale` then `render_image`) on synthetic 256 and 512
+pixel single band tiles, and checks that both produce identical bytes.
+
+Two stages are timed: "prepare" is rescale + colormap + mask, the part the
+fused path replaces, and "total" also includes the image encode.
+
+Usage (from the tileserver directory, with the titiler image's packages):
+    python benchmarks/render_colormap.py [--repeat 50]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+import warnings
+
+import numpy
+from rio_tiler.colormap import apply_cmap
+from rio_tiler.models import ImageData
+from titiler.core.resources.enums import ImageType
+from titiler.core.utils import render_image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from dependencies import get_named_colormap, parse_colormap  # noqa: E402
+from render import apply_rescaled_colormap, render_colormapped  # noqa: E402
+
+# The linear colormap used by the CKAN map preview.
+MAPPREVIEW_COLORMAP = json.dumps({
+    0: [109, 179, 30, 50],
+    75: [0, 143, 95, 255],
+    125: [0, 100, 110, 255],
+    175: [28, 58, 109, 255],
+    255: [39, 0, 59, 255],
+})
+
+CASES = [
+    # dtype, rescale range
+    ("float32", (0.0, 100.0)),
+    ("uint16", (100, 4000)),
+    ("uint8", (10, 200)),
+]
+
+
+def make_image(size, dtype, seed=0):
+    """Return a single band tile with a noisy gradient and a nodata corner."""
+    rng = numpy.random.default_rng(seed)
+    gradient = numpy.linspace(0, 1, size * size).reshape(size, size)
+    values = gradient * 4000 + rng.normal(0, 50, (size, size))
+    if numpy.issubdtype(numpy.dtype(dtype), numpy.integer):
+        info = numpy.iinfo(dtype)
+        values = numpy.clip(values, info.min, info.max)
+    array = numpy.ma.MaskedArray(values.astype(dtype)[None])
+    mask = numpy.zeros(array.shape, dtype=bool)
+    mask[:, : size // 4, : size // 4] = True
+    array.mask = mask
+    return ImageData(array)
+
+
+def prepare_generic(image, in_range, colormap):
+    image = ImageData(image.array.copy())
+    image.rescale((in_range,))
+    data, alpha = apply_cmap(image.data.copy(), colormap)
+    return data, numpy.bitwise_and(alpha, image.mask)
+
+
+def total_generic(image, in_range, colormap, output_format):
+    image = ImageData(image.array.copy())
+    image.rescale((in_range,))
+    return render_image(image, output_format=output_format, colormap=colormap)
+
+
+def total_fused(image, in_range, colormap, output_format):
+    return render_colormapped(image, in_range, colormap, output_format=output_format)
+
+
+def best_ms(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    colormaps = {
+        "viridis": get_named_colormap("viridis"),
+        "linear": parse_colormap(MAPPREVIEW_COLORMAP, "linear"),
+    }
+
+    print(f"{'size':>5} {'dtype':>8} {'colormap':>8} {'format':>6} "
+          f"{'prepare ms':>22} {'total ms':>22}")
+    print(f"{'':>31} {'generic':>7} {'fused':>6} {'x':>6} "
+          f"{'generic':>7} {'fused':>6} {'x':>6}")
+    for size in (256, 512):
+        for dtype, in_range in CASES:
+            image = make_image(size, dtype)
+            for name, colormap in colormaps.items():
+                for output_format in (ImageType.png, ImageType.webp, None):
+                    generic = total_generic(image, in_range, colormap, output_format)
+                    fused = total_fused(image, in_range, colormap, output_format)
+                    if generic != fused:
+                        raise AssertionError(
+                            f"Output differs for {size} {dtype} {name} {output_format}"
+                        )
+
+                    prepare = (
+                        best_ms(lambda: prepare_generic(image, in_range, colormap), args.repeat),
+                        best_ms(lambda: apply_rescaled_colormap(image, in_range, colormap), args.repeat),
+                    )
+                    total = (
+                        best_ms(lambda: total_generic(image, in_range, colormap, output_format), args.repeat),
+                        best_ms(lambda: total_fused(image, in_range, colormap, output_format), args.repeat),
+                    )
+                    print(
+                        f"{size:>5} {dtype:>8} {name:>8} "
+                        f"{getattr(output_format, 'value', 'auto'):>6} "
+                        f"{prepare[0]:>7.2f} {prepare[1]:>6.2f} {prepare[0] / prepare[1]:>5.1f}x "
+                        f"{total[0]:>7.2f} {total[1]:>6.2f} {total[0] / total[1]:>5.1f}x"
+                    )
+
+
+if __name__ == "__main__":
+    # render_image warns about the uint8 cast of non uint8 data; that is expected.
+    warnings.simplefilter("ignore", UserWarning)
+    main()
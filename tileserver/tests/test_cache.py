@@ -0,0 +1,115 @@
+"""Tile cache tests.
+
+Run from the tileserver directory, with the titiler image's packages:
+    python -m pytest tests
+"""
+import os
+import sys
+
+import numpy
+import pytest
+import rasterio
+from rasterio.transform import from_bounds
+from starlette.testclient import TestClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import dependencies  # noqa: E402
+import settings  # noqa: E402
+import render  # noqa: E402,F401 registers the "empty" placeholder
+from cache import expand_placeholder, is_placeholder, placeholder  # noqa: E402
+
+# The signature box that starts every JPEG 2000 file.
+JP2_SIGNATURE = b"\x00\x00\x00\x0cjP  \r\n\x87\n"
+
+
+def write_cog(path, data):
+    with rasterio.open(
+        path,
+        "w",
+        driver="COG",
+        width=256,
+        height=256,
+        count=1,
+        dtype="uint8",
+        crs="EPSG:4326",
+        transform=from_bounds(-10, 30, 10, 50, 256, 256),
+    ) as dst:
+        dst.write(data, 1)
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("data") / "cog.tif")
+    write_cog(path, numpy.arange(256 * 256, dtype="uint8").reshape(256, 256))
+    return path
+
+
+@pytest.fixture(scope="module")
+def client(dataset):
+    dependencies.ALLOWED_PREFIXES = (os.path.dirname(dataset),)
+    import main
+
+    with TestClient(main.app) as client:
+        yield client
+
+
+def test_placeholder_round_trip():
+    content = placeholder("empty", "png:256x256")
+    assert is_placeholder(content)
+    assert expand_placeholder(content)[:8] == b"\x89PNG\r\n\x1a\n"
+
+
+def test_jp2_is_not_a_placeholder():
+    content = JP2_SIGNATURE + b"\x00" * 16
+    assert not is_placeholder(content)
+    assert expand_placeholder(content) is content
+
+
+def test_jp2_tile_round_trips_through_the_cache(client, dataset):
+    params = {"url": dataset, "rescale": "0,255"}
+    path = "/cog/tiles/WebMercatorQuad/5/15/11.jp2"
+
+    rendered = client.get(path, params=params)
+    assert rendered.status_code == 200
+    assert rendered.headers["content-type"] == "image/jp2"
+
+    cached = client.get(path, params=params)
+    assert cached.status_code == 200
+    assert cached.headers["x-cache"] == "HIT"
+    assert cached.content == rendered.content
+
+
+def test_empty_tile_round_trips_through_the_cache(client, dataset):
+    params = {"url": dataset, "rescale": "0,255"}
+    path = "/cog/tiles/WebMercatorQuad/5/0/0.png"
+
+    rendered = client.get(path, params=params)
+    assert rendered.status_code == 200
+    assert rendered.content.startswith(b"\x89PNG\r\n\x1a\n")
+
+    cached = client.get(path, params=params)
+    assert cached.headers["x-cache"] == "HIT"
+    assert cached.content == rendered.content
+
+
+@pytest.mark.parametrize(
+    "path",
+    ["/cog/tiles/WebMercatorQuad/5/15/11.png", "/cog/WebMercatorQuad/tilejson.json"],
+)
+def test_changed_dataset_is_not_served_from_the_cache(
+    client, dataset, path, monkeypatch
+):
+    monkeypatch.setattr(settings.reader_pool_setting, "revalidate", 0)
+    changing = os.path.join(os.path.dirname(dataset), "changing.tif")
+    params = {"url": changing, "rescale": "0,255"}
+
+    write_cog(changing, numpy.zeros((256, 256), dtype="uint8"))
+    before = client.get(path, params=params)
+    assert client.get(path, params=params).headers["x-cache"] == "HIT"
+
+    write_cog(changing, numpy.full((256, 256), 255, dtype="uint8"))
+    after = client.get(path, params=params)
+    assert after.status_code == 200
+    assert after.headers["x-cache"] == "MISS"
+    assert after.headers["etag"] != before.headers["etag"]